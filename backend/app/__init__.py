@@ -1,9 +1,10 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.exc import OperationalError
 from dotenv import load_dotenv
 import os
-from .services.logger import setup_logger
+from .services.logger import setup_logger, setup_logging
 
 # Initialize SQLAlchemy and logger
 db = SQLAlchemy()
@@ -15,7 +16,7 @@ def create_app(test_config=None):
     
     # Create Flask app
     app = Flask(__name__)
-    CORS(app)
+    CORS(app, expose_headers=['ETag', 'X-Next-Cursor'])
     
     # Configure the app
     if test_config is None:
@@ -27,11 +28,57 @@ def create_app(test_config=None):
             ),
             SQLALCHEMY_TRACK_MODIFICATIONS=False,
             UPLOAD_FOLDER=os.environ.get('UPLOAD_FOLDER', os.path.join(app.static_folder, 'uploads')),
-            MAX_CONTENT_LENGTH=16 * 1024 * 1024  # 16MB max file size
+            MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB max file size
+            SCAN_WORKERS=int(os.environ.get('SCAN_WORKERS', os.cpu_count() or 1)),
+            SCAN_CHUNK_SIZE=int(os.environ.get('SCAN_CHUNK_SIZE', 200)),
+            RENDITION_CACHE_DIR=os.environ.get('RENDITION_CACHE_DIR', os.path.join(app.instance_path, 'renditions')),
+            RENDITION_CACHE_MAX_BYTES=int(os.environ.get('RENDITION_CACHE_MAX_BYTES', 512 * 1024 * 1024)),
+            DETECTION_ASYNC=os.environ.get('DETECTION_ASYNC', '').lower() in ('1', 'true', 'yes'),
+            DETECTION_JOB_WORKERS=int(os.environ.get('DETECTION_JOB_WORKERS', 2)),
+            DETECTION_JOB_MAX_PENDING=int(os.environ.get('DETECTION_JOB_MAX_PENDING', 100)),
+            DETECTION_JOB_STALE_SECONDS=int(os.environ.get('DETECTION_JOB_STALE_SECONDS', 600)),
+            BATCH_MAX_FILES=int(os.environ.get('BATCH_MAX_FILES', 50)),
+            BATCH_MAX_CONTENT_LENGTH=int(os.environ.get('BATCH_MAX_CONTENT_LENGTH', 256 * 1024 * 1024)),
+            BATCH_DETECT_WORKERS=int(os.environ.get('BATCH_DETECT_WORKERS', os.cpu_count() or 1)),
+            NEAR_DUPLICATE_DETECTION=os.environ.get('NEAR_DUPLICATE_DETECTION', 'true').lower() in ('1', 'true', 'yes'),
+            NEAR_DUPLICATE_DISTANCE=int(os.environ.get('NEAR_DUPLICATE_DISTANCE', 4)),
+            NEAR_DUPLICATE_REUSE=os.environ.get('NEAR_DUPLICATE_REUSE', 'true').lower() in ('1', 'true', 'yes'),
+            DETECTION_CACHE_PATH=os.environ.get('DETECTION_CACHE_PATH', os.path.join(app.instance_path, 'detection_cache.db')),
+            DETECTION_CACHE_MAX_BYTES=int(os.environ.get('DETECTION_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+            DETECTION_CACHE_MEMORY_BYTES=int(os.environ.get('DETECTION_CACHE_MEMORY_BYTES', 32 * 1024 * 1024)),
+            RATE_LIMIT_BACKEND=os.environ.get('RATE_LIMIT_BACKEND', 'memory'),
+            RATE_LIMIT_STORAGE_PATH=os.environ.get('RATE_LIMIT_STORAGE_PATH', os.path.join(app.instance_path, 'rate_limits.db')),
+            BULK_WRITE_CHUNK_SIZE=int(os.environ.get('BULK_WRITE_CHUNK_SIZE', 500)),
+            SQLITE_JOURNAL_MODE=os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+            SQLITE_SYNCHRONOUS=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            SQLITE_BUSY_TIMEOUT_MS=int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+            CLUSTER_ON_DETECT=os.environ.get('CLUSTER_ON_DETECT', 'true').lower() in ('1', 'true', 'yes'),
+            CLUSTER_THRESHOLD=float(os.environ.get('CLUSTER_THRESHOLD', 0.95)),
+            CLUSTER_MERGE_THRESHOLD=float(os.environ.get('CLUSTER_MERGE_THRESHOLD', 0.97)),
+            CLUSTER_MERGE_INTERVAL=int(os.environ.get('CLUSTER_MERGE_INTERVAL', 500)),
+            EMBEDDING_STORE_DIR=os.environ.get('EMBEDDING_STORE_DIR', ''),
+            EMBEDDING_NPROBE=int(os.environ.get('EMBEDDING_NPROBE', 16)),
+            EMBEDDING_RERANK=int(os.environ.get('EMBEDDING_RERANK', 64)),
+            METRICS_ENABLED=os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+            PROFILING_ENABLED=os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes'),
+            PROFILING_INTERVAL=float(os.environ.get('PROFILING_INTERVAL', 0.005)),
+            PROFILE_DIR=os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')),
+            DB_AUTO_INIT=os.environ.get('DB_AUTO_INIT', '').lower() in ('1', 'true', 'yes'),
+            PRELOAD_MODELS=os.environ.get('PRELOAD_MODELS', '').lower() in ('1', 'true', 'yes'),
+            LOG_LEVEL=os.environ.get('LOG_LEVEL', 'INFO'),
+            LOG_LEVELS=os.environ.get('LOG_LEVELS', 'error_handler=ERROR'),
+            LOG_FORMAT=os.environ.get('LOG_FORMAT', 'json'),
+            LOG_FILE=os.environ.get('LOG_FILE'),
+            LOG_QUEUE_SIZE=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+            LOG_SAMPLE_BURST=int(os.environ.get('LOG_SAMPLE_BURST', 20)),
+            LOG_SAMPLE_INTERVAL=float(os.environ.get('LOG_SAMPLE_INTERVAL', 60))
         )
     else:
         app.config.update(test_config)
 
+    # Queue-based JSON logging; handlers are attached once per process
+    setup_logging(app)
+
     # Ensure the instance folder exists
     try:
         os.makedirs(app.instance_path)
@@ -47,13 +94,62 @@ def create_app(test_config=None):
     # Initialize database
     db.init_app(app)
 
+    # Detection results keyed by image content and detector settings;
+    # forked scan workers inherit the configuration
+    from .services.detection_cache import configure_detection_cache
+    configure_detection_cache(
+        app.config.get('DETECTION_CACHE_PATH'),
+        max_bytes=app.config.get('DETECTION_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+        memory_bytes=app.config.get('DETECTION_CACHE_MEMORY_BYTES', 0)
+    )
+
+    # Per-route request metrics and the optional per-request profiler
+    from .services.metrics import init_app as init_metrics
+    init_metrics(app)
+
     # Register blueprints
     from .routes import face_recognition_bp
     app.register_blueprint(face_recognition_bp)
 
-    # Create database tables
+    # Register maintenance commands
+    from .commands import register_commands
+    register_commands(app)
+
+    # Workers start lean: OpenCV, numpy and the cascade are loaded by the
+    # first request that needs them. With PRELOAD_MODELS a preforking
+    # server (gunicorn --preload) loads them once in the master and the
+    # workers share the pages copy-on-write, along with the cipher key.
+    if app.config.get('PRELOAD_MODELS'):
+        preload_models()
+
     with app.app_context():
-        db.create_all()
+        # WAL and a busy timeout keep readers responsive while scans write
+        from .services.database import configure_sqlite
+        configure_sqlite(
+            db.engine,
+            journal_mode=app.config.get('SQLITE_JOURNAL_MODE', 'WAL'),
+            synchronous=app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            busy_timeout_ms=app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000)
+        )
+
+        # Schema work belongs to `flask init-db`, run once per deployment
+        if app.config.get('DB_AUTO_INIT'):
+            db.create_all()
+
+        # Pick up detection jobs that were pending when the last process stopped
+        from .routes import recover_detection_jobs
+        try:
+            recover_detection_jobs(app)
+        except OperationalError as e:
+            db.session.rollback()
+            logger.warning(f"Skipping detection job recovery, run `flask init-db` first: {e.orig}")
         logger.info('Application initialized successfully')
 
-    return app
\ No newline at end of file
+    return app
+
+def preload_models():
+    """Import the CV services, load the face cascade and build the ciphers"""
+    from .services import face_clustering, renditions  # noqa: F401
+    from .services.face_detection import get_ciphers, get_detector
+    get_detector().warmup()
+    get_ciphers()
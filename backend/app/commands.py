@@ -0,0 +1,139 @@
+import click
+from flask.cli import with_appcontext
+
+from . import db, logger
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create any missing tables; run once per deployment, before starting workers"""
+    db.create_all()
+    logger.info('Database initialized')
+    click.echo('Database initialized')
+
+@click.command('migrate-face-features')
+@click.option('--batch-size', default=500, show_default=True, help='Rows to rewrite per commit')
+@with_appcontext
+def migrate_face_features_command(batch_size):
+    """Rewrite legacy JSON/Fernet face encodings in the compact binary format"""
+    from .models import Face
+    from .services.face_detection import decrypt_features, encode_features, is_legacy_features
+
+    migrated = 0
+    failed = 0
+    last_id = 0
+    while True:
+        faces = Face.query.filter(Face.id > last_id, Face.encoding.isnot(None)) \
+            .order_by(Face.id).limit(batch_size).all()
+        if not faces:
+            break
+        for face in faces:
+            if not isinstance(face.encoding, (str, bytes)) or not is_legacy_features(face.encoding):
+                continue
+            try:
+                face.encoding = encode_features(decrypt_features(face.encoding))
+                migrated += 1
+            except ValueError:
+                failed += 1
+        db.session.commit()
+        last_id = faces[-1].id
+
+    logger.info(f"Migrated {migrated} face encodings, {failed} could not be decrypted")
+    click.echo(f"Migrated {migrated} face encodings, {failed} could not be decrypted")
+
+@click.command('cluster-faces')
+@click.option('--batch-size', default=500, show_default=True, help='Detections to load per query')
+@click.option('--merge/--no-merge', default=True, show_default=True, help='Merge similar clusters afterwards')
+@with_appcontext
+def cluster_faces_command(batch_size, merge):
+    """Group detections that are not in a face cluster yet, then merge similar clusters"""
+    from .services.face_clustering import cluster_faces, merge_clusters
+
+    touched = cluster_faces(batch_size=batch_size)
+    merged = merge_clusters(set(touched)) if merge and touched else 0
+
+    logger.info(f"Clustered {len(touched)} faces into {len(set(touched))} clusters, merged {merged} clusters")
+    click.echo(f"Clustered {len(touched)} faces into {len(set(touched))} clusters, merged {merged} clusters")
+
+@click.command('build-embedding-index')
+@click.option('--nlist', type=int, help='Inverted lists (default about 4 * sqrt(faces))')
+@click.option('--m', default=32, show_default=True, help='PQ code bytes per face')
+@click.option('--sample', default=65536, show_default=True, help='Faces used to train the quantizers')
+@with_appcontext
+def build_embedding_index_command(nlist, m, sample):
+    """Compact the embedding store and (re)build its IVF-PQ index"""
+    from flask import current_app
+    from .services.face_clustering import loaded_gallery
+
+    if not current_app.config.get('EMBEDDING_STORE_DIR'):
+        raise click.UsageError('EMBEDDING_STORE_DIR is not set')
+    store = loaded_gallery()
+    try:
+        store.build_index(nlist=nlist, m=m, sample=sample)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    logger.info(f"Indexed {len(store)} faces, {store.memory_per_face():.0f} bytes per face in memory")
+    click.echo(f"Indexed {len(store)} faces, {store.memory_per_face():.0f} bytes per face in memory")
+
+@click.command('hash-photos')
+@click.option('--batch-size', default=500, show_default=True, help='Photos to hash per commit')
+@with_appcontext
+def hash_photos_command(batch_size):
+    """
+    Compute the perceptual hash of photos that have none (scanned or
+    older uploads) and group their near-duplicates. Running workers see
+    the new hashes after a restart.
+    """
+    from .models import Photo
+    from .services.perceptual_hash import file_hash, find_near_duplicate, loaded_hash_index, to_signed
+
+    index = loaded_hash_index()
+
+    hashed = 0
+    grouped = 0
+    last_id = 0
+    while True:
+        photos = Photo.query.filter(Photo.id > last_id, Photo.perceptual_hash.is_(None)) \
+            .order_by(Photo.id).limit(batch_size).all()
+        if not photos:
+            break
+        for photo in photos:
+            phash = file_hash(photo.filepath)
+            if phash is None:
+                continue
+            match = find_near_duplicate(phash)
+            photo.perceptual_hash = to_signed(phash)
+            if match and photo.duplicate_of is None:
+                photo.duplicate_of = match[0]
+                grouped += 1
+            hashed += 1
+            # Later photos can match this one
+            index.add(photo.id, phash)
+        db.session.commit()
+        last_id = photos[-1].id
+
+    logger.info(f"Hashed {hashed} photos, {grouped} grouped as near-duplicates")
+    click.echo(f"Hashed {hashed} photos, {grouped} grouped as near-duplicates")
+
+@click.command('clear-detection-cache')
+@with_appcontext
+def clear_detection_cache_command():
+    """Drop every cached detection result"""
+    from .services.detection_cache import get_detection_cache
+
+    cache = get_detection_cache()
+    if cache is None:
+        raise click.UsageError('The detection cache is disabled')
+    cache.clear()
+    logger.info('Detection cache cleared')
+    click.echo('Detection cache cleared')
+
+def register_commands(app):
+    """Register the maintenance CLI commands on the app"""
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_face_features_command)
+    app.cli.add_command(cluster_faces_command)
+    app.cli.add_command(build_embedding_index_command)
+    app.cli.add_command(hash_photos_command)
+    app.cli.add_command(clear_detection_cache_command)
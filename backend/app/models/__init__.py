@@ -34,8 +34,8 @@ class Contact(db.Model):
     birth_date = db.Column(db.Date)
     occupation = db.Column(db.String(100))
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     faces = db.relationship('Face', backref='contact', lazy=True)
 
 class Photo(db.Model):
@@ -44,4 +44,60 @@ class Photo(db.Model):
     filepath = db.Column(db.String(255), nullable=False)
     face_id = db.Column(db.Integer, db.ForeignKey('face.id'), index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    metadata = db.Column(db.JSON)
\ No newline at end of file
+    # 'metadata' is reserved on declarative models, so map the column under another attribute name
+    photo_metadata = db.Column('metadata', db.JSON)
+    # dHash of the image as a signed 64-bit integer, and the first photo of its near-duplicate group
+    perceptual_hash = db.Column(db.BigInteger)
+    duplicate_of = db.Column(db.Integer, db.ForeignKey('photo.id'), index=True)
+
+class FaceCluster(db.Model):
+    """Member count of an automatically clustered Face; Face.encoding holds the cluster mean"""
+    face_id = db.Column(db.Integer, db.ForeignKey('face.id'), primary_key=True)
+    size = db.Column(db.Integer, nullable=False, default=0)
+    # Workers catch up on clusters moved by others since their last look
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+class FaceEntryFeatures(db.Model):
+    """Encrypted features of a detected face and the Face cluster it was assigned to"""
+    entry_id = db.Column(db.Integer, db.ForeignKey('face_entry.id'), primary_key=True)
+    encoding = db.Column(db.Text, nullable=False)
+    face_id = db.Column(db.Integer, db.ForeignKey('face.id'), index=True)
+    similarity = db.Column(db.Float)
+
+class ScanManifest(db.Model):
+    """Size, mtime and content hash of every scanned file, used to skip unchanged photos on rescans"""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), nullable=False, unique=True, index=True)
+    directory = db.Column(db.String(1024), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    content_hash = db.Column(db.String(64), index=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'), index=True)
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DetectionJob(db.Model):
+    """Asynchronous face detection job for an uploaded photo"""
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    # host:pid of the process running the job; it refreshes updated_at while it runs
+    owner = db.Column(db.String(64))
+    filename = db.Column(db.String(255), nullable=False)
+    filepath = db.Column(db.String(255), nullable=False)
+    detector = db.Column(db.String(16))
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'detector': self.detector,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
@@ -1,12 +1,23 @@
-from flask import Blueprint, request, jsonify, send_file
+from flask import Blueprint, request, jsonify, send_file, current_app, url_for
+import io
 import os
+import re
+import hashlib
+import socket
+import time
+import uuid
 import logging
-from datetime import datetime
-from app.services.face_detection import detect_faces
+from datetime import datetime, timedelta
 from app.services.file_storage import SecureFileStorage
+from app.services.scan_engine import ScanEngine
+from app.services.job_queue import DetectionJobQueue, QueueFullError
 from app.services.error_handler import ErrorHandler, FileProcessingError, ValidationError, PermissionError
 from app.services.rate_limiter import rate_limit
-from app.models import FaceEntry, Face, Contact, Photo, db
+from app.services.database import BulkWriter
+from app.services.metrics import metrics, stage
+from app.models import FaceEntry, Face, FaceEntryFeatures, Contact, Photo, ScanManifest, DetectionJob, db
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
 logger = logging.getLogger(__name__)
@@ -16,7 +27,11 @@ UPLOAD_FOLDER = 'app/static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 # Initialize secure file storage
-file_storage = SecureFileStorage(UPLOAD_FOLDER, ALLOWED_EXTENSIONS)
+file_storage = SecureFileStorage(
+    UPLOAD_FOLDER,
+    ALLOWED_EXTENSIONS,
+    content_addressed=os.environ.get('STORAGE_CONTENT_ADDRESSED', '').lower() in ('1', 'true', 'yes')
+)
 
 def handle_errors(f):
     @wraps(f)
@@ -29,6 +44,171 @@ def handle_errors(f):
             return jsonify(response), status_code
     return decorated_function
 
+def store_detections(detections):
+    """
+    Add the FaceEntry and Photo rows for several detections, given as
+    (filename, filepath, detection_results), with one INSERT per table and
+    return their response payloads. The caller commits.
+    """
+    writer = BulkWriter(db.session)
+    faces = [(filepath, face) for _, filepath, results in detections for face in results['faces']]
+    face_entries = writer.insert(FaceEntry, [{
+        'image_path': filepath,
+        'face_location': face['location']
+    } for filepath, face in faces], returning=FaceEntry)
+    writer.insert(FaceEntryFeatures, [{
+        'entry_id': entry.id,
+        'encoding': face['features']
+    } for entry, (_, face) in zip(face_entries, faces)])
+    
+    detection_date = datetime.utcnow().isoformat()
+    photo_ids = writer.insert(Photo, [{
+        'filename': filename,
+        'filepath': filepath,
+        'perceptual_hash': _signed_hash(results.get('perceptual_hash')),
+        'duplicate_of': results.get('duplicate_of'),
+        'photo_metadata': {
+            'detection_date': detection_date,
+            'faces_detected': len(results['faces']),
+            'detector': results.get('detector')
+        }
+    } for filename, filepath, results in detections], returning=Photo.id)
+    
+    # Include the stored face IDs and photo ID in each response
+    entries = iter(face_entries)
+    for (_, _, results), photo_id in zip(detections, photo_ids):
+        results['stored_faces'] = [next(entries).to_dict() for _ in results['faces']]
+        results['photo_id'] = photo_id
+    return [results for _, _, results in detections]
+
+def store_detection(filename, filepath, detection_results):
+    """
+    Add the FaceEntry and Photo rows for one detection to the session and
+    return the response payload. The caller commits.
+    """
+    return store_detections([(filename, filepath, detection_results)])[0]
+
+# The CV, clustering and rendition services pull in OpenCV, numpy and PIL;
+# they are imported inside the functions that need them so a worker that
+# only serves contacts or metadata never loads them.
+
+def _signed_hash(hex_hash):
+    if not hex_hash:
+        return None
+    from app.services.perceptual_hash import to_signed
+    return to_signed(int(hex_hash, 16))
+
+def photo_fingerprint(data):
+    """
+    (perceptual hash, near-duplicate match or None) of an image buffer;
+    (None, None) when NEAR_DUPLICATE_DETECTION is off or it cannot be decoded
+    """
+    if not current_app.config.get('NEAR_DUPLICATE_DETECTION', True):
+        return None, None
+    from app.services.perceptual_hash import find_near_duplicate, image_hash
+    
+    with stage('phash.compute'):
+        phash = image_hash(data)
+    with stage('phash.lookup'):
+        return phash, find_near_duplicate(phash)
+
+def _image_size(source):
+    """(width, height) as displayed, after EXIF orientation, like the face boxes OpenCV reports"""
+    from PIL import Image
+    
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            # Orientations 5-8 turn the image by 90 degrees
+            if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                return height, width
+            return width, height
+    except Exception:
+        return None
+
+def reused_detection(match, image):
+    """
+    Detection results for a near-duplicate upload (a path or file object),
+    copied from the photo it matched and scaled to the upload's size, or
+    None when that photo has no complete set of stored faces to copy (it
+    was scanned, say)
+    """
+    if match is None or not current_app.config.get('NEAR_DUPLICATE_REUSE', True):
+        return None
+    source = db.session.query(Photo.filepath, Photo.photo_metadata).filter_by(id=match[1]).first()
+    if source is None:
+        # Deleted after the lookup
+        return None
+    rows = db.session.query(FaceEntry.face_location, FaceEntryFeatures.encoding) \
+        .join(FaceEntryFeatures, FaceEntryFeatures.entry_id == FaceEntry.id) \
+        .filter(FaceEntry.image_path == source.filepath).order_by(FaceEntry.id).all()
+    if len(rows) != (source.photo_metadata or {}).get('faces_detected'):
+        return None
+    size, source_size = _image_size(image), _image_size(source.filepath)
+    if size is None or source_size is None:
+        return None
+    scale_x, scale_y = size[0] / source_size[0], size[1] / source_size[1]
+    faces = [{
+        'location': {side: int(round(location.get(side, 0) * (scale_x if side in ('left', 'right') else scale_y)))
+                     for side in ('top', 'right', 'bottom', 'left')},
+        'features': encoding
+    } for location, encoding in rows]
+    return {'num_faces': len(faces), 'faces': faces}
+
+def with_fingerprint(detection_results, phash, match, reused=False):
+    """Add the perceptual hash and near-duplicate group to detection results"""
+    if phash is not None:
+        detection_results['perceptual_hash'] = f"{phash:016x}"
+    detection_results['duplicate_of'] = match[0] if match else None
+    if reused:
+        detection_results['near_duplicate'] = {'photo_id': match[1], 'distance': match[2]}
+    return detection_results
+
+def previous_detection(filepath):
+    """
+    Detection results already stored for a content-addressed file, or None.
+    Faces carry their stored features and cluster like a fresh detection.
+    """
+    photo = Photo.query.filter_by(filepath=filepath).order_by(Photo.id.desc()).first()
+    if photo is None:
+        return None
+    rows = db.session.query(FaceEntry, FaceEntryFeatures.encoding, FaceEntryFeatures.face_id) \
+        .outerjoin(FaceEntryFeatures, FaceEntryFeatures.entry_id == FaceEntry.id) \
+        .filter(FaceEntry.image_path == filepath).order_by(FaceEntry.id).all()
+    return {
+        'num_faces': len(rows),
+        'faces': [{'location': entry.face_location, 'features': encoding, 'face_id': face_id}
+                  for entry, encoding, face_id in rows],
+        'stored_faces': [entry.to_dict() for entry, _, _ in rows],
+        'photo_id': photo.id,
+        'duplicate': True
+    }
+
+def wants_async():
+    """Whether the client asked for (or the deployment defaults to) asynchronous detection"""
+    value = request.args.get('async')
+    if value is not None:
+        return value.lower() in ('1', 'true', 'yes')
+    if 'respond-async' in request.headers.get('Prefer', ''):
+        return True
+    return current_app.config.get('DETECTION_ASYNC', False)
+
+def requested_detector(name):
+    """The detector backend a request asked for by name, or the deployment default"""
+    from app.services.face_detection import get_detector
+    
+    try:
+        return get_detector(name or None)
+    except ValueError as e:
+        raise ValidationError(str(e), 'detector')
+
+@face_recognition_bp.route('/api/detectors', methods=['GET'])
+@handle_errors
+def list_detectors():
+    from app.services.face_detection import available_detectors, default_detector_name
+    
+    return jsonify({'default': default_detector_name(), 'detectors': available_detectors()})
+
 @face_recognition_bp.route('/api/detect-face', methods=['POST'])
 @handle_errors
 @rate_limit(calls=50, period=60)  # 50 calls per minute
@@ -39,52 +219,315 @@ def detect_face():
     file = request.files['file']
     if file.filename == '':
         raise ValidationError('No file selected', 'file')
+    detector = requested_detector(request.values.get('detector'))
     
-    logger.info(f"Processing face detection for file: {file.filename}")
+    logger.info("Processing face detection for file: %s", file.filename, extra={'sample_key': 'detect_face.request'})
+    
+    # Read the upload once; hashing, sniffing and decoding all use this buffer
+    upload = file_storage.read_upload(file)
+    if not upload.image_type:
+        raise FileProcessingError('Invalid file format', file.filename)
     
     # Save file securely
-    filename, filepath = file_storage.save_file(file, file.filename)
-    if not filename:
+    stored = file_storage.store_bytes(upload.data, file.filename, upload.content_hash, upload.image_type)
+    if not stored:
         raise FileProcessingError('Invalid file format', file.filename)
+    filename, filepath = stored.filename, stored.filepath
+    
+    if stored.duplicate:
+        previous = previous_detection(filepath)
+        if previous is not None:
+            # The stored copy already has its rows; drop the extra reference
+            file_storage.delete_file(filename)
+            logger.info(f"Reusing detection results for duplicate upload {filename}")
+            return jsonify(previous)
+    
+    # Near-duplicates (burst shots, edited copies) reuse the faces already found
+    phash, match = photo_fingerprint(upload.data)
+    reused = reused_detection(match, io.BytesIO(upload.data))
+    
+    if reused is None and wants_async():
+        return enqueue_detection(filename, filepath, detector.name)
     
     try:
-        # Process the image for face detection
-        detection_results = detect_faces(filepath)
-        logger.info(f"Detected {len(detection_results['faces'])} faces in {filename}")
+        if reused is not None:
+            detection_results = reused
+            logger.info("Reusing the faces of near-duplicate photo %d for %s", match[1], filename,
+                        extra={'sample_key': 'detect_face.reused'})
+        else:
+            # Process the image for face detection
+            with stage('detect_face.detect'):
+                detection_results = detector.detect_bytes(upload.data, upload.content_hash)
+            logger.info("Detected %d faces in %s", len(detection_results['faces']), filename,
+                        extra={'sample_key': 'detect_face.result'})
+        with_fingerprint(detection_results, phash, match, reused=reused is not None)
         
-        # Store each detected face in the database
-        stored_faces = []
-        for face in detection_results['faces']:
-            face_entry = FaceEntry(
-                image_path=filepath,
-                face_location=face['location']
-            )
-            db.session.add(face_entry)
-            stored_faces.append(face_entry.to_dict())
-        
-        # Create a photo entry
-        photo = Photo(
-            filename=filename,
-            filepath=filepath,
-            metadata={
-                'detection_date': datetime.utcnow().isoformat(),
-                'faces_detected': len(detection_results['faces'])
-            }
-        )
-        db.session.add(photo)
-        db.session.commit()
-        
-        # Include the stored face IDs and photo ID in the response
-        detection_results['stored_faces'] = stored_faces
-        detection_results['photo_id'] = photo.id
-        
-        return jsonify(detection_results)
+        with stage('detect_face.db_write'):
+            detection_results = store_detection(filename, filepath, detection_results)
+            db.session.commit()
     except Exception as e:
         logger.error(f"Error processing {filename}: {str(e)}")
         db.session.rollback()
         if os.path.exists(filepath):
             file_storage.delete_file(filename)
         raise
+    
+    with stage('detect_face.cluster'):
+        from app.services.face_clustering import cluster_detection
+        clusters = cluster_detection([entry['id'] for entry in detection_results['stored_faces']])
+    for face, entry in zip(detection_results['faces'], detection_results['stored_faces']):
+        face['face_id'] = clusters.get(entry['id'])
+    return jsonify(detection_results)
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def batch_pool():
+    """
+    The process-wide pool that runs detection for batch uploads. It is
+    shared by all requests, so concurrent batches queue for
+    BATCH_DETECT_WORKERS threads instead of each starting their own.
+    """
+    global _batch_pool
+    if _batch_pool is None:
+        with _batch_pool_lock:
+            if _batch_pool is None:
+                _batch_pool = ThreadPoolExecutor(max_workers=current_app.config.get('BATCH_DETECT_WORKERS', 2),
+                                                 thread_name_prefix='batch-detect')
+    return _batch_pool
+
+def _save_batch_file(file):
+    """Stream one upload to storage; returns (StoredFile, previous detection or None)"""
+    if not file.filename:
+        raise ValidationError('No file selected', 'files')
+    image_type = file_storage.sniff_upload(file)
+    if not image_type:
+        raise FileProcessingError('Invalid file format', file.filename)
+    stored = file_storage.store(file, file.filename, image_type)
+    if not stored:
+        raise FileProcessingError('Invalid file format', file.filename)
+    previous = previous_detection(stored.filepath) if stored.duplicate else None
+    if previous is not None:
+        # The stored copy already has its rows; drop the extra reference
+        file_storage.delete_file(stored.filename)
+    return stored, previous
+
+@face_recognition_bp.route('/api/detect-faces/batch', methods=['POST'])
+@handle_errors
+@rate_limit(calls=20, period=60)
+def detect_faces_batch():
+    """
+    Detect faces in every file of a multipart upload (field ``files``).
+    Files are streamed to storage, detected on the shared batch pool and
+    written in one transaction; each file gets its own result or error.
+    """
+    # A batch may be much larger than a single upload
+    request.max_content_length = current_app.config.get('BATCH_MAX_CONTENT_LENGTH', 256 * 1024 * 1024)
+    files = request.files.getlist('files')
+    if not files:
+        raise ValidationError('No files provided', 'files')
+    max_files = current_app.config.get('BATCH_MAX_FILES', 50)
+    if len(files) > max_files:
+        raise ValidationError(f'At most {max_files} files per batch', 'files')
+    detector = requested_detector(request.values.get('detector'))
+    
+    results = [None] * len(files)
+    pending = []
+    with stage('detect_batch.store'):
+        for i, file in enumerate(files):
+            try:
+                stored, previous = _save_batch_file(file)
+            except Exception as e:
+                results[i] = {'filename': file.filename, 'error': str(e)}
+                continue
+            if previous is not None:
+                results[i] = {'filename': file.filename, **previous}
+            else:
+                pending.append((i, stored))
+    
+    # Hash on the pool too; near-duplicates of stored photos reuse their faces
+    fingerprints = {}
+    if current_app.config.get('NEAR_DUPLICATE_DETECTION', True):
+        from app.services.perceptual_hash import file_hash, find_near_duplicate
+        
+        with stage('detect_batch.phash'):
+            hashes = [batch_pool().submit(file_hash, stored.filepath) for _, stored in pending]
+            for (i, _), future in zip(pending, hashes):
+                phash = future.result()
+                fingerprints[i] = (phash, find_near_duplicate(phash))
+    
+    detected = []
+    futures = []
+    for i, stored in pending:
+        phash, match = fingerprints.get(i, (None, None))
+        reused = reused_detection(match, stored.filepath)
+        if reused is not None:
+            detected.append((i, stored, with_fingerprint(reused, phash, match, reused=True)))
+        else:
+            future = batch_pool().submit(detector.detect_path, stored.filepath, stored.content_hash)
+            futures.append((i, stored, phash, match, future))
+    with stage('detect_batch.detect'):
+        for i, stored, phash, match, future in futures:
+            try:
+                detected.append((i, stored, with_fingerprint(future.result(), phash, match)))
+            except Exception as e:
+                logger.error(f"Error processing {stored.filename}: {str(e)}")
+                results[i] = {'filename': files[i].filename, 'error': str(e)}
+                file_storage.delete_file(stored.filename)
+    detected.sort(key=lambda item: item[0])
+    
+    def write_rows(items):
+        for (i, _, _), stored_results in zip(items, store_detections(
+                [(stored.filename, stored.filepath, detection) for _, stored, detection in items])):
+            results[i] = {'filename': files[i].filename, **stored_results}
+    
+    # One transaction for the whole batch; if it fails, files are retried one by one
+    with stage('detect_batch.db_write'):
+        _, failed = BulkWriter(db.session, chunk_size=max(1, len(detected))).write(detected, write_rows)
+    for (i, stored, _), error in failed:
+        results[i] = {'filename': files[i].filename, 'error': error}
+        file_storage.delete_file(stored.filename)
+    
+    stored_results = [results[i] for i, _, _ in detected if 'error' not in results[i]]
+    with stage('detect_batch.cluster'):
+        from app.services.face_clustering import cluster_detection
+        clusters = cluster_detection([entry['id'] for result in stored_results for entry in result['stored_faces']])
+    for result in stored_results:
+        for face, entry in zip(result['faces'], result['stored_faces']):
+            face['face_id'] = clusters.get(entry['id'])
+    
+    errors = sum(1 for result in results if 'error' in result)
+    logger.info(f"Batch detection finished: {len(files)} files, {errors} errors")
+    return jsonify({
+        'results': results,
+        'total_processed': len(files) - errors,
+        'total_errors': errors
+    })
+
+def enqueue_detection(filename, filepath, detector=None):
+    """Create a job for a saved upload and answer 202 with its status URL"""
+    job = DetectionJob(id=uuid.uuid4().hex, filename=filename, filepath=filepath, detector=detector)
+    db.session.add(job)
+    db.session.commit()
+    
+    try:
+        job_queue.submit(job.id)
+    except QueueFullError as e:
+        db.session.delete(job)
+        db.session.commit()
+        file_storage.delete_file(filename)
+        logger.warning(str(e))
+        return jsonify({
+            'error': 'Service Unavailable',
+            'message': 'Too many detection jobs are pending, please retry later'
+        }), 503, {'Retry-After': '5'}
+    
+    status_url = url_for('face_recognition.get_job', job_id=job.id)
+    return jsonify({**job.to_dict(), 'status_url': status_url}), 202, {'Location': status_url}
+
+def job_owner():
+    """Identifies this process on the jobs it claims"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def run_detection_job(job_id):
+    """Claim a queued job and run detection for it; executed on the job pool"""
+    owner = job_owner()
+    claimed = DetectionJob.query.filter_by(id=job_id, status='queued').update({
+        'status': 'running',
+        'owner': owner,
+        'attempts': DetectionJob.attempts + 1,
+        'updated_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return
+    
+    from app.services.face_detection import get_detector
+    
+    job = DetectionJob.query.get(job_id)
+    try:
+        with open(job.filepath, 'rb') as f:
+            data = f.read()
+        detection_results = with_fingerprint(get_detector(job.detector).detect_bytes(data),
+                                             *photo_fingerprint(data))
+        logger.info(f"Detected {len(detection_results['faces'])} faces in {job.filename}")
+        result = store_detection(job.filename, job.filepath, detection_results)
+        # Only the owner may finish the job, in the same transaction as its rows
+        finished = DetectionJob.query.filter_by(id=job_id, status='running', owner=owner).update({
+            'status': 'done',
+            'result': result,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        if not finished:
+            db.session.rollback()
+            logger.warning(f"Detection job {job_id} was taken over by another process; dropping this result")
+            return
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Error processing job {job_id} ({job.filename}): {str(e)}")
+        db.session.rollback()
+        failed = DetectionJob.query.filter_by(id=job_id, status='running', owner=owner).update({
+            'status': 'failed',
+            'error': str(e),
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        if failed and os.path.exists(job.filepath):
+            file_storage.delete_file(job.filename)
+    else:
+        from app.services.face_clustering import cluster_detection
+        cluster_detection([entry['id'] for entry in result['stored_faces']])
+
+def touch_detection_jobs(job_ids):
+    """Heartbeat for the jobs this process is running, so no other process requeues them"""
+    DetectionJob.query.filter(
+        DetectionJob.id.in_(job_ids),
+        DetectionJob.status == 'running',
+        DetectionJob.owner == job_owner()
+    ).update({'updated_at': datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+
+job_queue = DetectionJobQueue(run_detection_job, heartbeat=touch_detection_jobs)
+
+def recover_detection_jobs(app):
+    """
+    Requeue jobs left behind by a crashed process: queued jobs, and running
+    jobs whose owner has not sent a heartbeat for DETECTION_JOB_STALE_SECONDS.
+    Live processes heartbeat their running jobs, so this is safe to run in
+    every worker; a queued job is only ever claimed by one of them.
+    """
+    job_queue.init_app(app)
+    stale_before = datetime.utcnow() - timedelta(seconds=app.config.get('DETECTION_JOB_STALE_SECONDS', 600))
+    DetectionJob.query.filter(
+        DetectionJob.status == 'running',
+        DetectionJob.updated_at < stale_before
+    ).update({'status': 'queued', 'owner': None}, synchronize_session=False)
+    db.session.commit()
+    
+    job_ids = [job_id for (job_id,) in db.session.query(DetectionJob.id)
+               .filter_by(status='queued').order_by(DetectionJob.created_at)]
+    for job_id in job_ids:
+        job_queue.submit(job_id, force=True)
+    if job_ids:
+        logger.info(f"Recovered {len(job_ids)} detection jobs")
+
+@face_recognition_bp.route('/api/jobs/<job_id>', methods=['GET'])
+@handle_errors
+def get_job(job_id):
+    job = DetectionJob.query.get_or_404(job_id)
+    
+    # Long-poll: ?wait=<seconds> blocks until the job finishes or the wait expires
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 30)
+    deadline = time.monotonic() + wait
+    while job.status in ('queued', 'running'):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not job_queue.wait(job_id, min(remaining, 0.5)):
+            time.sleep(min(remaining, 0.5))
+        db.session.refresh(job)
+    
+    return jsonify(job.to_dict())
 
 @face_recognition_bp.route('/api/photos/scan', methods=['POST'])
 @handle_errors
@@ -92,6 +535,7 @@ def detect_face():
 def scan_photos():
     data = request.json
     directory = data.get('directory', UPLOAD_FOLDER)
+    detector = requested_detector(data.get('detector'))
     
     if not os.path.exists(directory):
         raise ValidationError('Directory does not exist', 'directory')
@@ -99,50 +543,102 @@ def scan_photos():
     if not os.access(directory, os.R_OK):
         raise PermissionError('No read access to directory', directory)
     
+    directory = os.path.abspath(directory)
     logger.info(f"Starting batch scan of directory: {directory}")
-    results = []
-    errors = []
+    engine = ScanEngine(
+        ALLOWED_EXTENSIONS,
+        max_workers=current_app.config.get('SCAN_WORKERS'),
+        chunk_size=current_app.config.get('SCAN_CHUNK_SIZE', 200),
+        detector=detector.name
+    )
     
-    for filename in os.listdir(directory):
-        if any(filename.lower().endswith(ext) for ext in ALLOWED_EXTENSIONS):
-            filepath = os.path.join(directory, filename)
-            try:
-                # Process image for face detection
-                detection_result = detect_faces(filepath)
-                logger.info(f"Processed {filename}: found {len(detection_result['faces'])} faces")
-                
-                # Create Photo entry
-                photo = Photo(
-                    filename=filename,
-                    filepath=filepath,
-                    metadata={
-                        'scan_date': datetime.utcnow().isoformat(),
-                        'faces_detected': len(detection_result['faces'])
-                    }
-                )
-                db.session.add(photo)
-                
-                results.append({
-                    'filename': filename,
-                    'faces_detected': len(detection_result['faces'])
-                })
-            except Exception as e:
-                logger.error(f"Error processing {filename}: {str(e)}")
-                errors.append({
-                    'filename': filename,
-                    'error': str(e)
-                })
-                continue
+    # Compare the directory against what the previous scan saw
+    entries = {m.path: m for m in db.session.query(
+        ScanManifest.id, ScanManifest.path, ScanManifest.size, ScanManifest.mtime_ns,
+        ScanManifest.content_hash, ScanManifest.photo_id
+    ).filter(ScanManifest.directory == directory)}
+    plan = engine.plan(directory, {
+        path: (m.size, m.mtime_ns, m.content_hash) for path, m in entries.items()
+    })
     
-    if results:
+    if plan.removed:
+        removed_photo_ids = [entries[path].photo_id for path in plan.removed if entries[path].photo_id]
+        ScanManifest.query.filter(ScanManifest.path.in_(plan.removed)).delete(synchronize_session=False)
+        if removed_photo_ids:
+            Photo.query.filter(Photo.id.in_(removed_photo_ids)).delete(synchronize_session=False)
         db.session.commit()
-        logger.info(f"Batch scan completed. Processed {len(results)} files, {len(errors)} errors")
+    
+    counts = {'added': 0, 'changed': 0, 'unchanged': len(plan.unchanged), 'removed': len(plan.removed)}
+    writer = BulkWriter(db.session, current_app.config.get('BULK_WRITE_CHUNK_SIZE', 500))
+    
+    def classify(chunk):
+        """Label each result unchanged, changed (its Photo still exists) or added"""
+        photo_ids = [entries[r['filepath']].photo_id for r in chunk
+                     if r['filepath'] in entries and entries[r['filepath']].photo_id]
+        existing = {photo_id for photo_id, in db.session.query(Photo.id).filter(Photo.id.in_(photo_ids))} \
+            if photo_ids else set()
+        for result in chunk:
+            entry = entries.get(result['filepath'])
+            if result.get('unchanged'):
+                yield 'unchanged', result
+            elif entry is not None and entry.photo_id in existing:
+                yield 'changed', result
+            else:
+                yield 'added', result
+    
+    def write_rows(items):
+        scan_date = datetime.utcnow()
+        added = [result for kind, result in items if kind == 'added']
+        photo_ids = writer.insert(Photo, [{
+            'filename': result['filename'],
+            'filepath': result['filepath'],
+            'photo_metadata': {'scan_date': scan_date.isoformat(), 'faces_detected': result['faces_detected'],
+                               'detector': detector.name}
+        } for result in added], returning=Photo.id)
+        new_photo_ids = {result['filepath']: photo_id for result, photo_id in zip(added, photo_ids)}
+        
+        writer.update(Photo, [{
+            'id': entries[result['filepath']].photo_id,
+            'photo_metadata': {'scan_date': scan_date.isoformat(), 'faces_detected': result['faces_detected'],
+                               'detector': detector.name}
+        } for kind, result in items if kind == 'changed'])
+        
+        manifest_inserts, manifest_updates = [], []
+        for kind, result in items:
+            size, mtime_ns = plan.stats[result['filepath']]
+            row = {'size': size, 'mtime_ns': mtime_ns, 'content_hash': result['content_hash'],
+                   'scanned_at': scan_date}
+            if result['filepath'] in new_photo_ids:
+                row['photo_id'] = new_photo_ids[result['filepath']]
+            entry = entries.get(result['filepath'])
+            if entry is None:
+                manifest_inserts.append({'path': result['filepath'], 'directory': directory, **row})
+            else:
+                manifest_updates.append({'id': entry.id, **row})
+        writer.insert(ScanManifest, manifest_inserts)
+        writer.update(ScanManifest, manifest_updates)
+    
+    def store_chunk(chunk):
+        written, failed = writer.write(list(classify(chunk)), write_rows)
+        for kind, _ in written:
+            counts[kind] += 1
+        return [(result, error) for (_, result), error in failed]
+    
+    scan = engine.scan(plan.candidates, store_chunk, known_hashes=plan.candidates)
+    results = [{
+        'filename': r['filename'],
+        'faces_detected': r['faces_detected']
+    } for r in scan['results'] if not r.get('unchanged')]
+    errors = scan['errors']
+    logger.info(f"Batch scan completed. Processed {len(results)} files, {len(errors)} errors, "
+                f"{counts['unchanged']} unchanged, {counts['removed']} removed")
     
     return jsonify({
         'results': results,
         'errors': errors,
         'total_processed': len(results),
-        'total_errors': len(errors)
+        'total_errors': len(errors),
+        **counts
     })
 
 @face_recognition_bp.route('/api/photos/<int:photo_id>/link-face', methods=['POST'])
@@ -161,44 +657,233 @@ def link_photo_to_face(photo_id):
     
     return jsonify({'message': 'Photo linked to face successfully'})
 
+GROUP_ID_PATTERN = re.compile(r'^(contact|face)_(\d+)$')
+
+def _group_columns():
+    """Group kind and id: photos of faces linked to a contact are grouped by contact"""
+    kind = db.case((Contact.id.isnot(None), 'contact'), else_='face')
+    group_id = db.func.coalesce(Contact.id, Face.id)
+    return kind, group_id
+
+def _parse_group_id(value, field):
+    match = GROUP_ID_PATTERN.match(value or '')
+    if not match:
+        raise ValidationError('Invalid group id', field)
+    return match.group(1), int(match.group(2))
+
+def _group_face_ids(groups):
+    """
+    Map the face ids belonging to the given (kind, id) groups to their group key.
+    Photo lookups then filter on the indexed photo.face_id column.
+    """
+    contact_ids = [gid for kind, gid in groups if kind == 'contact']
+    face_ids = [gid for kind, gid in groups if kind == 'face']
+    rows = db.session.query(Face.id, Face.contact_id, Contact.id) \
+        .outerjoin(Contact, Face.contact_id == Contact.id) \
+        .filter(db.or_(
+            Contact.id.in_(contact_ids),
+            db.and_(Face.id.in_(face_ids), Contact.id.is_(None))
+        ))
+    return {face_id: (f"contact_{contact_id}" if contact_id else f"face_{face_id}")
+            for face_id, _, contact_id in rows}
+
+def _photo_dict(photo_id, filename, photo_metadata):
+    return {
+        'id': photo_id,
+        'filename': filename,
+        'metadata': photo_metadata
+    }
+
+def _bounded_arg(name, default, maximum):
+    value = request.args.get(name, default, type=int)
+    if value is None or not 1 <= value <= maximum:
+        raise ValidationError(f'{name} must be between 1 and {maximum}', name)
+    return value
+
 @face_recognition_bp.route('/api/photos/organize', methods=['GET'])
 @handle_errors
 def get_organized_photos():
-    # Get all photos with their associated faces and contacts
-    photos = Photo.query.all()
-    organized = {}
-    
-    for photo in photos:
-        if photo.face_id:
-            face = Face.query.get(photo.face_id)
-            if face:
-                key = f"face_{face.id}"
-                name = f"Unknown Person {face.id}"
-                
-                if face.contact_id:
-                    contact = Contact.query.get(face.contact_id)
-                    if contact:
-                        key = f"contact_{contact.id}"
-                        name = contact.name
-                
-                if key not in organized:
-                    organized[key] = {
-                        'id': key,
-                        'name': name,
-                        'photos': []
-                    }
-                
-                organized[key]['photos'].append({
-                    'id': photo.id,
-                    'filename': photo.filename,
-                    'metadata': photo.metadata
-                })
-    
-    return jsonify({'groups': list(organized.values())})
+    """
+    Photos grouped by contact (or by face when no contact is linked).
+    Groups are paginated with ?cursor=&limit=; each group carries its first
+    photos_limit photos and a photos_cursor for /api/photos/organize/<group>.
+    ?summary=1 returns only counts and a cover photo per group.
+    """
+    limit = _bounded_arg('limit', 50, 200)
+    photos_limit = _bounded_arg('photos_limit', 20, 500)
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+    kind, group_id = _group_columns()
+    
+    # Count photos per face using the photo.face_id index, then fold faces into groups
+    face_stats = db.session.query(
+        Photo.face_id.label('face_id'),
+        db.func.count(Photo.id).label('photo_count'),
+        db.func.max(Photo.id).label('cover_id')
+    ).filter(Photo.face_id.isnot(None)).group_by(Photo.face_id).subquery()
+    query = db.session.query(
+        kind.label('kind'),
+        group_id.label('group_id'),
+        db.func.max(Contact.name).label('contact_name'),
+        db.func.sum(face_stats.c.photo_count).label('photo_count'),
+        db.func.max(face_stats.c.cover_id).label('cover_id')
+    ).select_from(face_stats) \
+        .join(Face, face_stats.c.face_id == Face.id) \
+        .outerjoin(Contact, Face.contact_id == Contact.id) \
+        .group_by(kind, group_id).order_by(kind, group_id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        cursor_kind, cursor_id = _parse_group_id(cursor, 'cursor')
+        query = query.filter(db.or_(kind > cursor_kind, db.and_(kind == cursor_kind, group_id > cursor_id)))
+    rows = query.limit(limit + 1).all()
+    next_cursor = f"{rows[limit - 1].kind}_{rows[limit - 1].group_id}" if len(rows) > limit else None
+    rows = rows[:limit]
+    
+    covers = {p.id: p for p in db.session.query(Photo.id, Photo.filename)
+              .filter(Photo.id.in_([row.cover_id for row in rows]))}
+    groups = []
+    for row in rows:
+        cover = covers.get(row.cover_id)
+        groups.append({
+            'id': f"{row.kind}_{row.group_id}",
+            'name': row.contact_name if row.kind == 'contact' else f"Unknown Person {row.group_id}",
+            'photo_count': int(row.photo_count),
+            'cover_photo': {'id': cover.id, 'filename': cover.filename} if cover else None
+        })
+    
+    if not summary and rows:
+        # First photos_limit photos of every face on the page, in one windowed query;
+        # a group's first photos are always among the first photos of its faces
+        face_groups = _group_face_ids([(row.kind, row.group_id) for row in rows])
+        row_number = db.func.row_number().over(partition_by=Photo.face_id, order_by=Photo.id)
+        ranked = db.session.query(
+            Photo.face_id.label('face_id'),
+            Photo.id.label('id'),
+            row_number.label('position')
+        ).filter(Photo.face_id.in_(list(face_groups))).subquery()
+        group_photo_ids = {group['id']: [] for group in groups}
+        for face_id, photo_id in db.session.query(ranked.c.face_id, ranked.c.id) \
+                .filter(ranked.c.position <= photos_limit).order_by(ranked.c.id):
+            photo_ids = group_photo_ids[face_groups[face_id]]
+            if len(photo_ids) < photos_limit:
+                photo_ids.append(photo_id)
+        
+        # Load the selected photos only
+        wanted = [photo_id for photo_ids in group_photo_ids.values() for photo_id in photo_ids]
+        details = {photo.id: photo for photo in db.session.query(Photo.id, Photo.filename, Photo.photo_metadata)
+                   .filter(Photo.id.in_(wanted))}
+        for group in groups:
+            group['photos'] = [_photo_dict(*details[photo_id]) for photo_id in group_photo_ids[group['id']]]
+            group['photos_cursor'] = None
+        for group in groups:
+            if group['photo_count'] > len(group['photos']):
+                group['photos_cursor'] = group['photos'][-1]['id']
+    
+    return jsonify({'groups': groups, 'next_cursor': next_cursor})
+
+@face_recognition_bp.route('/api/photos/organize/<group>', methods=['GET'])
+@handle_errors
+def get_group_photos(group):
+    """Photos of one group, paginated with ?cursor=<last photo id>&limit="""
+    limit = _bounded_arg('limit', 50, 500)
+    cursor = request.args.get('cursor', type=int)
+    group_kind, gid = _parse_group_id(group, 'group')
+    face_ids = list(_group_face_ids([(group_kind, gid)]))
+    
+    query = db.session.query(Photo.id, Photo.filename, Photo.photo_metadata) \
+        .filter(Photo.face_id.in_(face_ids))
+    if cursor:
+        query = query.filter(Photo.id > cursor)
+    photos = query.order_by(Photo.id).limit(limit + 1).all()
+    next_cursor = photos[limit - 1].id if len(photos) > limit else None
+    
+    return jsonify({
+        'id': group,
+        'photos': [_photo_dict(*photo) for photo in photos[:limit]],
+        'next_cursor': next_cursor
+    })
+
+@face_recognition_bp.route('/api/photos/duplicates', methods=['GET'])
+@handle_errors
+def get_duplicate_photos():
+    """
+    Near-duplicate groups: each group is the first photo of a burst or set
+    of edited copies and the photos found to be within
+    NEAR_DUPLICATE_DISTANCE bits of it. Paginated with ?cursor=&limit=.
+    """
+    limit = _bounded_arg('limit', 50, 200)
+    query = db.session.query(Photo.duplicate_of, db.func.count(Photo.id)) \
+        .filter(Photo.duplicate_of.isnot(None)).group_by(Photo.duplicate_of).order_by(Photo.duplicate_of)
+    cursor = request.args.get('cursor', type=int)
+    if cursor is not None:
+        query = query.filter(Photo.duplicate_of > cursor)
+    rows = query.limit(limit + 1).all()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    rows = rows[:limit]
+    
+    group_ids = [group_id for group_id, _ in rows]
+    details = {photo.id: photo for photo in db.session.query(
+        Photo.id, Photo.filename, Photo.photo_metadata, Photo.duplicate_of
+    ).filter(db.or_(Photo.id.in_(group_ids), Photo.duplicate_of.in_(group_ids))).order_by(Photo.id)}
+    members = {group_id: [] for group_id in group_ids}
+    for photo in details.values():
+        if photo.duplicate_of in members:
+            members[photo.duplicate_of].append(_photo_dict(photo.id, photo.filename, photo.photo_metadata))
+    groups = [{
+        'id': group_id,
+        'photo': _photo_dict(*details[group_id][:3]) if group_id in details else None,
+        'duplicate_count': count,
+        'duplicates': members[group_id]
+    } for group_id, count in rows]
+    return jsonify({'groups': groups, 'next_cursor': next_cursor})
+
+RENDITION_MAX_AGE = 365 * 24 * 3600
+
+_rendition_cache = None
+
+def get_rendition_cache():
+    """Return the rendition cache configured for the current app"""
+    from app.services.renditions import RenditionCache
+    global _rendition_cache
+    if _rendition_cache is None:
+        _rendition_cache = RenditionCache(
+            current_app.config.get('RENDITION_CACHE_DIR') or os.path.join(current_app.instance_path, 'renditions'),
+            max_bytes=current_app.config.get('RENDITION_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+        )
+    return _rendition_cache
+
+def _requested_size():
+    from app.services.renditions import RenditionCache
+    
+    size = request.args.get('size', type=int)
+    if size is not None and size not in RenditionCache.SIZES:
+        raise ValidationError(f'size must be one of {list(RenditionCache.SIZES)}', 'size')
+    return size
+
+def send_rendition(path, key, last_modified):
+    """Send a cached rendition with long-lived caching and conditional GET support"""
+    response = send_file(path, mimetype='image/jpeg', etag=key, last_modified=last_modified,
+                         max_age=RENDITION_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def not_modified(key, last_modified):
+    """Return a 304 response if the client already has this rendition"""
+    if key in request.if_none_match or (
+        not request.if_none_match and request.if_modified_since
+        and int(last_modified) <= request.if_modified_since.timestamp()
+    ):
+        response = current_app.response_class(status=304)
+        response.set_etag(key)
+        response.cache_control.max_age = RENDITION_MAX_AGE
+        response.cache_control.public = True
+        return response
+    return None
 
 @face_recognition_bp.route('/api/photos/<filename>', methods=['GET'])
 @handle_errors
 def get_photo(filename):
+    size = _requested_size()
     filepath = file_storage.get_file_path(filename)
     if not filepath:
         raise FileProcessingError('Photo not found', filename)
@@ -206,26 +891,156 @@ def get_photo(filename):
     if not os.path.exists(filepath):
         raise FileProcessingError('Photo file missing', filename)
     
+    filepath = os.path.abspath(filepath)
     try:
-        return send_file(filepath)
+        if size is None:
+            # The original can be replaced in place; clients revalidate it with its ETag on every use
+            response = send_file(filepath, conditional=True, etag=True, max_age=0)
+            response.cache_control.no_cache = True
+            response.cache_control.public = None
+            return response
+        
+        cache = get_rendition_cache()
+        key = cache.rendition_key(filepath, 'thumb', size)
+        last_modified = os.path.getmtime(filepath)
+        cached = not_modified(key, last_modified)
+        if cached is not None:
+            return cached
+        path, key = cache.thumbnail(filepath, size)
+        return send_rendition(path, key, last_modified)
     except Exception as e:
         raise FileProcessingError('Failed to send photo', filename, {'error': str(e)})
 
+@face_recognition_bp.route('/api/face-entries/<int:entry_id>/crop', methods=['GET'])
+@handle_errors
+def get_face_crop(entry_id):
+    size = _requested_size() or 256
+    entry = FaceEntry.query.get_or_404(entry_id)
+    if not entry.image_path or not os.path.exists(entry.image_path):
+        raise FileProcessingError('Photo file missing', 'image_path')
+    
+    try:
+        cache = get_rendition_cache()
+        key = cache.face_crop_key(entry.image_path, entry.face_location, size)
+        last_modified = os.path.getmtime(entry.image_path)
+        cached = not_modified(key, last_modified)
+        if cached is not None:
+            return cached
+        path, key = cache.face_crop(entry.image_path, entry.face_location, size)
+        return send_rendition(path, key, last_modified)
+    except Exception as e:
+        raise FileProcessingError('Failed to send face crop', 'image_path', {'error': str(e)})
+
 # Contact management routes
+CONTACT_FIELDS = {
+    'id': Contact.id,
+    'name': Contact.name,
+    'phone': Contact.phone,
+    'email': Contact.email,
+    'address': Contact.address,
+    'birth_date': Contact.birth_date,
+    'occupation': Contact.occupation,
+    'notes': Contact.notes
+}
+CONTACT_ORDERS = {'id': Contact.id, 'created_at': Contact.created_at}
+
+def _contact_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return list(CONTACT_FIELDS)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in CONTACT_FIELDS]
+    if unknown or not fields:
+        raise ValidationError(f'fields must be a subset of {list(CONTACT_FIELDS)}', 'fields')
+    return fields
+
+def _contact_cursor(order):
+    """Decode ?cursor=: the last id, or '<created_at>_<id>' when ordered by created_at"""
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return None
+    try:
+        if order == 'id':
+            return int(cursor)
+        created_at, _, contact_id = cursor.rpartition('_')
+        return datetime.fromisoformat(created_at), int(contact_id)
+    except ValueError:
+        raise ValidationError('Invalid cursor', 'cursor')
+
+def _name_prefix_filter(query, prefix):
+    """name >= prefix AND name < next prefix, a range scan on the name index (case-sensitive)"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return query.filter(Contact.name >= prefix, Contact.name < upper)
+
 @face_recognition_bp.route('/api/contacts', methods=['GET'])
 @handle_errors
 def list_contacts():
-    contacts = Contact.query.all()
-    return jsonify([{
-        'id': c.id,
-        'name': c.name,
-        'phone': c.phone,
-        'email': c.email,
-        'address': c.address,
-        'birth_date': c.birth_date.isoformat() if c.birth_date else None,
-        'occupation': c.occupation,
-        'notes': c.notes
-    } for c in contacts])
+    """
+    Contacts, optionally filtered by ?prefix= (name prefix), projected to
+    ?fields=id,name and paged with ?limit= and ?cursor= in ?order=id or
+    created_at. Without limit every matching contact is returned. When
+    there are more, X-Next-Cursor carries the cursor of the next page.
+    The ETag changes with any contact insert, update or delete, so
+    polling with If-None-Match gets a 304 without a query for the rows.
+    """
+    fields = _contact_fields()
+    order = request.args.get('order', 'id')
+    if order not in CONTACT_ORDERS:
+        raise ValidationError(f'order must be one of {list(CONTACT_ORDERS)}', 'order')
+    limit = _bounded_arg('limit', 0, 1000) if 'limit' in request.args else None
+    cursor = _contact_cursor(order)
+    prefix = request.args.get('prefix')
+    
+    query = db.session.query(Contact)
+    if prefix:
+        query = _name_prefix_filter(query, prefix)
+    
+    # Any change bumps the newest updated_at or the count; the arguments pick the page.
+    # Two scalar subqueries so SQLite answers each from an index without a scan.
+    newest, count = db.session.query(
+        query.with_entities(db.func.max(Contact.updated_at)).scalar_subquery(),
+        query.with_entities(db.func.count()).scalar_subquery()
+    ).one()
+    etag = hashlib.sha1(f"{newest}|{count}|{sorted(request.args.items(multi=True))}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    columns = [CONTACT_FIELDS[field] for field in fields]
+    if order == 'id':
+        if cursor is not None:
+            query = query.filter(Contact.id > cursor)
+        query = query.order_by(Contact.id)
+    else:
+        if cursor is not None:
+            query = query.filter(db.or_(
+                Contact.created_at > cursor[0],
+                db.and_(Contact.created_at == cursor[0], Contact.id > cursor[1])
+            ))
+        query = query.order_by(Contact.created_at, Contact.id)
+    rows = query.with_entities(Contact.id, Contact.created_at, *columns) \
+        .limit(limit + 1 if limit else None).all()
+    
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = str(last[0]) if order == 'id' else f"{last[1].isoformat()}_{last[0]}"
+    
+    contacts = []
+    for row in rows:
+        contact = dict(zip(fields, row[2:]))
+        if contact.get('birth_date'):
+            contact['birth_date'] = contact['birth_date'].isoformat()
+        contacts.append(contact)
+    
+    response = jsonify(contacts)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @face_recognition_bp.route('/api/contacts', methods=['POST'])
 @handle_errors
@@ -269,4 +1084,39 @@ def link_face_to_contact(face_id):
     face.contact_id = contact_id
     db.session.commit()
     
-    return jsonify({'message': 'Face linked to contact successfully'})
\ No newline at end of file
+    return jsonify({'message': 'Face linked to contact successfully'})
+
+@face_recognition_bp.route('/api/faces/match', methods=['POST'])
+@handle_errors
+@rate_limit(calls=120, period=60)
+def match_face():
+    data = request.json
+    if not data or 'features' not in data:
+        raise ValidationError('features is required', 'features')
+    
+    try:
+        k = int(data.get('k', 5))
+        threshold = float(data['threshold']) if data.get('threshold') is not None else None
+    except (TypeError, ValueError):
+        raise ValidationError('k and threshold must be numbers', 'k')
+    if not 1 <= k <= 100:
+        raise ValidationError('k must be between 1 and 100', 'k')
+    
+    from app.services.face_clustering import loaded_gallery
+    
+    matches = loaded_gallery().query(data['features'], k=k, threshold=threshold)
+    faces = {f.id: f for f in Face.query.filter(Face.id.in_([face_id for face_id, _ in matches]))}
+    
+    return jsonify({'matches': [{
+        'face_id': face_id,
+        'name': faces[face_id].name if face_id in faces else None,
+        'contact_id': faces[face_id].contact_id if face_id in faces else None,
+        'similarity': score
+    } for face_id, score in matches]})
+
+@face_recognition_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, stage, error and rate-limit metrics of this process in the Prometheus text format"""
+    if not current_app.config.get('METRICS_ENABLED', True):
+        return jsonify({'error': 'Not Found', 'message': 'Metrics are disabled'}), 404
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -1,12 +1,47 @@
-from .face_detection import detect_faces
-from .file_storage import SecureFileStorage
-from .error_handler import ErrorHandler, FileProcessingError, ValidationError, PermissionError
+import importlib
 
-__all__ = [
-    'detect_faces',
-    'SecureFileStorage',
-    'ErrorHandler',
-    'FileProcessingError',
-    'ValidationError',
-    'PermissionError'
-]
\ No newline at end of file
+# Exported names and the submodule that defines them. Submodules are
+# imported on first attribute access, so importing one light service (the
+# logger, the rate limiter) does not load OpenCV, numpy and PIL.
+_EXPORTS = {
+    'detect_faces': 'face_detection',
+    'FaceDetector': 'face_detection',
+    'get_detector': 'face_detection',
+    'encrypt_features': 'face_detection',
+    'decrypt_features': 'face_detection',
+    'compare_faces': 'face_detection',
+    'compare_many': 'face_detection',
+    'SecureFileStorage': 'file_storage',
+    'StoredFile': 'file_storage',
+    'ScanEngine': 'scan_engine',
+    'FaceGallery': 'face_gallery',
+    'get_gallery': 'face_gallery',
+    'EmbeddingStore': 'embedding_store',
+    'get_embedding_store': 'embedding_store',
+    'MultiIndexHashTable': 'perceptual_hash',
+    'get_hash_index': 'perceptual_hash',
+    'FaceClusterer': 'face_clustering',
+    'get_clusterer': 'face_clustering',
+    'RenditionCache': 'renditions',
+    'DetectionCache': 'detection_cache',
+    'DetectionJobQueue': 'job_queue',
+    'QueueFullError': 'job_queue',
+    'BulkWriter': 'database',
+    'configure_sqlite': 'database',
+    'MetricsRegistry': 'metrics',
+    'SamplingProfiler': 'metrics',
+    'ErrorHandler': 'error_handler',
+    'FileProcessingError': 'error_handler',
+    'ValidationError': 'error_handler',
+    'PermissionError': 'error_handler'
+}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
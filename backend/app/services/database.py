@@ -0,0 +1,105 @@
+import logging
+import sqlite3
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from sqlalchemy import event, insert, update
+
+logger = logging.getLogger('database')
+
+# BulkWriter.insert(returning=...) issues INSERT ... RETURNING
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+def configure_sqlite(engine, journal_mode: str = 'WAL', synchronous: str = 'NORMAL',
+                     busy_timeout_ms: int = 5000) -> None:
+    """
+    Apply connection pragmas to a SQLite engine. WAL lets readers run while
+    a scan is writing; busy_timeout makes writers wait for each other
+    instead of failing with "database is locked". Raises RuntimeError if
+    the SQLite library is older than MIN_SQLITE_VERSION.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} is too old; "
+                           f"{'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is needed for INSERT ... RETURNING")
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+        cursor.execute(f'PRAGMA synchronous={synchronous}')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+        cursor.close()
+
+    # Connections opened before the listener was attached keep their old settings
+    engine.dispose()
+
+class BulkWriter:
+    """
+    Chunked bulk persistence for detection output.
+
+    Rows are written with executemany INSERT/UPDATE statements instead of
+    one ORM object per row, and every chunk is committed on its own. A
+    chunk that fails is rolled back and retried one item at a time, so a
+    bad record only loses itself.
+    """
+
+    def __init__(self, session, chunk_size: int = 500):
+        self.session = session
+        self.chunk_size = max(1, chunk_size)
+
+    def insert(self, model, rows: List[Dict[str, Any]], returning=None) -> List[Any]:
+        """
+        Bulk INSERT rows (keyed by attribute name) into model. With
+        returning, the returned values come back in the order of rows.
+        """
+        if not rows:
+            return []
+        statement = insert(model)
+        if returning is None:
+            self.session.execute(statement, rows)
+            return []
+        return list(self.session.scalars(statement.returning(returning, sort_by_parameter_order=True), rows))
+
+    def update(self, model, rows: List[Dict[str, Any]]) -> None:
+        """Bulk UPDATE by primary key; every row must include it"""
+        if rows:
+            self.session.execute(update(model), rows)
+
+    def _commit(self, write_chunk: Callable[[Sequence[Any]], None], items: Sequence[Any]) -> None:
+        try:
+            write_chunk(items)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def write(self, items: Sequence[Any],
+              write_chunk: Callable[[Sequence[Any]], None]) -> Tuple[List[Any], List[Tuple[Any, str]]]:
+        """
+        Call write_chunk on consecutive chunks of items, committing each.
+        Returns (written items, [(failed item, error)]).
+        """
+        written = []
+        failed = []
+        for start in range(0, len(items), self.chunk_size):
+            chunk = items[start:start + self.chunk_size]
+            try:
+                self._commit(write_chunk, chunk)
+                written.extend(chunk)
+                continue
+            except Exception as e:
+                if len(chunk) == 1:
+                    failed.append((chunk[0], str(e)))
+                    continue
+                logger.warning(f"Bulk write of {len(chunk)} rows failed, retrying one by one: {str(e)}")
+
+            for item in chunk:
+                try:
+                    self._commit(write_chunk, [item])
+                    written.append(item)
+                except Exception as e:
+                    failed.append((item, str(e)))
+        if failed:
+            logger.error(f"Bulk write failed for {len(failed)} of {len(items)} rows")
+        return written, failed
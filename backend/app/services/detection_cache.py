@@ -0,0 +1,178 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from .metrics import metrics
+
+logger = logging.getLogger('face_detection')
+
+metrics.describe('detection_cache_hits_total', 'Detection results served from the cache, by tier')
+metrics.describe('detection_cache_misses_total', 'Detections that had to run the detector')
+metrics.describe('detection_cache_evictions_total', 'Cached detection results evicted for space, by tier')
+
+class DetectionCache:
+    """
+    Two-tier cache of detection results: an in-memory LRU in front of a
+    SQLite store shared by every worker process.
+
+    Entries are keyed by the image content hash and the detector
+    fingerprint (version, cascade and parameters), so changing a detector
+    setting can never serve an old result. Both tiers are bounded in
+    bytes and evict the least recently used entries first. Results are
+    stored as JSON; face features stay encrypted.
+    """
+
+    def __init__(self, path: Optional[str], max_bytes: int = 256 * 1024 * 1024,
+                 memory_bytes: int = 32 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._memory: 'OrderedDict[str, str]' = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @staticmethod
+    def key(content_hash: str, fingerprint: str) -> str:
+        return hashlib.sha256(f"{content_hash}|{fingerprint}".encode()).hexdigest()
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """Per-thread connection to the disk tier"""
+        if not self.path:
+            return None
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, detector TEXT NOT NULL, '
+                         'result TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL) WITHOUT ROWID')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _remember(self, key: str, value: str) -> None:
+        """Put an entry in the memory tier, evicting the least recently used"""
+        if len(value) > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_size -= len(old)
+            self._memory[key] = value
+            self._memory_size += len(value)
+            evicted = 0
+            while self._memory_size > self.memory_bytes:
+                _, dropped = self._memory.popitem(last=False)
+                self._memory_size -= len(dropped)
+                evicted += 1
+        if evicted:
+            metrics.inc('detection_cache_evictions_total', evicted, tier='memory')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The cached result for key, or None"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+        if value is not None:
+            metrics.inc('detection_cache_hits_total', tier='memory')
+            return json.loads(value)
+
+        conn = self._db()
+        row = conn.execute('SELECT result FROM entries WHERE key = ?', (key,)).fetchone() if conn else None
+        if row is None:
+            metrics.inc('detection_cache_misses_total')
+            return None
+        conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        self._remember(key, row[0])
+        metrics.inc('detection_cache_hits_total', tier='disk')
+        return json.loads(row[0])
+
+    def put(self, key: str, fingerprint: str, result: Dict[str, Any]) -> None:
+        value = json.dumps(result, separators=(',', ':'))
+        self._remember(key, value)
+        conn = self._db()
+        if conn is None:
+            return
+        conn.execute('INSERT OR REPLACE INTO entries (key, detector, result, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                     (key, fingerprint, value, len(value), time.time()))
+        with self._lock:
+            self._puts += 1
+            check = self._puts % 64 == 1
+        if check:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Trim the disk tier to 90% of max_bytes, least recently used first"""
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY last_used'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM entries WHERE key = ?', keys)
+        metrics.inc('detection_cache_evictions_total', len(keys), tier='disk')
+        logger.info(f"Detection cache evicted {len(keys)} entries")
+
+    def retain(self, fingerprints: Iterable[str]) -> int:
+        """Drop every entry made by a detector not in fingerprints; returns the number dropped"""
+        fingerprints = list(fingerprints)
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        conn = self._db()
+        if conn is None:
+            return 0
+        placeholders = ','.join('?' * len(fingerprints))
+        dropped = conn.execute(f'DELETE FROM entries WHERE detector NOT IN ({placeholders})', fingerprints).rowcount
+        if dropped:
+            logger.info(f"Detection cache dropped {dropped} entries of changed detector settings")
+        return dropped
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        conn = self._db()
+        if conn is not None:
+            conn.execute('DELETE FROM entries')
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._db()
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone() \
+            if conn else (0, 0)
+        with self._lock:
+            return {'memory_entries': len(self._memory), 'memory_bytes': self._memory_size,
+                    'disk_entries': entries, 'disk_bytes': size}
+
+
+_cache: Optional[DetectionCache] = None
+
+def configure_detection_cache(path: Optional[str], max_bytes: int = 256 * 1024 * 1024,
+                              memory_bytes: int = 32 * 1024 * 1024) -> Optional[DetectionCache]:
+    """
+    Set up the process-wide cache; forked scan workers inherit it. With no
+    path only the memory tier is used; with neither it is disabled.
+    """
+    global _cache
+    _cache = DetectionCache(path, max_bytes, memory_bytes) if path or memory_bytes > 0 else None
+    return _cache
+
+def get_detection_cache() -> Optional[DetectionCache]:
+    """Return the process-wide detection cache, or None when it is disabled"""
+    return _cache
@@ -0,0 +1,573 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .face_gallery import features_to_vector
+
+logger = logging.getLogger('face_detection')
+
+STORE_VERSION = 1
+PQ_CENTROIDS = 256
+
+def kmeans(data: np.ndarray, k: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means on the rows of data; returns k float32 centroids"""
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(data, centroids)
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        centroids[filled] = np.add.reduceat(data[order], starts, axis=0) / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        if empty.size:
+            # Restart empty clusters on random points
+            centroids[empty] = data[rng.choice(len(data), empty.size, replace=False)]
+    return centroids
+
+def nearest_centroids(data: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+    """Index of the nearest centroid (squared L2) for each row of data"""
+    norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        block = np.asarray(data[start:start + block_size], dtype=np.float32)
+        labels[start:start + len(block)] = (norms - 2 * block @ centroids.T).argmin(axis=1)
+    return labels
+
+class ProductQuantizer:
+    """
+    IVF-PQ codec: a coarse k-means quantizer picks an inverted list, and
+    the residual to its centroid is split into m sub-vectors that are each
+    replaced by the nearest of 256 sub-centroids, i.e. one byte.
+    """
+
+    def __init__(self, centroids: np.ndarray, codebooks: np.ndarray):
+        self.centroids = centroids.astype(np.float32)
+        self.codebooks = codebooks.astype(np.float32)
+        self.m, _, self.dsub = codebooks.shape
+        self.centroid_norms = (self.centroids ** 2).sum(axis=1)
+
+    @classmethod
+    def train(cls, data: np.ndarray, nlist: int, m: int, iterations: int = 10) -> 'ProductQuantizer':
+        if data.shape[1] % m:
+            raise ValueError(f"Dimension {data.shape[1]} is not divisible by m={m}")
+        centroids = kmeans(data, nlist, iterations)
+        residuals = data - centroids[nearest_centroids(data, centroids)]
+        dsub = data.shape[1] // m
+        codebooks = np.stack([
+            kmeans(residuals[:, s * dsub:(s + 1) * dsub], PQ_CENTROIDS, iterations, seed=s)
+            for s in range(m)
+        ])
+        return cls(centroids, codebooks)
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(inverted list, m code bytes) for each vector"""
+        lists = nearest_centroids(vectors, self.centroids)
+        residuals = vectors - self.centroids[lists]
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for s in range(self.m):
+            codes[:, s] = nearest_centroids(residuals[:, s * self.dsub:(s + 1) * self.dsub], self.codebooks[s])
+        return lists.astype(np.int32), codes
+
+    def lookup_table(self, query: np.ndarray) -> np.ndarray:
+        """Inner products of each query sub-vector with its 256 sub-centroids, shape (m, 256)"""
+        return np.einsum('sd,sjd->sj', query.reshape(self.m, self.dsub), self.codebooks)
+
+def quantize_rows(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    int8 rows and per-row float32 scales; row * scale reconstructs the
+    vector. The scale renormalizes the rounded row, so similarities with a
+    unit query stay within [-1, 1] as they do in FaceGallery.
+    """
+    steps = np.abs(vectors).max(axis=1) / 127
+    steps[steps == 0] = 1
+    quantized = np.rint(vectors / steps[:, None]).astype(np.int8)
+    norms = np.linalg.norm(quantized.astype(np.float32), axis=1)
+    scales = np.where(norms > 0, 1 / np.maximum(norms, 1e-12), 1)
+    return quantized, scales.astype('<f4')
+
+class EmbeddingStore:
+    """
+    On-disk face vector store with an IVF-PQ approximate index.
+
+    Vectors are appended to a memory-mapped file as unit-length int8 rows,
+    each with a float32 scale, keyed by a parallel file of face ids. Updates and deletes append
+    a new row (a delete stores the id negated), so writes never rewrite
+    existing data; build_index() compacts away superseded rows.
+
+    Once an index is built, each face keeps only its IVF-PQ code (m bytes)
+    and a few integers in memory. A query scores the nprobe closest inverted
+    lists from the codes, then re-ranks the best rerank candidates exactly
+    against the int8 rows, which are paged in from disk on demand. Rows
+    appended after the last build are scored exactly until the next one.
+    Without an index every query is an exact scan of the mapped file.
+
+    It offers the FaceGallery interface, so it can stand in for it.
+    Appends take an exclusive flock; other processes pick up new rows and
+    rebuilt indexes before their next query.
+    """
+
+    def __init__(self, directory: str, nprobe: int = 16, rerank: int = 64):
+        self.directory = directory
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._file_locked = False
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    # -- files ---------------------------------------------------------------
+
+    def _path(self, name: str, generation: Optional[int] = None) -> str:
+        generation = self._generation if generation is None else generation
+        return os.path.join(self.directory, f"{name}-{generation}")
+
+    def _read_meta(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.directory, 'meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'version': STORE_VERSION, 'generation': 0, 'dim': None, 'indexed': False}
+
+    def _write_meta(self, meta: Dict[str, Any]) -> None:
+        path = os.path.join(self.directory, 'meta.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Exclusive flock across processes; re-entrant for the thread holding _lock"""
+        if self._file_locked:
+            yield
+            return
+        with open(os.path.join(self.directory, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._file_locked = True
+            try:
+                yield
+            finally:
+                self._file_locked = False
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _code_dtype(self) -> np.dtype:
+        return np.dtype([('list', '<i4'), ('code', 'u1', (self._pq.m,))])
+
+    def _open(self) -> None:
+        """(Re)read the current generation: ids, liveness and the index"""
+        meta = self._read_meta()
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported embedding store version {meta.get('version')}")
+        self._meta_mtime = self._stat_meta()
+        self._generation = meta['generation']
+        self.dim = meta['dim']
+        self._pq: Optional[ProductQuantizer] = None
+        if meta['indexed']:
+            with np.load(self._path('index') + '.npz') as index:
+                self._pq = ProductQuantizer(index['centroids'], index['codebooks'])
+
+        ids_path = self._path('ids')
+        ids = np.fromfile(ids_path, dtype='<i8') if os.path.exists(ids_path) else np.empty(0, dtype=np.int64)
+        # A face's last row wins; it is live unless that row is a delete
+        faces = np.where(ids >= 0, ids, -ids - 1)
+        _, last = np.unique(faces[::-1], return_index=True)
+        last = len(ids) - 1 - last
+        self._ids = ids.astype(np.int64)
+        self._live = np.zeros(len(ids), dtype=bool)
+        self._live[last] = ids[last] >= 0
+        self._rows = len(ids)
+        self._vectors: Optional[np.memmap] = None
+        self._rebuild_lookup()
+        self._build_lists()
+
+    def _stat_meta(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.directory, 'meta.json')).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self) -> None:
+        """Pick up rows appended and indexes built by other processes"""
+        if self._stat_meta() != self._meta_mtime:
+            self._open()
+            return
+        try:
+            size = os.path.getsize(self._path('ids'))
+        except FileNotFoundError:
+            return
+        if size // 8 > self._rows:
+            with open(self._path('ids'), 'rb') as f:
+                f.seek(self._rows * 8)
+                self._track(np.frombuffer(f.read((size // 8 - self._rows) * 8), dtype='<i8'))
+
+    def _track(self, ids: np.ndarray) -> None:
+        """Register rows already written to disk"""
+        first = self._rows
+        total = first + len(ids)
+        if total > len(self._ids):
+            capacity = max(1024, total, len(self._ids) * 2)
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_ids[:first] = self._ids[:first]
+            grown_live = np.zeros(capacity, dtype=bool)
+            grown_live[:first] = self._live[:first]
+            self._ids, self._live = grown_ids, grown_live
+        self._ids[first:total] = ids
+        for offset, stored in enumerate(ids.tolist()):
+            row = first + offset
+            face_id = stored if stored >= 0 else -stored - 1
+            previous = self._row_of(face_id)
+            if previous is not None:
+                self._live[previous] = False
+            self._live[row] = stored >= 0
+            self._recent[face_id] = row if stored >= 0 else None
+        self._rows = total
+        if len(self._recent) > max(4096, len(self._sorted_ids) // 8):
+            self._rebuild_lookup()
+
+    def _rebuild_lookup(self) -> None:
+        """Fold recently written rows into the sorted id -> row arrays"""
+        rows = np.flatnonzero(self._live[:self._rows]).astype(np.int32)
+        ids = self._ids[rows]
+        order = np.argsort(ids, kind='stable')
+        self._sorted_ids, self._sorted_rows = ids[order], rows[order]
+        self._recent = {}
+
+    def _row_of(self, face_id: int) -> Optional[int]:
+        if face_id in self._recent:
+            return self._recent[face_id]
+        i = np.searchsorted(self._sorted_ids, face_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == face_id:
+            row = int(self._sorted_rows[i])
+            return row if self._live[row] else None
+        return None
+
+    def _row_vectors(self, rows: Any) -> np.ndarray:
+        """float32 vectors of the given rows (an index array or a slice)"""
+        if self._vectors is None or len(self._vectors) < self._rows:
+            self._vectors = np.memmap(self._path('vectors'), dtype='i1', mode='r', shape=(self._rows, self.dim))
+            self._scales = np.memmap(self._path('scales'), dtype='<f4', mode='r', shape=(self._rows,))
+        return self._vectors[rows].astype(np.float32) * self._scales[rows][:, None]
+
+    def _row_scores(self, rows: Any, vector: np.ndarray) -> np.ndarray:
+        """Inner products with the given rows; the scale is applied to the scores, not the rows"""
+        self._row_vectors(slice(0, 0))
+        return (self._vectors[rows].astype(np.float32) @ vector) * self._scales[rows]
+
+    def _build_lists(self) -> None:
+        """Group the live encoded rows by inverted list, with their codes in list order"""
+        self._indexed_rows = 0
+        self._list_offsets = None
+        if self._pq is None or not self._rows:
+            return
+        codes = np.fromfile(self._path('codes'), dtype=self._code_dtype())
+        encoded = min(len(codes), self._rows)
+        rows = np.flatnonzero(self._live[:encoded]).astype(np.int32)
+        rows = rows[np.argsort(codes['list'][rows], kind='stable')]
+        counts = np.bincount(codes['list'][rows], minlength=len(self._pq.centroids))
+        self._list_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self._list_rows = rows
+        self._list_codes = np.ascontiguousarray(codes['code'][rows])
+        self._indexed_rows = encoded
+
+    # -- writes --------------------------------------------------------------
+
+    def _append(self, items: List[Tuple[int, Optional[np.ndarray]]]) -> None:
+        """Append (face_id, unit vector or None for a delete) rows"""
+        with self._lock, self._file_lock():
+            self._refresh()
+            if self.dim is None:
+                first = next((vector for _, vector in items if vector is not None), None)
+                if first is None:
+                    return
+                self.dim = first.size
+                self._write_meta({'version': STORE_VERSION, 'generation': self._generation,
+                                  'dim': self.dim, 'indexed': False})
+                self._meta_mtime = self._stat_meta()
+            self._truncate()
+            vectors = np.zeros((len(items), self.dim), dtype=np.float32)
+            ids = np.empty(len(items), dtype='<i8')
+            for i, (face_id, vector) in enumerate(items):
+                if vector is None:
+                    ids[i] = -face_id - 1
+                else:
+                    vectors[i] = vector
+                    ids[i] = face_id
+            if self._pq is not None:
+                records = np.zeros(len(items), dtype=self._code_dtype())
+                records['list'], records['code'] = self._pq.encode(vectors)
+                with open(self._path('codes'), 'ab') as f:
+                    f.write(records.tobytes())
+            quantized, scales = quantize_rows(vectors)
+            with open(self._path('vectors'), 'ab') as f:
+                f.write(quantized.tobytes())
+            with open(self._path('scales'), 'ab') as f:
+                f.write(scales.tobytes())
+            # The id file is written last; a row exists once its id does
+            with open(self._path('ids'), 'ab') as f:
+                f.write(ids.tobytes())
+            self._track(ids)
+
+    def _truncate(self) -> None:
+        """
+        Cut the files back to the rows that have an id. An interrupted
+        append can leave data rows without one, which would shift every
+        later row onto the wrong vector.
+        """
+        row_sizes = {'ids': 8, 'vectors': self.dim, 'scales': 4}
+        if self._pq is not None:
+            row_sizes['codes'] = self._code_dtype().itemsize
+        for name, row_size in row_sizes.items():
+            path = self._path(name)
+            try:
+                if os.path.getsize(path) > self._rows * row_size:
+                    logger.warning(f"Dropping a partly appended row from {path}")
+                    os.truncate(path, self._rows * row_size)
+            except FileNotFoundError:
+                pass
+
+    def _usable(self, face_id: int, encoding: Any) -> Optional[np.ndarray]:
+        vector = features_to_vector(encoding)
+        if vector is not None and self.dim is not None and vector.size != self.dim:
+            logger.warning(f"Skipping face {face_id}: encoding has unexpected size {vector.size}")
+            return None
+        return vector
+
+    def load(self, faces: Iterable[Tuple[int, Any]], chunk_size: int = 1024) -> None:
+        """Replace the store contents with (face_id, encoding) pairs"""
+        with self._lock, self._file_lock():
+            old = self._generation
+            self._write_meta({'version': STORE_VERSION, 'generation': old + 1, 'dim': None, 'indexed': False})
+            self._open()
+            self._remove_generation(old)
+            chunk = []
+            for face_id, encoding in faces:
+                vector = self._usable(face_id, encoding)
+                if vector is not None:
+                    chunk.append((face_id, vector))
+                if len(chunk) >= chunk_size:
+                    self._append(chunk)
+                    chunk = []
+            if chunk:
+                self._append(chunk)
+            self.loaded = True
+        logger.info(f"Embedding store loaded with {len(self)} faces")
+
+    def reconcile(self, face_ids: Iterable[int], fetch: Callable[[List[int]], Iterable[Tuple[int, Any]]],
+                  chunk_size: int = 1024) -> None:
+        """
+        Bring the store in step with the given face ids without rewriting
+        it: missing faces are read with fetch(ids), as (face_id, encoding)
+        pairs, and appended, and stored faces that are not in face_ids are
+        deleted. It runs under the file lock, so workers that start
+        together append each face once.
+        """
+        wanted = np.unique(np.fromiter(face_ids, dtype=np.int64))
+        added = 0
+        with self._lock, self._file_lock():
+            self._refresh()
+            stored = np.unique(self._ids[:self._rows][self._live[:self._rows]])
+            gone = np.setdiff1d(stored, wanted, assume_unique=True)
+            if len(gone):
+                self._append([(int(face_id), None) for face_id in gone])
+            missing = np.setdiff1d(wanted, stored, assume_unique=True).tolist()
+            for start in range(0, len(missing), chunk_size):
+                usable = ((face_id, self._usable(face_id, encoding))
+                          for face_id, encoding in fetch(missing[start:start + chunk_size]))
+                chunk = [(face_id, vector) for face_id, vector in usable if vector is not None]
+                if chunk:
+                    self._append(chunk)
+                    added += len(chunk)
+            self.loaded = True
+        logger.info(f"Embedding store reconciled: {added} faces added, {len(gone)} removed, {len(self)} in total")
+
+    def add(self, face_id: int, encoding: Any) -> bool:
+        vector = self._usable(face_id, encoding)
+        if vector is None:
+            self.remove(face_id)
+            return False
+        self._append([(face_id, vector)])
+        return True
+
+    def remove(self, face_id: int) -> bool:
+        with self._lock:
+            self._refresh()
+            if self._row_of(face_id) is None:
+                return False
+            self._append([(face_id, None)])
+        return True
+
+    def build_index(self, nlist: Optional[int] = None, m: int = 32, sample: int = 65536,
+                    iterations: int = 10) -> None:
+        """
+        Compact the store and train the IVF-PQ index on up to sample live
+        vectors. nlist defaults to about 4 * sqrt(faces).
+        """
+        with self._lock, self._file_lock():
+            self._refresh()
+            rows = np.flatnonzero(self._live[:self._rows])
+            if len(rows) < PQ_CENTROIDS:
+                raise ValueError(f"Need at least {PQ_CENTROIDS} faces to build an index, have {len(rows)}")
+            nlist = nlist or int(min(max(16, 4 * np.sqrt(len(rows))), len(rows) // 8))
+            rng = np.random.default_rng(0)
+            training = np.sort(rng.choice(rows, min(sample, len(rows)), replace=False))
+            pq = ProductQuantizer.train(self._row_vectors(training), nlist, m, iterations)
+
+            old, new = self._generation, self._generation + 1
+            np.savez(self._path('index', new) + '.npz', centroids=pq.centroids, codebooks=pq.codebooks)
+            dtype = np.dtype([('list', '<i4'), ('code', 'u1', (m,))])
+            with open(self._path('ids', new), 'wb') as ids_file, \
+                    open(self._path('vectors', new), 'wb') as vectors_file, \
+                    open(self._path('scales', new), 'wb') as scales_file, \
+                    open(self._path('codes', new), 'wb') as codes_file:
+                for start in range(0, len(rows), 8192):
+                    block = rows[start:start + 8192]
+                    records = np.zeros(len(block), dtype=dtype)
+                    records['list'], records['code'] = pq.encode(self._row_vectors(block))
+                    ids_file.write(self._ids[block].astype('<i8').tobytes())
+                    vectors_file.write(np.asarray(self._vectors[block]).tobytes())
+                    scales_file.write(np.asarray(self._scales[block]).tobytes())
+                    codes_file.write(records.tobytes())
+                for f in (ids_file, vectors_file, scales_file, codes_file):
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._write_meta({'version': STORE_VERSION, 'generation': new, 'dim': self.dim, 'indexed': True})
+            self._vectors = None
+            self._open()
+            self._remove_generation(old)
+        logger.info(f"Embedding index built: {len(rows)} faces, {nlist} lists, {m} bytes per code")
+
+    def _remove_generation(self, generation: int) -> None:
+        for name in ('ids', 'vectors', 'scales', 'codes', 'index'):
+            for suffix in ('', '.npz'):
+                try:
+                    os.remove(self._path(name, generation) + suffix)
+                except FileNotFoundError:
+                    pass
+
+    # -- reads ---------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return int(self._live[:self._rows].sum())
+
+    @property
+    def indexed(self) -> bool:
+        return self._pq is not None
+
+    def memory_per_face(self) -> float:
+        """Bytes of process memory held per stored face, excluding the mapped vector file"""
+        arrays = [self._ids, self._live, self._sorted_ids, self._sorted_rows]
+        if self._list_offsets is not None:
+            arrays += [self._list_rows, self._list_codes]
+        return sum(a.nbytes for a in arrays) / max(1, len(self))
+
+    def vector(self, face_id: int) -> Optional[np.ndarray]:
+        with self._lock:
+            self._refresh()
+            row = self._row_of(face_id)
+            if row is None:
+                return None
+            vector = self._row_vectors([row])[0]
+        return vector / np.linalg.norm(vector)
+
+    def _candidates(self, vector: np.ndarray) -> np.ndarray:
+        """Rows worth an exact score: the best IVF-PQ matches plus unindexed rows"""
+        pq = self._pq
+        centroid_scores = pq.centroids @ vector
+        # Probe the lists nearest in L2, as vectors were assigned: max q.c - |c|^2 / 2
+        nprobe = min(self.nprobe, len(centroid_scores))
+        probes = np.argpartition(pq.centroid_norms / 2 - centroid_scores, nprobe - 1)[:nprobe]
+        table = pq.lookup_table(vector)
+        subspaces = np.arange(pq.m)
+
+        rows = []
+        scores = []
+        for probe in probes:
+            start, stop = self._list_offsets[probe], self._list_offsets[probe + 1]
+            if start == stop:
+                continue
+            rows.append(self._list_rows[start:stop])
+            # q.x ~= q.centroid + sum of the sub-centroid inner products
+            scores.append(centroid_scores[probe] + table[subspaces, self._list_codes[start:stop]].sum(axis=1))
+        tail = np.arange(self._indexed_rows, self._rows)
+        if not rows:
+            return tail[self._live[tail]]
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores)
+        alive = self._live[rows]
+        rows, scores = rows[alive], scores[alive]
+        if len(rows) > self.rerank:
+            rows = rows[np.argpartition(-scores, self.rerank - 1)[:self.rerank]]
+        return np.concatenate((rows, tail[self._live[tail]]))
+
+    def _search(self, vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        if self._list_offsets is not None and self._rows - self._indexed_rows > max(1024, self._indexed_rows // 10):
+            # Too many rows are scored exactly; fold them into the inverted lists
+            self._build_lists()
+        if self._list_offsets is None:
+            # Exact scan in contiguous, cache-sized blocks, which is much
+            # cheaper than gathering the live rows one by one
+            blocks = [np.arange(start, min(start + 2048, self._rows)) for start in range(0, self._rows, 2048)]
+        else:
+            candidates = np.sort(self._candidates(vector))
+            blocks = [candidates[start:start + 16384] for start in range(0, len(candidates), 16384)]
+        best_rows = []
+        best_scores = []
+        for block in blocks:
+            if self._list_offsets is None:
+                scores = self._row_scores(slice(block[0], block[-1] + 1), vector)
+                live = self._live[block]
+                block, scores = block[live], scores[live]
+            else:
+                scores = self._row_scores(block, vector)
+            if not scores.size:
+                continue
+            top = np.argpartition(-scores, k - 1)[:k] if scores.size > k else np.arange(scores.size)
+            best_rows.append(block[top])
+            best_scores.append(scores[top])
+        if not best_rows:
+            return []
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores)[:k]
+        return [(int(self._ids[rows[i]]), float(scores[i])) for i in order]
+
+    def query(self, encoding: Any, k: int = 5, threshold: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Up to k (face_id, cosine similarity) pairs, best first; approximate once indexed"""
+        vector = features_to_vector(encoding)
+        if vector is None or k <= 0:
+            return []
+        with self._lock:
+            self._refresh()
+            if self.dim is None or vector.size != self.dim:
+                return []
+            matches = self._search(vector, k)
+        if threshold is not None:
+            matches = [m for m in matches if m[1] >= threshold]
+        return matches
+
+    def query_many(self, encodings: List[Any], k: int = 5,
+                   threshold: Optional[float] = None) -> List[List[Tuple[int, float]]]:
+        return [self.query(encoding, k, threshold) for encoding in encodings]
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+def get_embedding_store(directory: str, nprobe: int = 16, rerank: int = 64) -> EmbeddingStore:
+    """Return the process-wide store for directory"""
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = EmbeddingStore(directory, nprobe, rerank)
+        store.nprobe, store.rerank = nprobe, rerank
+        return store
@@ -3,6 +3,8 @@ from typing import Dict, Any, Optional, Tuple, Union
 from werkzeug.exceptions import HTTPException
 from flask import jsonify
 
+from .metrics import metrics
+
 logger = logging.getLogger('error_handler')
 
 class BaseError(Exception):
@@ -31,7 +33,15 @@ class AppError(Exception):
 class ErrorHandler:
     @staticmethod
     def handle_error(error: Exception) -> Tuple[Dict[str, Union[str, Dict]], int]:
-        if isinstance(error, ValidationError):
+        metrics.inc('errors_total', type=type(error).__name__)
+        if isinstance(error, HTTPException):
+            logger.warning(f"HTTP Exception: {error.name} - {error.description}")
+            return {
+                'error': error.name,
+                'message': error.description
+            }, error.code
+
+        elif isinstance(error, ValidationError):
             logger.warning(f"Validation error: {error.message}", extra={
                 'field': error.field,
                 'details': error.details
@@ -0,0 +1,420 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import false, func, select, update
+
+from ..models import Face, FaceCluster, FaceEntry, FaceEntryFeatures, Photo, db
+from .face_detection import decrypt_features, encode_features
+from .face_gallery import FaceGallery, features_to_vector, get_gallery, register_gallery_sync
+
+logger = logging.getLogger('face_detection')
+
+def centroid_from_encoding(encoding: Any, clustered: bool) -> Optional[np.ndarray]:
+    """
+    Mean feature vector of a Face. Cluster faces store the unnormalized mean
+    of their members' unit vectors; any other face counts as one member.
+    """
+    if not clustered:
+        return features_to_vector(encoding)
+    try:
+        return decrypt_features(encoding).astype(np.float32)
+    except (TypeError, ValueError):
+        return None
+
+def encode_centroid(mean: np.ndarray) -> bytes:
+    """Encrypt a cluster mean for Face.encoding"""
+    return encode_features(mean, np.float16)
+
+class FaceClusterer:
+    """
+    Incremental clustering of detected faces around Face centroids.
+
+    A new detection joins the most similar Face in the gallery when the
+    cosine similarity reaches threshold, otherwise it starts a new Face.
+    Each assignment is one pass over the centroids, so the cost per photo
+    grows with the number of clusters, not with the number of detections.
+    Clusters touched since the last merge are compared against all
+    centroids every merge_interval assignments, and pairs above
+    merge_threshold are merged.
+    """
+
+    def __init__(self, threshold: float = 0.95, merge_threshold: float = 0.97, merge_interval: int = 500):
+        self.threshold = threshold
+        self.merge_threshold = merge_threshold
+        self.merge_interval = merge_interval
+        self._lock = threading.Lock()
+        self._touched: Set[int] = set()
+        self._assigned = 0
+        self._merging = False
+
+    def configure(self, config) -> None:
+        self.threshold = config.get('CLUSTER_THRESHOLD', self.threshold)
+        self.merge_threshold = config.get('CLUSTER_MERGE_THRESHOLD', self.merge_threshold)
+        self.merge_interval = config.get('CLUSTER_MERGE_INTERVAL', self.merge_interval)
+
+    def assign(self, gallery: FaceGallery, vectors: List[np.ndarray]) -> List[Optional[Tuple[int, float]]]:
+        """
+        Match the faces of one photo to existing clusters. Faces in the same
+        photo are different people, so each cluster is used at most once.
+        Returns (face_id, similarity) or None per vector.
+        """
+        candidates = []
+        for i, matches in enumerate(gallery.query_many(vectors, k=len(vectors), threshold=self.threshold)):
+            candidates.extend((score, i, face_id) for face_id, score in matches)
+        candidates.sort(reverse=True)
+
+        assigned: List[Optional[Tuple[int, float]]] = [None] * len(vectors)
+        used = set()
+        for score, i, face_id in candidates:
+            if assigned[i] is None and face_id not in used:
+                assigned[i] = (face_id, score)
+                used.add(face_id)
+        return assigned
+
+    @staticmethod
+    def add_member(mean: np.ndarray, size: int, vector: np.ndarray) -> np.ndarray:
+        """Running mean after adding one unit vector to a cluster of size members"""
+        return (mean * size + vector) / (size + 1)
+
+    @staticmethod
+    def merge_means(mean: np.ndarray, size: int, other: np.ndarray, other_size: int) -> np.ndarray:
+        return (mean * size + other * other_size) / (size + other_size)
+
+    def merge_candidates(self, gallery: FaceGallery, face_ids: Iterable[int]) -> List[Tuple[int, int, float]]:
+        """(face_id, nearest other face_id, similarity) for clusters above merge_threshold, best first"""
+        known = [(face_id, gallery.vector(face_id)) for face_id in face_ids]
+        known = [(face_id, vector) for face_id, vector in known if vector is not None]
+        if not known:
+            return []
+        face_ids = [face_id for face_id, _ in known]
+        vectors = [vector for _, vector in known]
+        pairs = []
+        for face_id, matches in zip(face_ids, gallery.query_many(vectors, k=2, threshold=self.merge_threshold)):
+            for other_id, score in matches:
+                if other_id != face_id:
+                    pairs.append((face_id, other_id, score))
+                    break
+        pairs.sort(key=lambda pair: -pair[2])
+        return pairs
+
+    def note_assigned(self, face_ids: Iterable[int]) -> bool:
+        """
+        Record clusters that changed. Returns True when a merge pass is due
+        and no other merge is running; the caller then runs take_touched()
+        """
+        with self._lock:
+            for face_id in face_ids:
+                self._touched.add(face_id)
+                self._assigned += 1
+            if self._merging or self._assigned < self.merge_interval:
+                return False
+            self._merging = True
+            self._assigned = 0
+            return True
+
+    def take_touched(self) -> Set[int]:
+        with self._lock:
+            touched, self._touched = self._touched, set()
+        return touched
+
+    def merge_finished(self) -> None:
+        with self._lock:
+            self._merging = False
+
+_clusterer = FaceClusterer()
+
+def get_clusterer() -> FaceClusterer:
+    """Return the process-wide clusterer"""
+    return _clusterer
+
+# -- clustering the stored detections ----------------------------------------
+
+# (max Face id, FaceCluster.updated_at) each loaded gallery is caught up to
+_synced: Dict[Any, Tuple[int, datetime]] = {}
+_synced_lock = threading.Lock()
+
+def loaded_gallery():
+    """
+    The process-wide face gallery, loaded from the Face table on first use
+    and caught up with the faces other workers added or moved since the
+    last call. With EMBEDDING_STORE_DIR set it is the on-disk
+    EmbeddingStore, which is reconciled with the Face table instead of
+    being rebuilt.
+    """
+    directory = current_app.config.get('EMBEDDING_STORE_DIR')
+    if directory:
+        from .embedding_store import get_embedding_store
+        gallery = get_embedding_store(directory,
+                                      nprobe=current_app.config.get('EMBEDDING_NPROBE', 16),
+                                      rerank=current_app.config.get('EMBEDDING_RERANK', 64))
+    else:
+        gallery = get_gallery()
+    if gallery.loaded:
+        _catch_up(gallery)
+        return gallery
+    
+    # Keep the gallery in step with committed Face rows from here on
+    register_gallery_sync(db.session, Face, gallery)
+    synced = (db.session.query(func.max(Face.id)).scalar() or 0, datetime.utcnow())
+    faces = db.session.query(Face.id, Face.encoding).filter(Face.encoding.isnot(None))
+    if directory:
+        gallery.reconcile((face_id for face_id, in faces.with_entities(Face.id)),
+                          lambda ids: faces.filter(Face.id.in_(ids)))
+    else:
+        gallery.load(faces)
+    with _synced_lock:
+        _synced[gallery] = synced
+    return gallery
+
+def _catch_up(gallery) -> None:
+    """
+    Add the faces created and the cluster centroids moved by other workers
+    since the last catch-up; this process's own commits are already synced
+    """
+    with _synced_lock:
+        last_id, last_at = _synced.get(gallery, (0, datetime.min))
+    now = datetime.utcnow()
+    created = db.session.query(Face.id, Face.encoding) \
+        .filter(Face.id > last_id, Face.encoding.isnot(None)).order_by(Face.id).all()
+    moved = db.session.query(Face.id, Face.encoding).join(FaceCluster, FaceCluster.face_id == Face.id) \
+        .filter(FaceCluster.updated_at >= last_at).all()
+    for face_id, encoding in created + moved:
+        vector = features_to_vector(encoding)
+        if vector is None:
+            continue
+        current = gallery.vector(face_id)
+        # A shared EmbeddingStore already has the rows other workers appended
+        if current is None or float(current @ vector) < 0.9999:
+            gallery.add(face_id, vector)
+    with _synced_lock:
+        _synced[gallery] = (max(last_id, created[-1][0] if created else 0), now)
+
+def configured_clusterer() -> FaceClusterer:
+    """The process-wide face clusterer with the current app's thresholds"""
+    clusterer = get_clusterer()
+    clusterer.configure(current_app.config)
+    return clusterer
+
+# Advisory lock key shared by every worker; any constant will do
+CLUSTER_LOCK_KEY = 0x66616365
+
+def _cluster_lock():
+    """
+    The statement that takes the cluster lock until the transaction ends.
+    SQLite has no row locks, so a no-op UPDATE starts the write transaction
+    and holds the database write lock; PostgreSQL takes a transaction-level
+    advisory lock. Raises RuntimeError for any other database rather than
+    clustering without mutual exclusion.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return update(FaceCluster).where(false()).values(size=FaceCluster.size) \
+            .execution_options(synchronize_session=False)
+    if dialect == 'postgresql':
+        return select(func.pg_advisory_xact_lock(CLUSTER_LOCK_KEY))
+    raise RuntimeError(f"Face clustering needs SQLite or PostgreSQL, not {dialect}")
+
+def _lock_clusters() -> None:
+    """
+    Take the cluster lock before reading any cluster, so no other worker
+    or thread assigns to or merges away the clusters read meanwhile
+    """
+    db.session.execute(_cluster_lock())
+
+def _face_area(location):
+    return (location.get('right', 0) - location.get('left', 0)) * (location.get('bottom', 0) - location.get('top', 0))
+
+def cluster_photo_faces(image_path, rows):
+    """
+    Assign the unclustered faces of one photo, as (FaceEntryFeatures,
+    face_location) pairs, to Face clusters, creating a Face for each face
+    that matches none. Unlinked photos are linked to the cluster of their
+    largest face. Returns the touched face ids; the caller commits, which
+    releases the cluster lock taken here.
+    """
+    # Loading the gallery can take a while; do it before locking and
+    # catch up only on the clusters other workers touched meanwhile
+    gallery = loaded_gallery()
+    _lock_clusters()
+    _catch_up(gallery)
+    # Another worker may have clustered some of them since they were read
+    pending = {entry_id for entry_id, in db.session.query(FaceEntryFeatures.entry_id).filter(
+        FaceEntryFeatures.entry_id.in_([features.entry_id for features, _ in rows]),
+        FaceEntryFeatures.face_id.is_(None))}
+    rows = [(features, location) for features, location in rows if features.entry_id in pending]
+    
+    clusterer = configured_clusterer()
+    vectors = [features_to_vector(features.encoding) for features, _ in rows]
+    valid = [i for i, vector in enumerate(vectors) if vector is not None]
+    while True:
+        matches = dict(zip(valid, clusterer.assign(gallery, [vectors[i] for i in valid])))
+        matched_ids = [match[0] for match in matches.values() if match]
+        faces = {face.id: face for face in Face.query.filter(Face.id.in_(matched_ids))}
+        missing = set(matched_ids) - set(faces)
+        if not missing:
+            break
+        # Merged away by another worker
+        for face_id in missing:
+            gallery.remove(face_id)
+    clusters = {c.face_id: c for c in FaceCluster.query.filter(FaceCluster.face_id.in_(matched_ids))}
+    
+    new_faces = []
+    for i in valid:
+        features, _ = rows[i]
+        match = matches[i]
+        face = faces.get(match[0]) if match else None
+        mean = centroid_from_encoding(face.encoding, face.id in clusters) if face is not None else None
+        if mean is None:
+            # Start a new cluster around this face
+            face = Face(encoding=encode_centroid(vectors[i]))
+            new_faces.append((face, features))
+            continue
+        cluster = clusters.get(face.id)
+        if cluster is None:
+            cluster = clusters[face.id] = FaceCluster(face_id=face.id, size=1)
+            db.session.add(cluster)
+        face.encoding = encode_centroid(FaceClusterer.add_member(mean, cluster.size, vectors[i]))
+        cluster.size += 1
+        features.face_id = face.id
+        features.similarity = match[1]
+    
+    if new_faces:
+        db.session.add_all(face for face, _ in new_faces)
+        db.session.flush()
+        for face, features in new_faces:
+            db.session.add(FaceCluster(face_id=face.id, size=1))
+            features.face_id = face.id
+            features.similarity = 1.0
+    
+    assigned = [(features, location) for features, location in rows if features.face_id is not None]
+    if assigned:
+        photo = Photo.query.filter_by(filepath=image_path, face_id=None).order_by(Photo.id.desc()).first()
+        if photo is not None:
+            photo.face_id = max(assigned, key=lambda pair: _face_area(pair[1]))[0].face_id
+    return [features.face_id for features, _ in assigned]
+
+def cluster_faces(entry_ids=None, batch_size=500):
+    """
+    Cluster detections that have not been assigned yet, committing one
+    photo at a time so each photo sees the clusters created before it.
+    A photo that fails is rolled back and left for a later run.
+    Returns the touched face ids; raises RuntimeError up front on a
+    database the cluster lock does not support.
+    """
+    _cluster_lock()
+    touched = []
+    last_id = 0
+    while True:
+        query = db.session.query(FaceEntryFeatures, FaceEntry.image_path, FaceEntry.face_location) \
+            .join(FaceEntry, FaceEntry.id == FaceEntryFeatures.entry_id) \
+            .filter(FaceEntryFeatures.face_id.is_(None), FaceEntryFeatures.entry_id > last_id)
+        if entry_ids is not None:
+            query = query.filter(FaceEntryFeatures.entry_id.in_(entry_ids))
+        batch = query.order_by(FaceEntryFeatures.entry_id).limit(batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1][0].entry_id
+        
+        photos = {}
+        for features, image_path, location in batch:
+            photos.setdefault(image_path, []).append((features, location))
+        for image_path, rows in photos.items():
+            try:
+                touched.extend(cluster_photo_faces(image_path, rows))
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Error clustering faces of {image_path}: {str(e)}")
+                db.session.rollback()
+    return touched
+
+def merge_clusters(face_ids):
+    """
+    Merge each of the given clusters into its nearest cluster when their
+    centroids are similar enough. Labelled faces (named or linked to a
+    contact) and faces not created by clustering are never absorbed.
+    Each merge re-reads both clusters under the cluster lock and commits
+    on its own. Returns the number of merged clusters.
+    """
+    merged = {}
+    
+    def resolve(face_id):
+        while face_id in merged:
+            face_id = merged[face_id]
+        return face_id
+    
+    for face_id, other_id, score in configured_clusterer().merge_candidates(loaded_gallery(), face_ids):
+        face_id, other_id = resolve(face_id), resolve(other_id)
+        if face_id == other_id:
+            continue
+        _lock_clusters()
+        faces = {face.id: face for face in Face.query.filter(Face.id.in_([face_id, other_id]))}
+        clusters = {c.face_id: c for c in FaceCluster.query.filter(FaceCluster.face_id.in_([face_id, other_id]))}
+        if len(faces) < 2:
+            db.session.rollback()
+            continue
+        
+        def absorbable(face):
+            return face.id in clusters and face.name is None and face.contact_id is None
+        
+        def size(face):
+            return clusters[face.id].size if face.id in clusters else 1
+        
+        # Keep the labelled or the larger cluster
+        keep, gone = sorted(faces.values(), key=lambda face: (absorbable(face), -size(face)))
+        keep_mean = centroid_from_encoding(keep.encoding, keep.id in clusters)
+        gone_mean = centroid_from_encoding(gone.encoding, True)
+        if not absorbable(gone) or keep_mean is None or gone_mean is None:
+            db.session.rollback()
+            continue
+        
+        keep_size = size(keep)
+        keep.encoding = encode_centroid(FaceClusterer.merge_means(keep_mean, keep_size, gone_mean, clusters[gone.id].size))
+        if keep.id not in clusters:
+            clusters[keep.id] = FaceCluster(face_id=keep.id, size=1)
+            db.session.add(clusters[keep.id])
+        clusters[keep.id].size = keep_size + clusters[gone.id].size
+        
+        FaceEntryFeatures.query.filter_by(face_id=gone.id).update({'face_id': keep.id}, synchronize_session=False)
+        Photo.query.filter_by(face_id=gone.id).update({'face_id': keep.id}, synchronize_session=False)
+        db.session.delete(clusters[gone.id])
+        db.session.delete(gone)
+        db.session.commit()
+        merged[gone.id] = keep.id
+        logger.info(f"Merged face cluster {gone.id} into {keep.id} (similarity {score:.3f})")
+    return len(merged)
+
+def cluster_detection(entry_ids):
+    """
+    Cluster the faces of a freshly stored detection. Clustering problems
+    never fail the detection; the faces stay pending for the next run.
+    Every CLUSTER_MERGE_INTERVAL assignments a merge pass is started in
+    the background.
+    """
+    if not entry_ids or not current_app.config.get('CLUSTER_ON_DETECT', True):
+        return {}
+    try:
+        touched = cluster_faces(entry_ids)
+    except Exception as e:
+        logger.error(f"Error clustering faces: {str(e)}")
+        db.session.rollback()
+        return {}
+    if configured_clusterer().note_assigned(touched):
+        app = current_app._get_current_object()
+        threading.Thread(target=_merge_in_background, args=(app,), daemon=True).start()
+    return dict(db.session.query(FaceEntryFeatures.entry_id, FaceEntryFeatures.face_id)
+                .filter(FaceEntryFeatures.entry_id.in_(entry_ids)))
+
+def _merge_in_background(app):
+    clusterer = get_clusterer()
+    try:
+        with app.app_context():
+            merged = merge_clusters(clusterer.take_touched())
+            logger.info(f"Cluster merge pass finished, {merged} clusters merged")
+    except Exception:
+        logger.exception("Cluster merge pass failed")
+    finally:
+        clusterer.merge_finished()
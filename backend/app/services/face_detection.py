@@ -1,111 +1,633 @@
 import cv2
 import numpy as np
-from typing import Dict, List, Any
-from PIL import Image
+from typing import Dict, List, Any, Optional, Sequence, Tuple, Union
+from PIL import Image, ImageOps
 import os
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import base64
+import hashlib
+import io
 import json
+import logging
+import struct
+import threading
 
-# Initialize encryption key - in production, this should be stored securely
-ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', Fernet.generate_key())
-cipher_suite = Fernet(ENCRYPTION_KEY)
+from .detection_cache import get_detection_cache
+from .metrics import stage
+
+logger = logging.getLogger('face_detection')
+
+# Encryption key - in production, this should be stored securely. The
+# ciphers are built on first use, not at import.
+ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY')
+
+# Face features are stored in a compact versioned binary format:
+#   header (magic, version, dtype code, element count) | 12-byte nonce | AES-GCM ciphertext + tag
+# The header is authenticated as associated data. The key is derived from
+# ENCRYPTION_KEY so existing deployments need no new secret.
+FEATURES_MAGIC = b'\xfa\xce'
+FEATURES_VERSION = 2
+_FEATURES_HEADER = struct.Struct('>2sBBI')
+_FEATURES_NONCE_SIZE = 12
+_FEATURES_DTYPES = {0: np.dtype(np.uint8), 1: np.dtype('<f2')}
+_FEATURES_DTYPE_CODES = {dtype: code for code, dtype in _FEATURES_DTYPES.items()}
+
+_ciphers: Optional[Tuple[Fernet, AESGCM]] = None
+_ciphers_lock = threading.Lock()
+_ephemeral_key = False
+
+def get_ciphers() -> Tuple[Fernet, AESGCM]:
+    """
+    The Fernet cipher for legacy blobs and the AES-GCM cipher for face
+    features. Without ENCRYPTION_KEY a key is generated for this process
+    only; call this before forking workers so they share it.
+    """
+    global _ciphers, _ephemeral_key, ENCRYPTION_KEY
+    if _ciphers is None:
+        with _ciphers_lock:
+            if _ciphers is None:
+                if not ENCRYPTION_KEY:
+                    logger.warning('ENCRYPTION_KEY is not set; using a key that only this process knows')
+                    ENCRYPTION_KEY = Fernet.generate_key()
+                    _ephemeral_key = True
+                _ciphers = (Fernet(ENCRYPTION_KEY), AESGCM(HKDF(
+                    algorithm=hashes.SHA256(),
+                    length=32,
+                    salt=None,
+                    info=b'facefund-face-features-v2'
+                ).derive(base64.urlsafe_b64decode(ENCRYPTION_KEY))))
+    return _ciphers
+
+def features_key_id() -> str:
+    """Short fingerprint of the features key; cached ciphertexts are only reused under the same key"""
+    get_ciphers()
+    key = ENCRYPTION_KEY.encode() if isinstance(ENCRYPTION_KEY, str) else ENCRYPTION_KEY
+    return hashlib.sha256(key).hexdigest()[:12]
 
 def encrypt_data(data: dict) -> str:
     """Encrypt sensitive data"""
     json_data = json.dumps(data)
-    encrypted_data = cipher_suite.encrypt(json_data.encode())
+    encrypted_data = get_ciphers()[0].encrypt(json_data.encode())
     return base64.b64encode(encrypted_data).decode()
 
 def decrypt_data(encrypted_data: str) -> dict:
     """Decrypt sensitive data"""
     try:
         encrypted_bytes = base64.b64decode(encrypted_data.encode())
-        decrypted_data = cipher_suite.decrypt(encrypted_bytes)
+        decrypted_data = get_ciphers()[0].decrypt(encrypted_bytes)
         return json.loads(decrypted_data)
     except Exception as e:
         print(f"Error decrypting data: {e}")
         return {}
 
-def detect_faces(image_path: str) -> Dict[str, Any]:
-    """
-    Detect faces in an image using OpenCV's cascade classifier
-    """
-    # Load the pre-trained face detection classifier
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    
-    # Read the image
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError("Failed to load image")
-    
-    # Convert to grayscale for face detection
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    # Detect faces
-    faces = face_cascade.detectMultiScale(
-        gray,
-        scaleFactor=1.1,
-        minNeighbors=5,
-        minSize=(30, 30)
-    )
-    
-    # Process results
-    face_list = []
-    for (x, y, w, h) in faces:
-        face_location = {
-            "left": int(x),
-            "top": int(y),
-            "right": int(x + w),
-            "bottom": int(y + h)
-        }
-        
-        # Extract the face region for feature extraction
-        face_roi = gray[y:y+h, x:x+w]
-        
-        # Basic feature extraction (you might want to use a more sophisticated method)
-        face_features = cv2.resize(face_roi, (64, 64)).flatten().tolist()
-        
-        face_dict = {
-            "location": face_location,
-            "features": encrypt_data({"features": face_features})
+def encode_features(features: Any, dtype: Any = np.uint8) -> bytes:
+    """
+    Encrypt a feature vector into the compact binary format.
+    Use dtype=np.float16 for real-valued embeddings.
+    """
+    vector = np.ascontiguousarray(np.asarray(features).ravel(), dtype=np.dtype(dtype).newbyteorder('<'))
+    code = _FEATURES_DTYPE_CODES.get(vector.dtype)
+    if code is None:
+        raise ValueError(f"Unsupported feature dtype: {vector.dtype}")
+    header = _FEATURES_HEADER.pack(FEATURES_MAGIC, FEATURES_VERSION, code, vector.size)
+    nonce = os.urandom(_FEATURES_NONCE_SIZE)
+    return header + nonce + get_ciphers()[1].encrypt(nonce, vector.tobytes(), header)
+
+def encrypt_features(features: Any, dtype: Any = np.uint8) -> str:
+    """Encrypt a feature vector for JSON transport (a single base64 pass)"""
+    return base64.b64encode(encode_features(features, dtype)).decode()
+
+def is_legacy_features(blob: Any) -> bool:
+    """Return True if blob uses the old JSON + Fernet + double base64 format"""
+    if isinstance(blob, str):
+        try:
+            blob = base64.b64decode(blob.encode())
+        except Exception:
+            return True
+    return not bytes(blob[:2]) == FEATURES_MAGIC
+
+def decrypt_features(blob: Any) -> np.ndarray:
+    """
+    Decrypt a feature vector from either the binary format (raw bytes or
+    base64 text) or the legacy JSON format. Raises ValueError if invalid.
+    """
+    if isinstance(blob, str):
+        try:
+            data = base64.b64decode(blob.encode())
+        except Exception:
+            raise ValueError("Invalid feature encoding")
+    else:
+        data = bytes(blob)
+
+    if data[:2] != FEATURES_MAGIC:
+        features = decrypt_data(blob if isinstance(blob, str) else data.decode()).get('features')
+        if features is None:
+            raise ValueError("Invalid feature encoding")
+        return np.asarray(features, dtype=np.uint8)
+
+    if len(data) < _FEATURES_HEADER.size + _FEATURES_NONCE_SIZE:
+        raise ValueError("Truncated feature encoding")
+    header = data[:_FEATURES_HEADER.size]
+    _, version, code, count = _FEATURES_HEADER.unpack(header)
+    if version != FEATURES_VERSION or code not in _FEATURES_DTYPES:
+        raise ValueError(f"Unsupported feature encoding version {version}")
+    nonce = data[_FEATURES_HEADER.size:_FEATURES_HEADER.size + _FEATURES_NONCE_SIZE]
+    try:
+        raw = get_ciphers()[1].decrypt(nonce, data[_FEATURES_HEADER.size + _FEATURES_NONCE_SIZE:], header)
+    except Exception:
+        raise ValueError("Feature encoding failed authentication")
+    vector = np.frombuffer(raw, dtype=_FEATURES_DTYPES[code])
+    if vector.size != count:
+        raise ValueError("Feature encoding has the wrong length")
+    return vector
+
+# Bump whenever a change to FaceDetector alters its results, so cached
+# results of the previous version are no longer served
+DETECTOR_VERSION = 2
+
+HAAR_CASCADE = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+def _file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+class CascadeBackend:
+    """
+    Viola-Jones cascade detector: OpenCV's Haar frontal-face cascade by
+    default, or an LBP cascade, which trades some recall for several times
+    the speed on CPU. The classifier is loaded once per thread.
+    """
+
+    def __init__(self, name: str = 'haar', cascade_path: Optional[str] = None, scale_factor: float = 1.1,
+                 min_neighbors: int = 5, min_size: Tuple[int, int] = (30, 30)):
+        self.name = name
+        self.cascade_path = cascade_path or HAAR_CASCADE
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self._local = threading.local()
+
+    @property
+    def fingerprint(self) -> str:
+        return (f"{self.name}:cascade={_file_digest(self.cascade_path)}:scaleFactor={self.scale_factor}:"
+                f"minNeighbors={self.min_neighbors}:minSize={self.min_size[0]}x{self.min_size[1]}")
+
+    def _get_classifier(self) -> cv2.CascadeClassifier:
+        """Return this thread's classifier, loading it on first use"""
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = cv2.CascadeClassifier(self.cascade_path)
+            if classifier.empty():
+                raise ValueError(f"Failed to load face cascade: {self.cascade_path}")
+            self._local.classifier = classifier
+        return classifier
+
+    def detect(self, gray: np.ndarray) -> np.ndarray:
+        """Run the cascade and return (x, y, w, h) boxes"""
+        faces = self._get_classifier().detectMultiScale(
+            gray,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=self.min_size
+        )
+        return np.asarray(faces, dtype=np.int64).reshape(-1, 4)
+
+class DnnBackend:
+    """
+    OpenCV DNN detector for an SSD face model loaded from local files, such
+    as the res10 300x300 Caffe model (deploy.prototxt plus weights). Slower
+    than the cascades, but it finds rotated, profile and small faces they
+    miss. The pipeline decodes grayscale, so the image is fed to the network
+    with the gray channel repeated. One network is loaded per thread.
+    """
+
+    def __init__(self, model_path: str, config_path: Optional[str] = None, confidence: float = 0.5,
+                 input_size: int = 300, min_size: Tuple[int, int] = (30, 30)):
+        self.name = 'dnn'
+        self.model_path = model_path
+        self.config_path = config_path
+        self.confidence = confidence
+        self.input_size = input_size
+        self.min_size = min_size
+        self._local = threading.local()
+
+    @property
+    def fingerprint(self) -> str:
+        config = _file_digest(self.config_path) if self.config_path else None
+        return (f"dnn:model={_file_digest(self.model_path)}:config={config}:confidence={self.confidence}:"
+                f"inputSize={self.input_size}:minSize={self.min_size[0]}x{self.min_size[1]}")
+
+    def _get_net(self) -> 'cv2.dnn.Net':
+        """Return this thread's network, loading it on first use"""
+        net = getattr(self._local, 'net', None)
+        if net is None:
+            try:
+                net = cv2.dnn.readNet(self.model_path, self.config_path or '')
+            except cv2.error as e:
+                raise ValueError(f"Failed to load face detection model {self.model_path}: {e}")
+            self._local.net = net
+        return net
+
+    def detect(self, gray: np.ndarray) -> np.ndarray:
+        """Run the network and return (x, y, w, h) boxes above the confidence threshold"""
+        height, width = gray.shape[:2]
+        blob = cv2.dnn.blobFromImage(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), 1.0,
+                                     (self.input_size, self.input_size), (104.0, 177.0, 123.0))
+        net = self._get_net()
+        net.setInput(blob)
+        # SSD output: [1, 1, N, 7] rows of (image, class, confidence, x1, y1, x2, y2), coordinates in 0..1
+        detections = net.forward().reshape(-1, 7)
+        detections = detections[detections[:, 2] >= self.confidence]
+        corners = np.clip(detections[:, 3:7], 0, 1) * np.array([width, height, width, height], dtype=np.float32)
+        boxes = np.round(corners).astype(np.int64)
+        boxes[:, 2:] -= boxes[:, :2]
+        keep = (boxes[:, 2] >= self.min_size[0]) & (boxes[:, 3] >= self.min_size[1])
+        return boxes[keep].reshape(-1, 4)
+
+class FaceDetector:
+    """
+    Reusable face detection engine around a detector backend (a Haar
+    cascade unless another backend is given).
+
+    The backend's model is loaded once per thread and kept for the
+    lifetime of the process, so callers no longer pay for parsing it on
+    every detection.
+
+    When max_dimension is set, detection runs on a copy of the image whose
+    long edge is at most that many pixels and the face boxes are mapped back
+    to original coordinates. Feature crops always come from the original
+    resolution. Faces smaller than min_size in the reduced image are missed.
+    """
+
+    def __init__(self, cascade_path: Optional[str] = None, scale_factor: float = 1.1,
+                 min_neighbors: int = 5, min_size: Tuple[int, int] = (30, 30),
+                 max_dimension: Optional[int] = None, backend: Optional[Any] = None):
+        self.backend = backend or CascadeBackend('haar', cascade_path, scale_factor, min_neighbors, min_size)
+        self.name = self.backend.name
+        self.max_dimension = max_dimension or None
+        self._fingerprint: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        """Everything besides the image that determines a detection result"""
+        if self._fingerprint is None:
+            self._fingerprint = (f"v{DETECTOR_VERSION}:{self.backend.fingerprint}:"
+                                 f"maxDimension={self.max_dimension}:key={features_key_id()}")
+        return self._fingerprint
+
+    def warmup(self) -> None:
+        """Load the backend's model and run one detection so the first request is not slow"""
+        self.detect(np.zeros((64, 64), dtype=np.uint8))
+
+    def _detect_boxes(self, gray: np.ndarray) -> np.ndarray:
+        """Run the backend and return (x, y, w, h) boxes"""
+        return self.backend.detect(gray)
+
+    def _shrink(self, gray: np.ndarray) -> np.ndarray:
+        """Resize gray so its long edge is at most max_dimension"""
+        long_edge = max(gray.shape[:2])
+        if not self.max_dimension or long_edge <= self.max_dimension:
+            return gray
+        ratio = self.max_dimension / long_edge
+        size = (max(1, round(gray.shape[1] * ratio)), max(1, round(gray.shape[0] * ratio)))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _map_boxes(boxes: np.ndarray, small_shape: Tuple[int, ...], full_shape: Tuple[int, ...]) -> np.ndarray:
+        """Map boxes found on a reduced image back to full-resolution pixels"""
+        if small_shape[:2] == full_shape[:2] or not len(boxes):
+            return boxes
+        sx = full_shape[1] / small_shape[1]
+        sy = full_shape[0] / small_shape[0]
+        mapped = np.empty_like(boxes)
+        mapped[:, 0] = np.floor(boxes[:, 0] * sx)
+        mapped[:, 1] = np.floor(boxes[:, 1] * sy)
+        mapped[:, 2] = np.minimum(np.ceil((boxes[:, 0] + boxes[:, 2]) * sx), full_shape[1]) - mapped[:, 0]
+        mapped[:, 3] = np.minimum(np.ceil((boxes[:, 1] + boxes[:, 3]) * sy), full_shape[0]) - mapped[:, 1]
+        return mapped
+
+    def _build_result(self, boxes: np.ndarray, gray: np.ndarray) -> Dict[str, Any]:
+        """Extract features for each box from the full-resolution image"""
+        face_list = []
+        for (x, y, w, h) in boxes:
+            face_location = {
+                "left": int(x),
+                "top": int(y),
+                "right": int(x + w),
+                "bottom": int(y + h)
+            }
+
+            # Extract the face region for feature extraction
+            face_roi = gray[y:y+h, x:x+w]
+
+            # Basic feature extraction (you might want to use a more sophisticated method)
+            with stage('detect.features'):
+                face_features = cv2.resize(face_roi, (64, 64)).ravel()
+
+            with stage('detect.encrypt'):
+                encrypted = encrypt_features(face_features)
+            face_dict = {
+                "location": face_location,
+                "features": encrypted
+            }
+            face_list.append(face_dict)
+
+        return {
+            "num_faces": len(face_list),
+            "faces": face_list,
+            "detector": self.name
         }
-        face_list.append(face_dict)
-    
-    return {
-        "num_faces": len(face_list),
-        "faces": face_list
-    }
+
+    def detect(self, image: np.ndarray) -> Dict[str, Any]:
+        """
+        Detect faces in a decoded BGR or grayscale image
+        """
+        # Convert to grayscale for face detection
+        if image.ndim == 3:
+            with stage('detect.cvtcolor'):
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+
+        with stage('detect.resize'):
+            small = self._shrink(gray)
+        with stage('detect.cascade'):
+            boxes = self._map_boxes(self._detect_boxes(small), small.shape, gray.shape)
+        return self._build_result(boxes, gray)
+
+    def _reduced_decode_flag(self, data: bytes) -> int:
+        """Pick the strongest reduced grayscale decode that keeps the long edge above max_dimension"""
+        try:
+            with Image.open(io.BytesIO(data)) as header:
+                long_edge = max(header.size)
+        except Exception:
+            return cv2.IMREAD_GRAYSCALE
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                             (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                             (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if long_edge // factor >= self.max_dimension:
+                return flag
+        return cv2.IMREAD_GRAYSCALE
+
+    def detect_bytes(self, data: bytes, content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Detect faces in an encoded image buffer, through the detection cache
+        when one is configured. content_hash is the buffer's SHA-256, if
+        the caller already has it.
+        """
+        cache = get_detection_cache()
+        if cache is None or self._uncacheable():
+            return self._detect_encoded(data)
+        key = cache.key(content_hash or hashlib.sha256(data).hexdigest(), self.fingerprint)
+        with stage('detect.cache'):
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+        result = self._detect_encoded(data)
+        with stage('detect.cache'):
+            cache.put(key, self.fingerprint, result)
+        return result
+
+    @staticmethod
+    def _uncacheable() -> bool:
+        # Features encrypted under a process-local key are useless to other processes
+        get_ciphers()
+        return _ephemeral_key
+
+    def _detect_encoded(self, data: bytes) -> Dict[str, Any]:
+        """
+        Decode an encoded image buffer and detect faces in it. With
+        max_dimension set, detection runs on a reduced decode and the full
+        image is only decoded when there are faces to crop.
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        if not self.max_dimension:
+            with stage('detect.decode'):
+                gray = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
+                raise ValueError("Failed to load image")
+            return self.detect(gray)
+
+        boxes, small, reduced, flag = self._reduced_boxes(data)
+        if not len(boxes):
+            return {"num_faces": 0, "faces": [], "detector": self.name}
+
+        with stage('detect.decode_full'):
+            gray = reduced if flag == cv2.IMREAD_GRAYSCALE else cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError("Failed to load image")
+        return self._build_result(self._map_boxes(boxes, small.shape, gray.shape), gray)
+
+    def _reduced_boxes(self, data: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """(boxes, the shrunk image they were found on, the reduced decode, its imdecode flag)"""
+        with stage('detect.decode'):
+            flag = self._reduced_decode_flag(data)
+            reduced = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+        if reduced is None:
+            raise ValueError("Failed to load image")
+        with stage('detect.resize'):
+            small = self._shrink(reduced)
+        with stage('detect.cascade'):
+            boxes = self._detect_boxes(small)
+        return boxes, small, reduced, flag
+
+    def count_faces(self, data: bytes, content_hash: Optional[str] = None) -> int:
+        """
+        Number of faces in an encoded image buffer. Only the boxes are
+        computed; there is no full decode, feature crop or encryption.
+        With a detection cache, a cached detection or count is reused and
+        new counts are cached under their own key.
+        """
+        cache = get_detection_cache()
+        if cache is None:
+            return self._count_boxes(data)
+        content_hash = content_hash or hashlib.sha256(data).hexdigest()
+        count_key = cache.key(content_hash, f"{self.fingerprint}|count")
+        with stage('detect.cache'):
+            cached = None if self._uncacheable() else cache.get(cache.key(content_hash, self.fingerprint))
+            cached = cached or cache.get(count_key)
+        if cached is not None:
+            return cached['num_faces']
+        num_faces = self._count_boxes(data)
+        with stage('detect.cache'):
+            cache.put(count_key, self.fingerprint, {'num_faces': num_faces})
+        return num_faces
+
+    def _count_boxes(self, data: bytes) -> int:
+        if self.max_dimension:
+            return len(self._reduced_boxes(data)[0])
+        with stage('detect.decode'):
+            gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError("Failed to load image")
+        with stage('detect.cascade'):
+            return len(self._detect_boxes(gray))
+
+    def detect_path(self, image_path: str, content_hash: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Read an image from disk and detect faces in it
+        """
+        try:
+            with stage('detect.read'), open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            raise ValueError("Failed to load image")
+        return self.detect_bytes(data, content_hash)
+
+
+def configured_backends() -> Dict[str, Any]:
+    """
+    The detector backends this deployment can run, by name. Haar is always
+    available. LBP needs FACE_DETECTION_LBP_CASCADE, because the pip OpenCV
+    wheels do not ship the LBP cascades. DNN needs FACE_DETECTION_DNN_MODEL,
+    plus FACE_DETECTION_DNN_CONFIG for formats that keep the graph separately.
+    """
+    backends = {'haar': CascadeBackend('haar')}
+    lbp_cascade = os.environ.get('FACE_DETECTION_LBP_CASCADE')
+    if lbp_cascade:
+        backends['lbp'] = CascadeBackend('lbp', lbp_cascade)
+    dnn_model = os.environ.get('FACE_DETECTION_DNN_MODEL')
+    if dnn_model:
+        backends['dnn'] = DnnBackend(
+            dnn_model,
+            os.environ.get('FACE_DETECTION_DNN_CONFIG') or None,
+            confidence=float(os.environ.get('FACE_DETECTION_DNN_CONFIDENCE', 0.5))
+        )
+    for name, backend in list(backends.items()):
+        paths = [getattr(backend, attr, None) for attr in ('cascade_path', 'model_path', 'config_path')]
+        missing = [path for path in paths if path and not os.path.isfile(path)]
+        if missing:
+            logger.error(f"Face detector '{name}' is disabled; missing file {missing[0]}")
+            del backends[name]
+    return backends
+
+def default_detector_name() -> str:
+    return os.environ.get('FACE_DETECTION_BACKEND', 'haar')
+
+_detectors: Optional[Dict[str, FaceDetector]] = None
+_detector_lock = threading.Lock()
+
+def _load_detectors() -> Dict[str, FaceDetector]:
+    global _detectors
+    if _detectors is None:
+        with _detector_lock:
+            if _detectors is None:
+                max_dimension = int(os.environ.get('FACE_DETECTION_MAX_DIMENSION', 1280))
+                detectors = {name: FaceDetector(max_dimension=max_dimension, backend=backend)
+                             for name, backend in configured_backends().items()}
+                cache = get_detection_cache()
+                if cache is not None and not FaceDetector._uncacheable():
+                    # Results of earlier detector settings can never be hit again
+                    cache.retain([detector.fingerprint for detector in detectors.values()])
+                _detectors = detectors
+    return _detectors
+
+def available_detectors() -> List[str]:
+    """Names of the detector backends get_detector accepts"""
+    return list(_load_detectors())
+
+def get_detector(name: Optional[str] = None) -> FaceDetector:
+    """
+    Return the process-wide face detector for a backend, the deployment's
+    FACE_DETECTION_BACKEND by default. Raises ValueError for a backend that
+    is unknown or not configured.
+    """
+    detectors = _load_detectors()
+    name = name or default_detector_name()
+    detector = detectors.get(name)
+    if detector is None:
+        raise ValueError(f"Unknown face detector '{name}'; available: {', '.join(detectors)}")
+    return detector
+
+def detect_faces(image_path: str, detector: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Detect faces in an image with the named detector backend
+    """
+    return get_detector(detector).detect_path(image_path)
 
 def crop_face(image_path: str, face_location: dict) -> Image:
     """
-    Crop a face from an image given its location
+    Crop a face from an image given its location. Face boxes come from
+    OpenCV, which applies the EXIF orientation when decoding, so the image
+    is turned the same way before cropping.
     """
-    image = Image.open(image_path)
     top = face_location.get('top', 0)
     right = face_location.get('right', 0)
     bottom = face_location.get('bottom', 0)
     left = face_location.get('left', 0)
-    face_image = image.crop((left, top, right, bottom))
-    return face_image
+    with Image.open(image_path) as image:
+        return ImageOps.exif_transpose(image).crop((left, top, right, bottom))
+
+def _feature_matrix(features: Sequence[Any], cache: Dict[Any, np.ndarray]) -> np.ndarray:
+    """Decrypt feature blobs once and stack them as unit-length float32 rows"""
+    rows = []
+    for item in features:
+        if isinstance(item, (str, bytes)):
+            vector = cache.get(item)
+            if vector is None:
+                vector = cache[item] = decrypt_features(item)
+        else:
+            vector = np.asarray(item).ravel()
+        rows.append(vector)
+    if not rows:
+        return np.empty((0, 0), dtype=np.float32)
+    try:
+        matrix = np.vstack(rows).astype(np.float32)
+    except ValueError:
+        raise ValueError("Feature vectors have different lengths")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def compare_many(queries: Sequence[Any], candidates: Sequence[Any], threshold: Optional[float] = None,
+                 max_chunk_elements: int = 4 * 1024 * 1024) -> Union[np.ndarray, List[Tuple[int, int, float]]]:
+    """
+    Compare every query face against every candidate face using cosine similarity.
+
+    Without a threshold, returns the len(queries) x len(candidates) similarity
+    matrix. With a threshold, returns (query_index, candidate_index, similarity)
+    tuples for pairs above it, without materializing the full matrix. Work
+    larger than max_chunk_elements scores is split into query chunks.
+    """
+    cache: Dict[Any, np.ndarray] = {}
+    query_matrix = _feature_matrix(queries, cache)
+    candidate_matrix = _feature_matrix(candidates, cache)
+    if len(query_matrix) and len(candidate_matrix) and query_matrix.shape[1] != candidate_matrix.shape[1]:
+        raise ValueError("Query and candidate feature vectors have different lengths")
+
+    chunk_rows = max(1, max_chunk_elements // max(1, len(candidate_matrix)))
+    candidate_t = candidate_matrix.T
+
+    if threshold is None:
+        similarity = np.empty((len(query_matrix), len(candidate_matrix)), dtype=np.float32)
+        if not similarity.size:
+            pass
+        elif similarity.size <= max_chunk_elements:
+            np.matmul(query_matrix, candidate_t, out=similarity)
+        else:
+            for start in range(0, len(query_matrix), chunk_rows):
+                stop = start + chunk_rows
+                np.matmul(query_matrix[start:stop], candidate_t, out=similarity[start:stop])
+        return similarity
+
+    matches = []
+    if not len(query_matrix) or not len(candidate_matrix):
+        return matches
+    for start in range(0, len(query_matrix), chunk_rows):
+        scores = query_matrix[start:start + chunk_rows] @ candidate_t
+        rows, cols = np.nonzero(scores > threshold)
+        matches.extend(zip((rows + start).tolist(), cols.tolist(), scores[rows, cols].tolist()))
+    return matches
 
 def compare_faces(face1_features: str, face2_features: str, threshold: float = 0.6) -> bool:
     """
     Compare two face feature sets and determine if they match
     """
     try:
-        # Decrypt the encrypted feature data
-        features1 = decrypt_data(face1_features)["features"]
-        features2 = decrypt_data(face2_features)["features"]
-        
-        # Convert to numpy arrays for comparison
-        features1 = np.array(features1)
-        features2 = np.array(features2)
-        
-        # Calculate similarity (using cosine similarity)
-        similarity = np.dot(features1, features2) / (np.linalg.norm(features1) * np.linalg.norm(features2))
-        
-        return similarity > threshold
+        return bool(compare_many([face1_features], [face2_features])[0, 0] > threshold)
     except Exception as e:
         print(f"Error comparing faces: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,247 @@
+import logging
+import threading
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .face_detection import decrypt_features
+
+logger = logging.getLogger('face_detection')
+
+def features_to_vector(encoding: Any) -> Optional[np.ndarray]:
+    """
+    Turn a stored face encoding into a unit-length float32 vector.
+    Accepts an encrypted feature blob in any supported format or a raw sequence.
+    """
+    if encoding is None:
+        return None
+    if isinstance(encoding, (str, bytes)):
+        try:
+            encoding = decrypt_features(encoding)
+        except ValueError:
+            return None
+    vector = np.asarray(encoding, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    if vector.size == 0 or norm == 0:
+        return None
+    return vector / norm
+
+class FaceGallery:
+    """
+    In-memory 1:N matcher over the known faces.
+
+    Every face encoding is kept as one row of a normalized float32 matrix,
+    so a top-k cosine query is a blocked matrix-vector product instead of
+    one decrypt and compare per face.
+    """
+
+    def __init__(self, block_size: int = 65536):
+        self.block_size = block_size
+        self._lock = threading.RLock()
+        self._matrix: Optional[np.ndarray] = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._rows = {}
+        self._size = 0
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def load(self, faces: Iterable[Tuple[int, Any]]) -> None:
+        """Replace the gallery contents with (face_id, encoding) pairs"""
+        ids = []
+        vectors = []
+        for face_id, encoding in faces:
+            vector = features_to_vector(encoding)
+            if vector is None:
+                continue
+            if vectors and vector.shape != vectors[0].shape:
+                logger.warning(f"Skipping face {face_id}: encoding has unexpected size {vector.size}")
+                continue
+            ids.append(face_id)
+            vectors.append(vector)
+
+        with self._lock:
+            self._matrix = np.vstack(vectors) if vectors else None
+            self._ids = np.asarray(ids, dtype=np.int64)
+            self._rows = {face_id: row for row, face_id in enumerate(ids)}
+            self._size = len(ids)
+            self.loaded = True
+        logger.info(f"Face gallery loaded with {self._size} faces")
+
+    def add(self, face_id: int, encoding: Any) -> bool:
+        """Add or replace the encoding of a face"""
+        vector = features_to_vector(encoding)
+        if vector is None:
+            self.remove(face_id)
+            return False
+
+        with self._lock:
+            if self._matrix is None:
+                self._matrix = np.empty((16, vector.size), dtype=np.float32)
+                self._ids = np.empty(16, dtype=np.int64)
+            elif vector.size != self._matrix.shape[1]:
+                logger.warning(f"Skipping face {face_id}: encoding has unexpected size {vector.size}")
+                return False
+
+            row = self._rows.get(face_id)
+            if row is None:
+                if self._size == self._matrix.shape[0]:
+                    # Grow geometrically so repeated adds stay amortized O(1)
+                    capacity = max(16, self._size * 2)
+                    matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+                    matrix[:self._size] = self._matrix[:self._size]
+                    ids = np.empty(capacity, dtype=np.int64)
+                    ids[:self._size] = self._ids[:self._size]
+                    self._matrix, self._ids = matrix, ids
+                row = self._size
+                self._size += 1
+                self._rows[face_id] = row
+                self._ids[row] = face_id
+            self._matrix[row] = vector
+        return True
+
+    def vector(self, face_id: int) -> Optional[np.ndarray]:
+        """Normalized vector of a face, or None if it is not in the gallery"""
+        with self._lock:
+            row = self._rows.get(face_id)
+            return None if row is None else self._matrix[row].copy()
+
+    def remove(self, face_id: int) -> bool:
+        """Remove a face by moving the last row into its slot"""
+        with self._lock:
+            row = self._rows.pop(face_id, None)
+            if row is None:
+                return False
+            last = self._size - 1
+            if row != last:
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = self._ids[last]
+                self._rows[int(self._ids[row])] = row
+            self._size = last
+        return True
+
+    def query(self, encoding: Any, k: int = 5, threshold: Optional[float] = None) -> List[Tuple[int, float]]:
+        """
+        Return up to k (face_id, cosine similarity) pairs, best match first
+        """
+        vector = features_to_vector(encoding)
+        if vector is None or k <= 0:
+            return []
+
+        with self._lock:
+            if not self._size or vector.size != self._matrix.shape[1]:
+                return []
+
+            best_ids = []
+            best_scores = []
+            for start in range(0, self._size, self.block_size):
+                stop = min(start + self.block_size, self._size)
+                scores = self._matrix[start:stop] @ vector
+                if scores.size > k:
+                    top = np.argpartition(scores, -k)[-k:]
+                else:
+                    top = np.arange(scores.size)
+                best_scores.append(scores[top])
+                best_ids.append(self._ids[start:stop][top])
+
+        scores = np.concatenate(best_scores)
+        ids = np.concatenate(best_ids)
+        order = np.argsort(-scores)[:k]
+        matches = [(int(ids[i]), float(scores[i])) for i in order]
+        if threshold is not None:
+            matches = [m for m in matches if m[1] >= threshold]
+        return matches
+
+    def query_many(self, encodings: List[Any], k: int = 5,
+                   threshold: Optional[float] = None) -> List[List[Tuple[int, float]]]:
+        """
+        query() for several encodings at once; each block of the gallery is
+        scored against all of them with one matrix product
+        """
+        vectors = [features_to_vector(encoding) for encoding in encodings]
+        results = [[] for _ in vectors]
+        with self._lock:
+            if not self._size or k <= 0:
+                return results
+            valid = [i for i, v in enumerate(vectors) if v is not None and v.size == self._matrix.shape[1]]
+            if not valid:
+                return results
+            queries = np.vstack([vectors[i] for i in valid])
+
+            best_ids = []
+            best_scores = []
+            for start in range(0, self._size, self.block_size):
+                stop = min(start + self.block_size, self._size)
+                scores = queries @ self._matrix[start:stop].T
+                if scores.shape[1] > k:
+                    top = np.argpartition(scores, -k, axis=1)[:, -k:]
+                else:
+                    top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+                best_scores.append(np.take_along_axis(scores, top, axis=1))
+                best_ids.append(self._ids[start:stop][top])
+
+        scores = np.concatenate(best_scores, axis=1)
+        ids = np.concatenate(best_ids, axis=1)
+        for row, i in enumerate(valid):
+            order = np.argsort(-scores[row])[:k]
+            results[i] = [(int(ids[row, j]), float(scores[row, j])) for j in order
+                          if threshold is None or scores[row, j] >= threshold]
+        return results
+
+
+_gallery = FaceGallery()
+
+def get_gallery() -> FaceGallery:
+    """Return the process-wide face gallery"""
+    return _gallery
+
+def _collect_face_changes(session, face_model) -> None:
+    from sqlalchemy import inspect
+
+    changes = session.info.setdefault('face_gallery_changes', {})
+    for obj in session.new:
+        if isinstance(obj, face_model):
+            changes[obj.id] = obj.encoding
+    for obj in session.dirty:
+        # Renames and contact links do not touch the vectors
+        if isinstance(obj, face_model) and inspect(obj).attrs.encoding.history.has_changes():
+            changes[obj.id] = obj.encoding
+    for obj in session.deleted:
+        if isinstance(obj, face_model):
+            changes[obj.id] = None
+
+def _apply_face_changes(session) -> None:
+    changes = session.info.pop('face_gallery_changes', None)
+    gallery = _synced_gallery
+    if not changes or gallery is None or not gallery.loaded:
+        return
+    for face_id, encoding in changes.items():
+        if encoding is None:
+            gallery.remove(face_id)
+        else:
+            gallery.add(face_id, encoding)
+
+def _discard_face_changes(session) -> None:
+    session.info.pop('face_gallery_changes', None)
+
+_sync_registered = False
+_synced_gallery = None
+
+def register_gallery_sync(session, face_model, gallery=None) -> None:
+    """
+    Keep a gallery (the process-wide one by default, or anything with the
+    same add/remove interface) in step with committed Face changes made
+    through session. Changes are collected at flush time and applied only
+    after commit.
+    """
+    global _sync_registered, _synced_gallery
+    _synced_gallery = gallery if gallery is not None else _gallery
+    if _sync_registered:
+        return
+    from sqlalchemy import event
+
+    event.listen(session, 'after_flush', lambda sess, ctx: _collect_face_changes(sess, face_model))
+    event.listen(session, 'after_commit', _apply_face_changes)
+    event.listen(session, 'after_rollback', _discard_face_changes)
+    _sync_registered = True
@@ -1,19 +1,107 @@
 import os
+import re
 import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+import logging
+from contextlib import contextmanager
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import hashlib
-from typing import Optional, Tuple
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+from .metrics import stage
+
+logger = logging.getLogger('file_storage')
+
+CHUNK_SIZE = 64 * 1024
+CONTENT_NAME_PATTERN = re.compile(r'^([0-9a-f]{64})(\.[a-z0-9]+)$')
+
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+IMAGE_TYPE_EXTENSIONS = {'jpeg': {'jpg', 'jpeg'}, 'png': {'png'}, 'gif': {'gif'}, 'bmp': {'bmp'}}
+# Content-addressed files are named with one extension per type, so a.jpg and a.jpeg share a file
+CANONICAL_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'gif': '.gif', 'bmp': '.bmp', 'webp': '.webp'}
+
+def sniff_image_type(data: bytes) -> Optional[str]:
+    """Identify an image format from its leading bytes"""
+    for signature, image_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+class UploadBuffer(NamedTuple):
+    data: bytes
+    content_hash: str
+    image_type: Optional[str]
+
+class StoredFile(NamedTuple):
+    filename: str
+    filepath: str
+    content_hash: str
+    duplicate: bool
 
 class SecureFileStorage:
-    def __init__(self, base_path: str, allowed_extensions: set):
+    """
+    Upload storage. In content-addressed mode files are named by the
+    SHA-256 of their content and sharded as ab/cd/<hash>.<ext>; identical
+    uploads are stored once and reference counted.
+    """
+
+    def __init__(self, base_path: str, allowed_extensions: set, content_addressed: bool = False):
         self.base_path = base_path
         self.allowed_extensions = allowed_extensions
+        self.content_addressed = content_addressed
+        self._local = threading.local()
         self._ensure_directories()
 
     def _ensure_directories(self):
         """Ensure the base directory exists"""
         os.makedirs(self.base_path, exist_ok=True)
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    @property
+    def _tmp_dir(self) -> str:
+        return os.path.join(self.base_path, '.tmp')
+
+    def _refs(self) -> sqlite3.Connection:
+        """Per-thread connection to the reference count store"""
+        conn = getattr(self._local, 'refs', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.base_path, '.refs.db'), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS refs (name TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID')
+            self._local.refs = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _locked_refs(self) -> Iterator[sqlite3.Connection]:
+        """
+        The reference count connection inside a write transaction. Taking
+        a reference and releasing the last one, with the file check or
+        removal that goes with each, cannot interleave across processes.
+        """
+        conn = self._refs()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _content_path(self, name: str) -> str:
+        return os.path.join(self.base_path, name[:2], name[2:4], name)
 
     def _allowed_file(self, filename: str) -> bool:
         """Check if the file extension is allowed"""
@@ -26,41 +114,194 @@ class SecureFileStorage:
         filename = secure_filename(original_filename)
         name, ext = os.path.splitext(filename)
         
-        # Create a hash of the original filename and timestamp
-        hash_input = f"{original_filename}{timestamp}".encode('utf-8')
+        # Hash the original filename, timestamp and a random nonce; two uploads
+        # of one name within a second must not overwrite each other
+        hash_input = f"{original_filename}{timestamp}{uuid.uuid4().hex}".encode('utf-8')
         file_hash = hashlib.sha256(hash_input).hexdigest()[:8]
         
         return f"{name}_{timestamp}_{file_hash}{ext}"
 
+    def _write_temp(self, file) -> Tuple[str, str]:
+        """Stream an upload to a temp file, hashing it on the way. Returns (temp path, sha256)"""
+        stream = getattr(file, 'stream', file)
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, digest.hexdigest()
+
+    def _write_bytes(self, data: bytes) -> str:
+        """Write a buffer to a temp file and return its path"""
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(data)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def _reserve(self, content_hash: str, original_filename: str,
+                 image_type: Optional[str] = None) -> Tuple[str, str, bool]:
+        """
+        Take a reference on content-addressed content. The extension comes
+        from the sniffed image type when known, else the original filename.
+        Returns (filename, filepath, already stored)
+        """
+        ext = CANONICAL_EXTENSIONS.get(image_type) or os.path.splitext(original_filename)[1].lower()
+        filename = f"{content_hash}{ext}"
+        filepath = self._content_path(filename)
+        with self._locked_refs() as refs:
+            count = refs.execute(
+                "INSERT INTO refs (name, count) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET count = count + 1 RETURNING count",
+                (filename,)
+            ).fetchone()[0]
+            # Once this commits, no delete can remove the file until our reference is released
+            return filename, filepath, count > 1 and os.path.exists(filepath)
+
+    def read_upload(self, file) -> UploadBuffer:
+        """
+        Read an upload into memory once, hashing and sniffing the buffer.
+        Uploads are bounded by MAX_CONTENT_LENGTH.
+        """
+        with stage('storage.read'):
+            data = getattr(file, 'stream', file).read()
+        with stage('storage.hash'):
+            content_hash = hashlib.sha256(data).hexdigest()
+        return UploadBuffer(data, content_hash, self._allowed_type(sniff_image_type(data)))
+
+    def _allowed_type(self, image_type: Optional[str]) -> Optional[str]:
+        if not IMAGE_TYPE_EXTENSIONS.get(image_type, {image_type}) & self.allowed_extensions:
+            return None
+        return image_type
+
+    def sniff_upload(self, file) -> Optional[str]:
+        """
+        Allowed image type of an upload from its leading bytes, without
+        reading the rest of it; the stream is rewound for store()
+        """
+        stream = getattr(file, 'stream', file)
+        position = stream.tell()
+        header = stream.read(16)
+        stream.seek(position)
+        return self._allowed_type(sniff_image_type(header))
+
+    def store_bytes(self, data: bytes, original_filename: str, content_hash: Optional[str] = None,
+                    image_type: Optional[str] = None) -> Optional[StoredFile]:
+        """
+        Save an in-memory upload atomically. In content-addressed mode
+        duplicates take a reference without being written again.
+        """
+        if not self._allowed_file(original_filename):
+            return None
+        content_hash = content_hash or hashlib.sha256(data).hexdigest()
+
+        if not self.content_addressed:
+            filename = self._generate_secure_filename(original_filename)
+            filepath = os.path.join(self.base_path, filename)
+            with stage('storage.write'):
+                os.replace(self._write_bytes(data), filepath)
+            return StoredFile(filename, filepath, content_hash, False)
+
+        filename, filepath, duplicate = self._reserve(content_hash, original_filename,
+                                                      image_type or sniff_image_type(data[:16]))
+        if duplicate:
+            return StoredFile(filename, filepath, content_hash, True)
+        with stage('storage.write'):
+            tmp_path = self._write_bytes(data)
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.replace(tmp_path, filepath)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return StoredFile(filename, filepath, content_hash, False)
+
+    def store(self, file, original_filename: str, image_type: Optional[str] = None) -> Optional[StoredFile]:
+        """
+        Save an upload atomically (temp file + rename).
+        Returns None if the file type is not allowed. In content-addressed
+        mode, duplicate is True when identical content was already stored.
+        """
+        if not self._allowed_file(original_filename):
+            return None
+
+        with stage('storage.write'):
+            tmp_path, content_hash = self._write_temp(file)
+        try:
+            if not self.content_addressed:
+                filename = self._generate_secure_filename(original_filename)
+                filepath = os.path.join(self.base_path, filename)
+                os.replace(tmp_path, filepath)
+                return StoredFile(filename, filepath, content_hash, False)
+
+            if image_type is None:
+                with open(tmp_path, 'rb') as f:
+                    image_type = sniff_image_type(f.read(16))
+            filename, filepath, duplicate = self._reserve(content_hash, original_filename, image_type)
+            if duplicate:
+                os.remove(tmp_path)
+                return StoredFile(filename, filepath, content_hash, True)
+
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.replace(tmp_path, filepath)
+            return StoredFile(filename, filepath, content_hash, False)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
     def save_file(self, file, original_filename: str) -> Tuple[Optional[str], Optional[str]]:
         """
         Save a file securely
         Returns: (filename, filepath) or (None, None) if failed
         """
-        if not self._allowed_file(original_filename):
-            return None, None
-        
-        filename = self._generate_secure_filename(original_filename)
-        filepath = os.path.join(self.base_path, filename)
-        
         try:
-            file.save(filepath)
-            return filename, filepath
+            stored = self.store(file, original_filename)
         except Exception as e:
             print(f"Error saving file: {str(e)}")
             return None, None
+        if stored is None:
+            return None, None
+        return stored.filename, stored.filepath
 
     def delete_file(self, filename: str) -> bool:
-        """Delete a file from storage"""
+        """
+        Delete a file from storage. Content-addressed files are only removed
+        once their last reference is released.
+        """
         filepath = self.get_file_path(filename)
         if not filepath or not os.path.exists(filepath):
             return False
         
         try:
+            if self.content_addressed and CONTENT_NAME_PATTERN.match(filename):
+                with self._locked_refs() as refs:
+                    row = refs.execute(
+                        "UPDATE refs SET count = count - 1 WHERE name = ? RETURNING count", (filename,)
+                    ).fetchone()
+                    if row and row[0] > 0:
+                        return True
+                    refs.execute("DELETE FROM refs WHERE name = ?", (filename,))
+                    # Removed before the commit, so a concurrent upload either
+                    # waits and rewrites the file or took its reference first
+                    os.remove(filepath)
+                return True
             os.remove(filepath)
             return True
         except Exception as e:
-            print(f"Error deleting file: {str(e)}")
+            logger.error(f"Error deleting {filename}: {str(e)}")
             return False
 
     def get_file_path(self, filename: str) -> Optional[str]:
@@ -68,6 +309,11 @@ class SecureFileStorage:
         if not filename:
             return None
         
+        if CONTENT_NAME_PATTERN.match(filename):
+            filepath = self._content_path(filename)
+            if os.path.exists(filepath):
+                return filepath
+        
         filepath = os.path.join(self.base_path, filename)
         return filepath if os.path.exists(filepath) else None
 
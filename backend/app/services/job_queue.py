@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger('face_detection')
+
+class QueueFullError(Exception):
+    pass
+
+class DetectionJobQueue:
+    """
+    Bounded local worker pool for asynchronous detection jobs.
+
+    Job state lives in the database; this class only schedules job ids on a
+    thread pool and lets in-process waiters block until a job finishes.
+    OpenCV releases the GIL while decoding and detecting, so threads are
+    enough to keep detection off the request workers.
+
+    While jobs run, a background thread calls heartbeat with their ids
+    every heartbeat_interval seconds, so other processes can tell them
+    apart from jobs abandoned by a crashed worker.
+    """
+
+    def __init__(self, handler: Callable[[str], None], max_workers: int = 2, max_pending: int = 100,
+                 heartbeat: Optional[Callable[[List[str]], None]] = None, heartbeat_interval: float = 30.0):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self._app = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._events: Dict[str, threading.Event] = {}
+        self._running: Set[str] = set()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        """Bind the queue to an app; workers run jobs inside its app context"""
+        self._app = app
+        self.max_workers = app.config.get('DETECTION_JOB_WORKERS', self.max_workers)
+        self.max_pending = app.config.get('DETECTION_JOB_MAX_PENDING', self.max_pending)
+        # Several beats fit in the stale window, so one slow beat does not get a live job requeued
+        self.heartbeat_interval = app.config.get('DETECTION_JOB_STALE_SECONDS', self.heartbeat_interval * 4) / 4
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='detection-job')
+        return self._executor
+
+    @property
+    def pending(self) -> int:
+        return len(self._events)
+
+    def submit(self, job_id: str, force: bool = False) -> None:
+        """
+        Schedule a job; raises QueueFullError when max_pending jobs are
+        waiting, unless force is set (used when recovering jobs at startup)
+        """
+        with self._lock:
+            if job_id in self._events:
+                return
+            if not force and len(self._events) >= self.max_pending:
+                raise QueueFullError(f"Detection queue is full ({self.max_pending} jobs pending)")
+            self._events[job_id] = threading.Event()
+            executor = self._get_executor()
+            if self.heartbeat is not None and (self._heartbeat_thread is None
+                                               or not self._heartbeat_thread.is_alive()):
+                self._heartbeat_thread = threading.Thread(target=self._beat, name='detection-job-heartbeat',
+                                                          daemon=True)
+                self._heartbeat_thread.start()
+        executor.submit(self._run, job_id)
+
+    def _run(self, job_id: str) -> None:
+        try:
+            with self._lock:
+                self._running.add(job_id)
+            with self._app.app_context():
+                self.handler(job_id)
+        except Exception:
+            logger.exception(f"Detection job {job_id} failed")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+                event = self._events.pop(job_id, None)
+            if event:
+                event.set()
+
+    def _beat(self) -> None:
+        """Report the running jobs until none are left"""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                running = list(self._running)
+                if not running and not self._events:
+                    self._heartbeat_thread = None
+                    return
+            if not running:
+                continue
+            try:
+                with self._app.app_context():
+                    self.heartbeat(running)
+            except Exception:
+                logger.exception('Detection job heartbeat failed')
+
+    def wait(self, job_id: str, timeout: float) -> bool:
+        """
+        Block until a job running in this process finishes. Returns False
+        if the job is not tracked here or did not finish within timeout.
+        """
+        event = self._events.get(job_id)
+        if event is None:
+            return False
+        return event.wait(timeout)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
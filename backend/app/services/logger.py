@@ -1,44 +1,184 @@
+import atexit
+import copy
+import json
 import logging
 import logging.handlers
 import os
-from datetime import datetime
-
-def setup_logging(app):
-    # Create logs directory if it doesn't exist
-    log_dir = os.path.join(app.root_path, 'logs')
-    os.makedirs(log_dir, exist_ok=True)
-
-    # Set up file handler for all logs
-    log_file = os.path.join(log_dir, f'app_{datetime.now().strftime("%Y%m%d")}.log')
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_file,
-        maxBytes=10485760,  # 10MB
-        backupCount=10
-    )
-
-    # Set up formatters
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    file_handler.setFormatter(formatter)
-
-    # Configure root logger
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(file_handler)
-
-    # Set up specific loggers for different components
-    loggers = {
-        'face_detection': logging.INFO,
-        'file_storage': logging.INFO,
-        'rate_limiter': logging.INFO,
-        'error_handler': logging.ERROR
-    }
-
-    for logger_name, level in loggers.items():
-        logger = logging.getLogger(logger_name)
-        logger.setLevel(level)
-        logger.addHandler(file_handler)
-
-    # Log application startup
-    app.logger.info(f"Application started in {app.config['ENV']} mode")
\ No newline at end of file
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from .metrics import metrics
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra= fields"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """
+    Rate limit for high-volume messages. Records logged with
+    ``extra={'sample_key': ...}`` pass at most burst times per interval
+    seconds per key; the first record of the next window carries the number
+    dropped in between as ``suppressed``. Other records always pass.
+    """
+
+    def __init__(self, burst: int = 20, interval: float = 60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._lock = threading.Lock()
+        # key -> [window start, records passed, records dropped]
+        self._windows: Dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample_key', None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                self._windows[key] = [now, 1, 0]
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+        metrics.inc('log_records_sampled_out_total', key=key)
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks the caller: when the queue is full the
+    record is dropped and counted. Only the message is rendered on the
+    calling thread; formatting and I/O happen on the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Tracebacks cannot cross the queue; render them here
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log_records_dropped_total')
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+_setup_lock = threading.Lock()
+
+def _start_listener(handlers, queue_size: int, burst: int, interval: float) -> None:
+    """Route root records through a new queue, sampling filter and listener thread"""
+    global _listener, _queue_handler
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(burst=burst, interval=interval))
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    _queue_handler = queue_handler
+    logging.getLogger().addHandler(queue_handler)
+
+def _stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+atexit.register(_stop_listener)
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """Parse 'face_detection=INFO,error_handler=ERROR' into logger levels"""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(app) -> None:
+    """
+    Send all records through one QueueHandler on the root logger. Request
+    threads only enqueue; a QueueListener thread formats them (JSON lines
+    by default) and writes them to stderr and, if LOG_FILE is set, to a
+    rotating file. Handlers are attached once per process; calling this
+    again only reapplies the levels.
+    """
+    config = app.config
+    with _setup_lock:
+        if _listener is None:
+            formatter = JsonFormatter() if config.get('LOG_FORMAT', 'json') == 'json' else logging.Formatter(TEXT_FORMAT)
+            handlers = [logging.StreamHandler(sys.stderr)]
+            if config.get('LOG_FILE'):
+                handlers.append(logging.handlers.RotatingFileHandler(
+                    config['LOG_FILE'],
+                    maxBytes=10485760,  # 10MB
+                    backupCount=10
+                ))
+            for handler in handlers:
+                handler.setFormatter(formatter)
+
+            _start_listener(
+                handlers,
+                queue_size=config.get('LOG_QUEUE_SIZE', 10000),
+                burst=config.get('LOG_SAMPLE_BURST', 20),
+                interval=config.get('LOG_SAMPLE_INTERVAL', 60.0)
+            )
+
+    logging.getLogger().setLevel(config.get('LOG_LEVEL', 'INFO').upper())
+    for name, level in parse_levels(config.get('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+def _restart_listener_after_fork() -> None:
+    """
+    The listener thread does not survive fork. Forked workers (gunicorn
+    --preload, scan pools) get their own queue, sampling filter and
+    listener thread, so request threads still never write synchronously.
+    """
+    global _setup_lock
+    if _listener is None:
+        return
+    # Another thread may have held it at the moment of the fork
+    _setup_lock = threading.Lock()
+    old_handler = _queue_handler
+    logging.getLogger().removeHandler(old_handler)
+    sampling = next(f for f in old_handler.filters if isinstance(f, SamplingFilter))
+    _start_listener(_listener.handlers, old_handler.queue.maxsize, sampling.burst, sampling.interval)
+    # multiprocessing workers leave through os._exit, which skips atexit
+    from multiprocessing import util
+    util.Finalize(None, _stop_listener, exitpriority=-100)
+
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+def setup_logger(name: str = 'app') -> logging.Logger:
+    """Return the application logger; its records reach the handlers set up by setup_logging"""
+    return logging.getLogger(name)
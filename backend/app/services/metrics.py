@@ -0,0 +1,204 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('metrics')
+
+# Seconds; wide enough for a 48 MP decode, fine enough for a rate limit check
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Histogram:
+    """Fixed-bucket latency histogram; observe() is a bisect and three additions"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms rendered in the Prometheus text format.
+
+    Each worker process keeps its own numbers; scrape every worker or put
+    the processes behind a per-worker metrics port.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """Observe the duration of the with block, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'Requests by route, method and status')
+metrics.describe('http_request_duration_seconds', 'Request latency by route')
+metrics.describe('stage_duration_seconds', 'Latency of individual hot-path stages')
+metrics.describe('errors_total', 'Errors handled by ErrorHandler by type')
+metrics.describe('rate_limit_rejections_total', 'Requests rejected by the rate limiter')
+
+def stage(name: str):
+    """Time a hot-path stage: ``with stage('detect.cascade'): ...``"""
+    return metrics.timer('stage_duration_seconds', stage=name)
+
+class SamplingProfiler:
+    """
+    Statistical profiler for a single thread. A background thread samples
+    the target thread's stack every interval seconds; the result is a
+    count per collapsed stack ("outer;inner;leaf"), the input format of
+    flamegraph tools.
+    """
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self) -> 'SamplingProfiler':
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.samples
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+def init_app(app) -> None:
+    """
+    Count and time every request by route. With PROFILING_ENABLED set, a
+    request carrying ``X-Profile: 1`` is sampled and its collapsed stacks
+    are written to PROFILE_DIR; the response names the file in X-Profile-Id.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        if app.config.get('PROFILING_ENABLED') and request.headers.get('X-Profile') == '1':
+            g.profiler = SamplingProfiler(interval=app.config.get('PROFILING_INTERVAL', 0.005)).start()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+        started = g.pop('request_started', None)
+        if started is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                            route=route, method=request.method)
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            profile_id = uuid.uuid4().hex
+            directory = app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, f"{profile_id}.folded"), 'w') as f:
+                f.write(profiler.collapsed())
+            logger.info(f"Profiled {request.method} {route}: {sum(profiler.samples.values())} samples, "
+                        f"written to {profile_id}.folded")
+            response.headers['X-Profile-Id'] = profile_id
+        return response
+
+    @app.teardown_request
+    def stop_request_profiler(exc):
+        # after_request is skipped when the request raised; never leave the sampler running
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,151 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+
+HASH_BITS = 64
+
+def dhash(gray: np.ndarray) -> int:
+    """
+    64-bit difference hash of a grayscale image: shrink to 9x8 and record
+    whether each pixel is brighter than its right neighbour. Recompression,
+    resizing and small exposure edits change only a few bits.
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def image_hash(data: bytes) -> Optional[int]:
+    """dHash of an encoded image, from a 1/8 scale decode; None if it cannot be decoded"""
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None or not gray.size:
+        return None
+    return dhash(gray)
+
+def file_hash(path: str) -> Optional[int]:
+    """image_hash of a file; None if it cannot be read or decoded"""
+    try:
+        with open(path, 'rb') as f:
+            return image_hash(f.read())
+    except OSError:
+        return None
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+def to_signed(value: int) -> int:
+    """Map an unsigned 64-bit hash onto a signed SQLite INTEGER"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def from_signed(value: int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+class MultiIndexHashTable:
+    """
+    Hamming-distance lookup over 64-bit hashes by multi-index hashing.
+
+    Each hash is split into max_distance + 1 bands and indexed by every
+    band value. Two hashes at most max_distance bits apart agree exactly
+    on at least one band, so a lookup only compares the keys that share a
+    band with the query instead of every stored hash.
+    """
+
+    def __init__(self, max_distance: int = 4):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        edges = [HASH_BITS * i // bands for i in range(bands + 1)]
+        self._bands = [(low, (1 << (high - low)) - 1) for low, high in zip(edges, edges[1:])]
+        self._tables: List[Dict[int, Set[int]]] = [{} for _ in self._bands]
+        self._hashes: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.max_key = 0
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def _band_values(self, value: int) -> List[int]:
+        return [(value >> low) & mask for low, mask in self._bands]
+
+    def _discard(self, key: int) -> None:
+        old = self._hashes.pop(key, None)
+        if old is None:
+            return
+        for table, band in zip(self._tables, self._band_values(old)):
+            keys = table.get(band)
+            keys.discard(key)
+            if not keys:
+                del table[band]
+
+    def update(self, items: Iterable[Tuple[int, int]]) -> None:
+        """Add or replace (key, hash) pairs"""
+        with self._lock:
+            for key, value in items:
+                self._discard(key)
+                self._hashes[key] = value
+                for table, band in zip(self._tables, self._band_values(value)):
+                    table.setdefault(band, set()).add(key)
+                self.max_key = max(self.max_key, key)
+
+    def add(self, key: int, value: int) -> None:
+        self.update([(key, value)])
+
+    def remove(self, key: int) -> None:
+        with self._lock:
+            self._discard(key)
+
+    def lookup(self, value: int, max_distance: Optional[int] = None) -> List[Tuple[int, int]]:
+        """(key, distance) pairs within max_distance bits of value, closest first"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        with self._lock:
+            candidates = set()
+            for table, band in zip(self._tables, self._band_values(value)):
+                candidates.update(table.get(band, ()))
+            matches = [(key, hamming(value, self._hashes[key])) for key in candidates]
+        return sorted((match for match in matches if match[1] <= max_distance), key=lambda m: (m[1], m[0]))
+
+
+_index: Optional[MultiIndexHashTable] = None
+_index_lock = threading.Lock()
+
+def get_hash_index(max_distance: int = 4) -> MultiIndexHashTable:
+    """Return the process-wide perceptual hash index"""
+    global _index
+    if _index is None or _index.max_distance != max_distance:
+        with _index_lock:
+            if _index is None or _index.max_distance != max_distance:
+                _index = MultiIndexHashTable(max_distance)
+    return _index
+
+def loaded_hash_index():
+    """
+    The process-wide perceptual hash index, caught up with the hashed
+    Photo rows any worker added since the last lookup
+    """
+    from flask import current_app
+    from ..models import Photo, db
+    
+    index = get_hash_index(current_app.config.get('NEAR_DUPLICATE_DISTANCE', 4))
+    rows = db.session.query(Photo.id, Photo.perceptual_hash) \
+        .filter(Photo.id > index.max_key, Photo.perceptual_hash.isnot(None)).order_by(Photo.id).all()
+    index.update((photo_id, from_signed(value)) for photo_id, value in rows)
+    return index
+
+def find_near_duplicate(phash):
+    """
+    (group photo id, nearest photo id, distance) of the closest stored
+    photo within NEAR_DUPLICATE_DISTANCE bits of phash, or None
+    """
+    if phash is None:
+        return None
+    from ..models import Photo, db
+    
+    index = loaded_hash_index()
+    for photo_id, distance in index.lookup(phash):
+        photo = db.session.query(Photo.id, Photo.duplicate_of).filter_by(id=photo_id).first()
+        if photo is None:
+            # Deleted since it was indexed
+            index.remove(photo_id)
+            continue
+        return photo.duplicate_of or photo.id, photo_id, distance
+    return None
@@ -1,48 +1,163 @@
 from functools import wraps
-from flask import request, jsonify
+from flask import request, jsonify, current_app
+import os
 import time
+import sqlite3
 import logging
-from threading import Lock
-from collections import defaultdict
-from datetime import datetime
+from threading import Lock, local
+from collections import OrderedDict
+from typing import Optional
+
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+class MemoryBackend:
+    """
+    Token buckets for a single process, held in an LRU-ordered dict.
+
+    Each check touches one entry under one lock. Keys whose bucket has
+    refilled completely carry no state and are evicted as the LRU end is
+    visited; max_keys bounds memory even under a flood of distinct keys.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated, full_at]
+        self._lock = Lock()
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> bool:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = capacity
+                bucket = self._buckets[key] = [0.0, now, now]
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            bucket[0] = tokens
+            bucket[1] = now
+            bucket[2] = now + (capacity - tokens) / rate
+
+            # Drop idle keys from the LRU end; a full bucket is the same as no bucket
+            while self._buckets:
+                oldest_key, oldest = next(iter(self._buckets.items()))
+                if oldest_key == key or (oldest[2] > now and len(self._buckets) <= self.max_keys):
+                    break
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+class SQLiteBackend:
+    """
+    Token buckets in a SQLite file shared by every worker process on a host.
+
+    Each check is a single atomic UPSERT, so limits hold across gunicorn
+    workers. Refilled buckets are deleted periodically.
+    """
+
+    _UPSERT = (
+        "INSERT INTO rate_limit_buckets (key, tokens, updated, full_at, allowed) "
+        "VALUES (:key, :capacity - 1, :now, :now + 1 / :rate, 1) "
+        "ON CONFLICT(key) DO UPDATE SET "
+        "allowed = (MIN(:capacity, tokens + (:now - updated) * :rate) >= 1), "
+        "tokens = MIN(:capacity, tokens + (:now - updated) * :rate) "
+        "  - (MIN(:capacity, tokens + (:now - updated) * :rate) >= 1), "
+        "updated = :now, "
+        "full_at = :now + (:capacity - (MIN(:capacity, tokens + (:now - updated) * :rate) "
+        "  - (MIN(:capacity, tokens + (:now - updated) * :rate) >= 1))) / :rate "
+        "RETURNING allowed"
+    )
+
+    def __init__(self, path: str, cleanup_interval: int = 10000, timeout: float = 5.0):
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            raise RuntimeError(f"SQLite 3.35+ is required for the shared rate limiter, found {sqlite3.sqlite_version}")
+        self.path = path
+        self.cleanup_interval = cleanup_interval
+        self.timeout = timeout
+        self._local = local()
+        self._checks = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, "
+            "full_at REAL NOT NULL, allowed INTEGER NOT NULL) WITHOUT ROWID"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        pid = os.getpid()
+        if conn is None or self._local.pid != pid:
+            # Connections must not be shared across fork or threads
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def consume(self, key: str, capacity: int, rate: float, now: float) -> bool:
+        conn = self._connection()
+        row = conn.execute(self._UPSERT, {'key': key, 'capacity': capacity, 'rate': rate, 'now': now}).fetchone()
+
+        self._checks += 1
+        if self._checks % self.cleanup_interval == 0:
+            conn.execute("DELETE FROM rate_limit_buckets WHERE full_at <= ?", (now,))
+        return bool(row[0])
+
 class RateLimiter:
-    def __init__(self):
-        self.requests = defaultdict(list)
-        self.lock = Lock()
+    """Token bucket rate limiter: O(1) work per check, pluggable storage backend"""
 
-    def _cleanup_old_requests(self, key: str, period: int):
-        current_time = time.time()
-        with self.lock:
-            self.requests[key] = [req_time for req_time in self.requests[key]
-                                if current_time - req_time < period]
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
 
     def check_rate_limit(self, key: str, calls: int, period: int) -> bool:
-        self._cleanup_old_requests(key, period)
-        with self.lock:
-            if len(self.requests[key]) >= calls:
-                return False
-            self.requests[key].append(time.time())
-            return True
+        return self.backend.consume(key, calls, calls / period, time.time())
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = Lock()
+
+def get_limiter() -> RateLimiter:
+    """
+    Return the process-wide limiter. RATE_LIMIT_BACKEND=sqlite shares the
+    buckets between all workers through RATE_LIMIT_STORAGE_PATH.
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                config = current_app.config
+                if config.get('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+                    path = config.get('RATE_LIMIT_STORAGE_PATH') or \
+                        os.path.join(current_app.instance_path, 'rate_limits.db')
+                    _limiter = RateLimiter(SQLiteBackend(path))
+                else:
+                    _limiter = RateLimiter(MemoryBackend(config.get('RATE_LIMIT_MAX_KEYS', 100000)))
+    return _limiter
 
 def rate_limit(calls: int = 60, period: int = 60):
-    limiter = RateLimiter()
-    
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             key = f"{request.remote_addr}:{f.__name__}"
-            
-            if not limiter.check_rate_limit(key, calls, period):
+
+            if not get_limiter().check_rate_limit(key, calls, period):
                 logger.warning(f"Rate limit exceeded for {key}")
+                metrics.inc('rate_limit_rejections_total', endpoint=f.__name__)
                 response = {
                     'error': 'Rate Limit Exceeded',
                     'message': f'Please wait before making another request. Maximum {calls} calls per {period} seconds.'
                 }
                 return jsonify(response), 429
-                
+
             return f(*args, **kwargs)
         return decorated_function
-    return decorator
\ No newline at end of file
+    return decorator
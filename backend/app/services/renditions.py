@@ -0,0 +1,136 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from .face_detection import crop_face
+
+logger = logging.getLogger('renditions')
+
+class RenditionCache:
+    """
+    Disk cache of downscaled photo thumbnails and face crops.
+
+    Renditions are generated lazily on first request at one of a few fixed
+    sizes and keyed by the source path, its size and mtime, so editing a
+    photo produces new renditions. The cache directory is capped at
+    max_bytes; the least recently used files are evicted first.
+    """
+
+    SIZES = (128, 256, 512, 1024)
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024, quality: int = 85):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._total = sum(size for _, size, _ in self._iter_entries())
+
+    def _iter_entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    @staticmethod
+    def source_version(source_path: str) -> Tuple[int, int]:
+        """Return (size, mtime_ns) of the source file; raises OSError if missing"""
+        stat = os.stat(source_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def rendition_key(self, source_path: str, kind: str, size: int, extra: str = '') -> str:
+        """Stable key for a rendition; also used as the HTTP ETag"""
+        file_size, mtime_ns = self.source_version(source_path)
+        key = f"{os.path.abspath(source_path)}|{file_size}|{mtime_ns}|{kind}|{size}|{extra}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.jpg")
+
+    def _lookup(self, key: str) -> Optional[str]:
+        path = self._cache_path(key)
+        try:
+            # The file mtime doubles as the LRU timestamp
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def _store(self, key: str, image: Image.Image) -> str:
+        """Write a rendition atomically and evict old entries if over the cap"""
+        path = self._cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.convert('RGB').save(f, format='JPEG', quality=self.quality, optimize=True)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._total += os.path.getsize(path)
+            if self._total > self.max_bytes:
+                self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Delete least recently used renditions until the cache is at 90% of its cap"""
+        entries = sorted(self._iter_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except OSError:
+                continue
+        self._total = total
+        logger.info(f"Evicted {evicted} renditions, cache is now {total} bytes")
+
+    def thumbnail(self, source_path: str, size: int) -> Tuple[str, str]:
+        """Return (path, key) of a thumbnail whose long edge is at most size"""
+        key = self.rendition_key(source_path, 'thumb', size)
+        cached = self._lookup(key)
+        if cached:
+            return cached, key
+
+        with Image.open(source_path) as image:
+            # Let the JPEG decoder scale down while decoding
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.LANCZOS)
+            return self._store(key, image), key
+
+    def face_crop_key(self, source_path: str, face_location: Dict[str, int], size: int) -> str:
+        """Rendition key of a face crop"""
+        location = ','.join(str(face_location.get(k, 0)) for k in ('left', 'top', 'right', 'bottom'))
+        return self.rendition_key(source_path, 'face', size, location)
+
+    def face_crop(self, source_path: str, face_location: Dict[str, int], size: int) -> Tuple[str, str]:
+        """Return (path, key) of a face crop whose long edge is at most size"""
+        key = self.face_crop_key(source_path, face_location, size)
+        cached = self._lookup(key)
+        if cached:
+            return cached, key
+
+        image = crop_face(source_path, face_location)
+        image.thumbnail((size, size), Image.LANCZOS)
+        return self._store(key, image), key
@@ -0,0 +1,169 @@
+import os
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('face_detection')
+
+# (size in bytes, mtime in nanoseconds, sha256 hex digest)
+ManifestEntry = Tuple[int, int, Optional[str]]
+
+def _init_worker(detector: Optional[str] = None):
+    """Load and warm up the detector once in each worker process"""
+    import cv2
+    from .face_detection import get_detector
+    # Parallelism comes from the pool; keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+    get_detector(detector).warmup()
+
+def _scan_file(task: Tuple[str, Optional[str], Optional[str]]) -> Dict[str, Any]:
+    """
+    Hash and, if its content changed, run detection on a single file inside
+    a worker process. The file is read once; the same buffer is hashed and
+    decoded. Only the faces are counted; no features are extracted or
+    encrypted, and only the hash and the count go back to the parent.
+    """
+    from .face_detection import get_detector
+
+    filepath, known_hash, detector = task
+    filename = os.path.basename(filepath)
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        if content_hash == known_hash:
+            return {
+                'filename': filename,
+                'filepath': filepath,
+                'content_hash': content_hash,
+                'unchanged': True
+            }
+
+        faces_detected = get_detector(detector).count_faces(data, content_hash)
+    except Exception as e:
+        return {'filename': filename, 'filepath': filepath, 'error': str(e)}
+    return {
+        'filename': filename,
+        'filepath': filepath,
+        'content_hash': content_hash,
+        'faces_detected': faces_detected
+    }
+
+class ScanPlan:
+    """Result of comparing a directory listing against the scan manifest"""
+
+    def __init__(self):
+        self.candidates: Dict[str, Optional[str]] = {}  # path -> previously known hash
+        self.unchanged: List[str] = []
+        self.removed: List[str] = []
+        self.stats: Dict[str, Tuple[int, int]] = {}
+
+class ScanEngine:
+    """
+    Spreads decode and detection of a photo directory across a process pool.
+
+    Workers return small per-file results; the caller's ``on_chunk``
+    callback receives them in chunks and owns all database writes.
+    detector names the backend to use; None means the deployment default.
+    """
+
+    def __init__(self, allowed_extensions: Iterable[str], max_workers: Optional[int] = None,
+                 chunk_size: int = 200, detector: Optional[str] = None):
+        self.allowed_extensions = {ext.lower() for ext in allowed_extensions}
+        self.detector = detector
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+
+    def _allowed_file(self, filename: str) -> bool:
+        """Check if the file extension is allowed"""
+        return '.' in filename and \
+            filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+
+    def list_files(self, directory: str) -> Dict[str, Tuple[int, int]]:
+        """Return {path: (size, mtime_ns)} for all image files directly inside directory"""
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and self._allowed_file(entry.name):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def plan(self, directory: str, manifest: Dict[str, ManifestEntry]) -> ScanPlan:
+        """
+        Compare the directory against the manifest of a previous scan.
+        Files whose size and mtime are unchanged are skipped without being
+        read; everything else becomes a candidate and is re-hashed.
+        """
+        plan = ScanPlan()
+        plan.stats = self.list_files(directory)
+        for path, (size, mtime_ns) in plan.stats.items():
+            known = manifest.get(path)
+            if known is None:
+                plan.candidates[path] = None
+            elif known[0] == size and known[1] == mtime_ns:
+                plan.unchanged.append(path)
+            else:
+                plan.candidates[path] = known[2]
+        plan.removed = [path for path in manifest if path not in plan.stats]
+        return plan
+
+    def _iter_results(self, tasks: List[Tuple[str, Optional[str], Optional[str]]]) -> Iterator[Dict[str, Any]]:
+        if self.max_workers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield _scan_file(task)
+            return
+
+        workers = min(self.max_workers, len(tasks))
+        # Hand out work in batches so IPC overhead stays small for large libraries
+        batch = max(1, min(32, len(tasks) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.detector,)) as pool:
+            yield from pool.map(_scan_file, tasks, chunksize=batch)
+
+    def scan(self, filepaths: Iterable[str],
+             on_chunk: Callable[[List[Dict[str, Any]]], None],
+             known_hashes: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Detect faces in every file and pass successful results to on_chunk
+        in groups of chunk_size. on_chunk may return (result, error) pairs
+        for results it could not store; raising fails the whole chunk. Files whose content hash matches
+        known_hashes are not decoded and come back flagged ``unchanged``.
+        Returns the processed results and per-file errors.
+        """
+        known_hashes = known_hashes or {}
+        tasks = [(path, known_hashes.get(path), self.detector) for path in filepaths]
+        results = []
+        errors = []
+        pending = []
+
+        def flush():
+            try:
+                failed = {r['filepath']: error for r, error in on_chunk(pending) or []}
+            except Exception as e:
+                logger.error(f"Failed to store scan chunk of {len(pending)} files: {str(e)}")
+                failed = {r['filepath']: str(e) for r in pending}
+            for r in pending:
+                if r['filepath'] in failed:
+                    errors.append({'filename': r['filename'], 'error': failed[r['filepath']]})
+                else:
+                    results.append(r)
+            pending.clear()
+
+        for result in self._iter_results(tasks):
+            if 'error' in result:
+                # One line per broken file; sampled so a bad directory cannot flood the log
+                logger.error("Error processing %s: %s", result['filename'], result['error'],
+                             extra={'sample_key': 'scan.file_error'})
+                errors.append({'filename': result['filename'], 'error': result['error']})
+                continue
+
+            pending.append(result)
+            if len(pending) >= self.chunk_size:
+                flush()
+
+        if pending:
+            flush()
+
+        return {'results': results, 'errors': errors}
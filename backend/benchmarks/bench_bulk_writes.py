@@ -0,0 +1,101 @@
+"""
+Rows per second for persisting detection output, one ORM object per row
+versus BulkWriter, and how long a concurrent reader waits meanwhile.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_bulk_writes --photos 20000 --chunk-size 500
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from app import create_app, db
+from app.models import FaceEntry, Photo
+from app.services.database import BulkWriter
+
+def _records(count, faces_per_photo):
+    return [{
+        'filename': f"photo_{i}.jpg",
+        'filepath': f"/photos/photo_{i}.jpg",
+        'faces': [{'top': 10 * n, 'right': 10 * n + 50, 'bottom': 10 * n + 50, 'left': 10 * n}
+                  for n in range(faces_per_photo)]
+    } for i in range(count)]
+
+def write_orm(records, chunk_size):
+    """Previous behaviour: one ORM object per row, a single commit at the end"""
+    for record in records:
+        db.session.add(Photo(filename=record['filename'], filepath=record['filepath'],
+                             photo_metadata={'faces_detected': len(record['faces'])}))
+        db.session.add_all(FaceEntry(image_path=record['filepath'], face_location=face)
+                           for face in record['faces'])
+    db.session.commit()
+
+def write_bulk(records, chunk_size):
+    writer = BulkWriter(db.session, chunk_size)
+
+    def write_chunk(chunk):
+        writer.insert(Photo, [{
+            'filename': record['filename'],
+            'filepath': record['filepath'],
+            'photo_metadata': {'faces_detected': len(record['faces'])}
+        } for record in chunk])
+        writer.insert(FaceEntry, [{'image_path': record['filepath'], 'face_location': face}
+                                  for record in chunk for face in record['faces']])
+
+    writer.write(records, write_chunk)
+
+def _reader(path, stop, latencies):
+    conn = sqlite3.connect(path, timeout=30)
+    while not stop.is_set():
+        start = time.perf_counter()
+        conn.execute('SELECT COUNT(*) FROM contact').fetchone()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    conn.close()
+
+def run(write, records, chunk_size, journal_mode):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'faces.db')
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+            'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'),
+            'SQLITE_JOURNAL_MODE': journal_mode,
+            'DB_AUTO_INIT': True,
+            'TESTING': True
+        })
+        with app.app_context():
+            stop = threading.Event()
+            latencies = []
+            reader = threading.Thread(target=_reader, args=(path, stop, latencies))
+            reader.start()
+            start = time.perf_counter()
+            write(records, chunk_size)
+            elapsed = time.perf_counter() - start
+            stop.set()
+            reader.join()
+            rows = Photo.query.count() + FaceEntry.query.count()
+            db.session.remove()
+            db.engine.dispose()
+    return rows / elapsed, max(latencies, default=0.0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--photos', type=int, default=20000)
+    parser.add_argument('--faces', type=int, default=2, help='faces per photo')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    records = _records(args.photos, args.faces)
+    for name, write, journal_mode in (('orm ', write_orm, 'DELETE'),
+                                      ('orm ', write_orm, 'WAL'),
+                                      ('bulk', write_bulk, 'DELETE'),
+                                      ('bulk', write_bulk, 'WAL')):
+        rate, worst = run(write, records, args.chunk_size, journal_mode)
+        print(f"{name} {journal_mode:6} {rate:12,.0f} rows/s   slowest concurrent read {worst * 1000:8.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Throughput and accuracy of each face detector backend on synthetic photos.
+
+Every backend runs the production pipeline (reduced decode, detection,
+feature crops) without the detection cache over the same workloads:
+large frontal faces, groups, small faces and faces turned up to 40
+degrees. A detection counts when it overlaps a ground-truth face with
+IoU >= --iou. Backends that are not configured are skipped; LBP needs a
+cascade file and DNN a model file, taken from the arguments or from the
+FACE_DETECTION_* environment variables.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_detectors --images 20 \\
+        --lbp-cascade lbpcascade_frontalface_improved.xml \\
+        --dnn-model res10_300x300_ssd_iter_140000.caffemodel --dnn-config deploy.prototxt
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+from app.services.face_detection import CascadeBackend, DnnBackend, FaceDetector
+
+from .synthetic import make_scene
+
+# name: (width, height, faces, face size, max turn in degrees)
+WORKLOADS = {
+    'frontal': (1280, 960, 3, 240, 0),
+    'group': (1920, 1080, 12, 160, 0),
+    'small': (1920, 1080, 24, 60, 0),
+    'rotated': (1920, 1080, 12, 160, 40),
+}
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    overlap = w * h
+    return overlap / (aw * ah + bw * bh - overlap) if overlap else 0.0
+
+def score(found, truth, threshold):
+    """(true positives, detections, faces), matching each face at most once"""
+    unmatched = list(truth)
+    hits = 0
+    for box in found:
+        best = max(unmatched, key=lambda face: iou(box, face), default=None)
+        if best is not None and iou(box, best) >= threshold:
+            unmatched.remove(best)
+            hits += 1
+    return hits, len(found), len(truth)
+
+def run(detector, images, threshold):
+    latencies = []
+    hits = detections = faces = 0
+    for data, truth in images:
+        start = time.perf_counter()
+        result = detector._detect_encoded(data)
+        latencies.append(time.perf_counter() - start)
+        found = [(loc['left'], loc['top'], loc['right'] - loc['left'], loc['bottom'] - loc['top'])
+                 for loc in (face['location'] for face in result['faces'])]
+        counts = score(found, truth, threshold)
+        hits, detections, faces = hits + counts[0], detections + counts[1], faces + counts[2]
+    ms = np.asarray(latencies) * 1000
+    return {
+        'images_per_s': len(images) / ms.sum() * 1000,
+        'p50_ms': float(np.percentile(ms, 50)),
+        'recall': hits / faces if faces else float('nan'),
+        'precision': hits / detections if detections else float('nan'),
+    }
+
+def backends(args):
+    configured = {'haar': CascadeBackend('haar')}
+    if args.lbp_cascade:
+        configured['lbp'] = CascadeBackend('lbp', args.lbp_cascade)
+    if args.dnn_model:
+        configured['dnn'] = DnnBackend(args.dnn_model, args.dnn_config, confidence=args.dnn_confidence)
+    return configured
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', type=int, default=20, help='images per workload')
+    parser.add_argument('--max-dimension', type=int, default=int(os.environ.get('FACE_DETECTION_MAX_DIMENSION', 1280)))
+    parser.add_argument('--iou', type=float, default=0.4, help='overlap that counts as a detection')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='comma-separated workloads')
+    parser.add_argument('--lbp-cascade', default=os.environ.get('FACE_DETECTION_LBP_CASCADE'))
+    parser.add_argument('--dnn-model', default=os.environ.get('FACE_DETECTION_DNN_MODEL'))
+    parser.add_argument('--dnn-config', default=os.environ.get('FACE_DETECTION_DNN_CONFIG'))
+    parser.add_argument('--dnn-confidence', type=float,
+                        default=float(os.environ.get('FACE_DETECTION_DNN_CONFIDENCE', 0.5)))
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    detectors = {name: FaceDetector(max_dimension=args.max_dimension, backend=backend)
+                 for name, backend in backends(args).items()}
+    for name in ('lbp', 'dnn'):
+        if name not in detectors:
+            print(f"{name}: not configured, skipped")
+    for detector in detectors.values():
+        detector.warmup()
+
+    print(f"{'backend':8} {'workload':9} {'images/s':>9} {'p50 ms':>8} {'recall':>7} {'precision':>9}")
+    for workload in args.workloads.split(','):
+        width, height, faces, size, angle = WORKLOADS[workload]
+        images = [make_scene(width, height, faces, size, angle, seed=i) for i in range(args.images)]
+        for name, detector in detectors.items():
+            result = run(detector, images, args.iou)
+            print(f"{name:8} {workload:9} {result['images_per_s']:9.1f} {result['p50_ms']:8.1f} "
+                  f"{result['recall']:7.3f} {result['precision']:9.3f}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Recall and latency of the IVF-PQ embedding store against exact search.
+
+Ground truth is the exact top-k of the in-memory FaceGallery (float32).
+The store is measured unindexed (exact scan of the mapped int8 file)
+and indexed at several nprobe settings; recall@k is the fraction of the
+exact top-k ids it returns, and match recall the fraction of exact top-k
+ids at or above --threshold (the same person, in the synthetic data).
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_embedding_store --faces 20000 --m 32
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app.services.embedding_store import EmbeddingStore
+from app.services.face_gallery import FaceGallery
+
+from .synthetic import make_embeddings
+
+def timed_queries(index, queries, k):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.query(query, k=k))
+        latencies.append(time.perf_counter() - start)
+    ms = np.asarray(latencies) * 1000
+    return results, float(np.percentile(ms, 50)), float(np.percentile(ms, 95))
+
+def recall(results, truth, k, threshold):
+    """(recall@k, recall of the exact matches at or above threshold)"""
+    at_k = []
+    matches = []
+    for result, exact in zip(results, truth):
+        found = {face_id for face_id, _ in result}
+        at_k.append(len(found & {face_id for face_id, _ in exact}) / k)
+        wanted = {face_id for face_id, score in exact if score >= threshold}
+        if wanted:
+            matches.append(len(found & wanted) / len(wanted))
+    return float(np.mean(at_k)), float(np.mean(matches)) if matches else float('nan')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--faces', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=4096)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--m', type=int, default=32, help='PQ code bytes per face')
+    parser.add_argument('--nlist', type=int, help='inverted lists (default about 4 * sqrt(faces))')
+    parser.add_argument('--rerank', type=int, default=64, help='candidates re-ranked exactly')
+    parser.add_argument('--nprobe', default='4,8,16,32', help='comma-separated nprobe values')
+    parser.add_argument('--threshold', type=float, default=0.9, help='similarity of a true match')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    vectors, _ = make_embeddings(args.faces + args.queries, args.dim, identities=args.faces // 5)
+    vectors, queries = vectors[:args.faces], vectors[args.faces:]
+    ids = np.arange(1, args.faces + 1)
+
+    gallery = FaceGallery()
+    gallery.load(zip(ids.tolist(), vectors))
+    truth, p50, p95 = timed_queries(gallery, queries, args.k)
+    print(f"{args.faces} faces x {args.dim} dims, {args.queries} queries, k={args.k}")
+    print(f"{'exact FaceGallery (float32 in RAM)':42} p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  "
+          f"memory/face {vectors.shape[1] * 4:6d} B")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore(os.path.join(tmp, 'embeddings'), rerank=args.rerank)
+        start = time.perf_counter()
+        store.load(zip(ids.tolist(), vectors))
+        load_s = time.perf_counter() - start
+        results, p50, p95 = timed_queries(store, queries, args.k)
+        at_k, matches = recall(results, truth, args.k, args.threshold)
+        print(f"{'store, unindexed (exact int8 scan)':42} p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  "
+              f"recall@{args.k} {at_k:.3f}  match recall {matches:.3f}  load {load_s:.1f} s")
+
+        start = time.perf_counter()
+        store.build_index(nlist=args.nlist, m=args.m)
+        build_s = time.perf_counter() - start
+        lists = len(store._pq.centroids)
+        disk = sum(os.path.getsize(os.path.join(store.directory, name)) for name in os.listdir(store.directory))
+        print(f"index: {lists} lists, {args.m} B codes, built in {build_s:.1f} s; "
+              f"memory/face {store.memory_per_face():.0f} B, disk/face {disk / args.faces:.0f} B")
+        for nprobe in [int(value) for value in args.nprobe.split(',')]:
+            store.nprobe = nprobe
+            results, p50, p95 = timed_queries(store, queries, args.k)
+            at_k, matches = recall(results, truth, args.k, args.threshold)
+            print(f"{f'store, IVF-PQ nprobe={nprobe} rerank={args.rerank}':42} p50 {p50:7.2f} ms  "
+                  f"p95 {p95:7.2f} ms  recall@{args.k} {at_k:.3f}  match recall {matches:.3f}")
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Microbenchmark of RateLimiter.check_rate_limit under contention.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_rate_limiter --threads 8 --processes 4
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import Process, Queue
+
+from app.services.rate_limiter import MemoryBackend, RateLimiter, SQLiteBackend
+
+def _hammer(limiter, checks, keys, offset=0):
+    for i in range(checks):
+        limiter.check_rate_limit(f"10.0.{(i + offset) % keys}.1:detect_face", 50, 60)
+
+def bench_threads(backend, threads, checks, keys):
+    """checks/sec with several threads sharing one limiter"""
+    limiter = RateLimiter(backend)
+    workers = [threading.Thread(target=_hammer, args=(limiter, checks, keys, n * 7))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * checks / (time.perf_counter() - start)
+
+def _process_main(path, checks, keys, offset, results):
+    limiter = RateLimiter(SQLiteBackend(path))
+    start = time.perf_counter()
+    _hammer(limiter, checks, keys, offset)
+    results.put((start, time.perf_counter()))
+
+def bench_processes(path, processes, checks, keys):
+    """checks/sec with several processes sharing one SQLite file"""
+    SQLiteBackend(path)
+    results = Queue()
+    workers = [Process(target=_process_main, args=(path, checks, keys, n * 7, results))
+               for n in range(processes)]
+    for worker in workers:
+        worker.start()
+    spans = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = max(end for _, end in spans) - min(start for start, _ in spans)
+    return processes * checks / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--checks', type=int, default=20000, help='checks per thread or process')
+    parser.add_argument('--keys', type=int, default=1000, help='distinct client keys')
+    args = parser.parse_args()
+
+    rate = bench_threads(MemoryBackend(), args.threads, args.checks, args.keys)
+    print(f"memory  {args.threads} threads:   {rate:12,.0f} checks/s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'rate_limits.db')
+        rate = bench_threads(SQLiteBackend(path), args.threads, args.checks // 4, args.keys)
+        print(f"sqlite  {args.threads} threads:   {rate:12,.0f} checks/s")
+        rate = bench_processes(path, args.processes, args.checks // 4, args.keys)
+        print(f"sqlite  {args.processes} processes: {rate:12,.0f} checks/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Worker startup cost: time to import the app, to run create_app and to
+serve the first requests, in a fresh interpreter per run.
+
+Compares the default lean start (OpenCV, numpy and the cascade load on the
+first detection) with PRELOAD_MODELS, and reports which heavy modules a
+worker has loaded before its first request.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ('cv2', 'numpy', 'PIL.Image', 'cryptography.fernet')
+
+# Runs in the child interpreter; keep it free of heavy imports of its own
+CHILD = r"""
+import io, json, os, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+tmp, preload = sys.argv[1], sys.argv[2] == '1'
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'faces.db'),
+    'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'),
+    'RENDITION_CACHE_DIR': os.path.join(tmp, 'renditions'),
+    'PRELOAD_MODELS': preload,
+    'TESTING': True
+})
+created = time.perf_counter()
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+loaded = [name for name in %(heavy)r if name in sys.modules]
+client = app.test_client()
+response = client.get('/api/contacts')
+assert response.status_code == 200, response.status_code
+first = time.perf_counter()
+with open(os.path.join(tmp, 'upload.jpg'), 'rb') as f:
+    data = f.read()
+response = client.post('/api/detect-face', data={'file': (io.BytesIO(data), 'upload.jpg')})
+assert response.status_code == 200, response.status_code
+detected = time.perf_counter()
+# /api/detect-face saves uploads in the blueprint's upload folder rather than under tmp
+from app import db
+from app.models import Photo
+from app.routes import file_storage
+with app.app_context():
+    file_storage.delete_file(db.session.get(Photo, response.get_json()['photo_id']).filename)
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (first - created) * 1000,
+    'first_detect_ms': (detected - first) * 1000,
+    'rss_before_first_request_mb': rss,
+    'loaded_before_first_request': loaded
+}))
+""" % {'heavy': HEAVY_MODULES}
+
+def run_child(tmp, preload):
+    output = subprocess.run([sys.executable, '-c', CHILD, tmp, '1' if preload else '0'],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per mode')
+    args = parser.parse_args()
+
+    from app import create_app, db
+    from .synthetic import make_image
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The schema is created once, as `flask init-db` would
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'faces.db'),
+                          'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'), 'DB_AUTO_INIT': True, 'TESTING': True})
+        with app.app_context():
+            db.engine.dispose()
+        with open(os.path.join(tmp, 'upload.jpg'), 'wb') as f:
+            f.write(make_image(1920, 1080, faces=1, seed=3))
+
+        for mode, preload in (('lazy', False), ('preload', True)):
+            runs = [run_child(tmp, preload) for _ in range(args.runs)]
+            print(f"{mode}: loaded before the first request: {', '.join(runs[0]['loaded_before_first_request']) or 'none'}")
+            for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'first_detect_ms', 'rss_before_first_request_mb'):
+                values = [run[key] for run in runs]
+                print(f"  {key:28} median {statistics.median(values):8.1f}  min {min(values):8.1f}")
+
+if __name__ == '__main__':
+    sys.exit(main())
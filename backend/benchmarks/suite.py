@@ -0,0 +1,285 @@
+"""
+Benchmark suite for the detection, crypto, storage and API hot paths.
+
+Everything runs on synthetic data generated offline. Results are written
+as JSON (p50/p95/mean latency and throughput per case) so runs from
+different commits can be compared.
+
+Run from the backend directory:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --quick --compare results.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from .synthetic import make_image, write_library
+
+RESOLUTIONS = {'vga': (640, 480), '1080p': (1920, 1080), '12mp': (4000, 3000)}
+FACE_COUNTS = (0, 1, 4)
+
+def measure(fn, iterations, warmup=1, items=1, setup=None):
+    """
+    Time fn over iterations runs after warmup runs. setup, if given, runs
+    before every call outside the timed region. items is the number of
+    operations one call performs, for the throughput figure.
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    ms = np.asarray(samples) * 1000
+    return {
+        'iterations': iterations,
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'mean_ms': round(float(ms.mean()), 3),
+        'throughput_per_s': round(iterations * items / (ms.sum() / 1000), 1)
+    }
+
+def bench_detection(tmp, iterations):
+    from app.services.face_detection import detect_faces, get_detector
+
+    get_detector().warmup()
+    results = {}
+    for name, (width, height) in RESOLUTIONS.items():
+        for faces in FACE_COUNTS:
+            path = os.path.join(tmp, f"detect_{name}_{faces}.jpg")
+            with open(path, 'wb') as f:
+                f.write(make_image(width, height, faces, seed=faces))
+            result = measure(lambda: detect_faces(path), iterations)
+            result['faces_found'] = detect_faces(path)['num_faces']
+            results[f"detect_faces/{name}/{faces}_faces"] = result
+    return results
+
+def bench_crypto(iterations):
+    from app.services.face_detection import decrypt_data, decrypt_features, encrypt_data, encrypt_features
+
+    features = np.random.default_rng(0).integers(0, 256, 4096).astype(np.uint8)
+    legacy = encrypt_data({'features': features.tolist()})
+    compact = encrypt_features(features)
+    return {
+        'encrypt_data': measure(lambda: encrypt_data({'features': features.tolist()}), iterations),
+        'decrypt_data': measure(lambda: decrypt_data(legacy), iterations),
+        'encrypt_features': measure(lambda: encrypt_features(features), iterations),
+        'decrypt_features': measure(lambda: decrypt_features(compact), iterations)
+    }
+
+def bench_compare(iterations, gallery_size):
+    from app.services.face_detection import compare_faces, compare_many, encrypt_features
+
+    rng = np.random.default_rng(1)
+    candidates = [encrypt_features(rng.integers(0, 256, 4096).astype(np.uint8)) for _ in range(gallery_size)]
+    query = candidates[0]
+    return {
+        'compare_faces': measure(lambda: compare_faces(query, candidates[1]), iterations),
+        f"compare_many/1x{gallery_size}": measure(lambda: compare_many([query], candidates), iterations,
+                                                 items=gallery_size)
+    }
+
+def bench_storage(tmp, iterations):
+    from app.services.file_storage import SecureFileStorage
+
+    storage = SecureFileStorage(os.path.join(tmp, 'storage'), {'jpg'})
+    data = make_image(*RESOLUTIONS['1080p'], faces=1)
+    return {'save_file/1080p': measure(lambda: storage.save_file(io.BytesIO(data), 'photo.jpg'), iterations)}
+
+def bench_rate_limiter(iterations):
+    from app.services.rate_limiter import RateLimiter
+
+    limiter = RateLimiter()
+    keys = [f"10.0.{i % 250}.{i // 250}:detect_face" for i in range(1000)]
+
+    def checks():
+        for key in keys:
+            limiter.check_rate_limit(key, 50, 60)
+    return {'check_rate_limit/1000_keys': measure(checks, iterations, items=len(keys))}
+
+def _seed_database(db, faces, photos_per_face):
+    from app.models import Contact, Face, Photo
+    from app.services.database import BulkWriter
+
+    writer = BulkWriter(db.session)
+    contact_ids = writer.insert(Contact, [{'name': f"Contact {i}"} for i in range(faces // 4)],
+                                returning=Contact.id)
+    face_ids = writer.insert(Face, [{
+        'name': f"Face {i}",
+        'contact_id': contact_ids[i] if i < len(contact_ids) else None
+    } for i in range(faces)], returning=Face.id)
+    writer.insert(Photo, [{
+        'filename': f"seed_{face_id}_{n}.jpg",
+        'filepath': f"/seed/{face_id}_{n}.jpg",
+        'face_id': face_id,
+        'photo_metadata': {'faces_detected': 1}
+    } for face_id in face_ids for n in range(photos_per_face)])
+    db.session.commit()
+
+def bench_api(tmp, iterations, library_size, seed_faces):
+    from app import create_app, db
+    from app.models import Photo, ScanManifest
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'faces.db'),
+        'UPLOAD_FOLDER': os.path.join(tmp, 'uploads'),
+        'RENDITION_CACHE_DIR': os.path.join(tmp, 'renditions'),
+        'SCAN_WORKERS': os.cpu_count() or 1,
+        'DB_AUTO_INIT': True,
+        'TESTING': True
+    })
+    client = app.test_client()
+    clients = iter(range(10 ** 9))
+
+    def call(method, url, **kwargs):
+        # A fresh client address per call keeps the route rate limits out of the measurement
+        address = next(clients)
+        response = client.open(url, method=method, environ_base={
+            'REMOTE_ADDR': f"10.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}"
+        }, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {url} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        return response
+
+    results = {}
+    upload = make_image(*RESOLUTIONS['1080p'], faces=2, seed=7)
+    # Repeated uploads of one image are near-duplicates; measure detection without reuse first
+    app.config['NEAR_DUPLICATE_REUSE'] = False
+    results['api/detect-face/1080p'] = measure(lambda: call(
+        'POST', '/api/detect-face', data={'file': (io.BytesIO(upload), 'upload.jpg')}
+    ), iterations)
+    batch = [make_image(*RESOLUTIONS['1080p'], faces=2, seed=seed) for seed in range(10)]
+    results[f"api/detect-faces/batch/{len(batch)}x1080p"] = measure(lambda: call(
+        'POST', '/api/detect-faces/batch',
+        data={'files': [(io.BytesIO(data), f'batch_{i}.jpg') for i, data in enumerate(batch)]}
+    ), max(1, iterations // 5), items=len(batch))
+    app.config['NEAR_DUPLICATE_REUSE'] = True
+    results['api/detect-face/1080p/near-duplicate'] = measure(lambda: call(
+        'POST', '/api/detect-face', data={'file': (io.BytesIO(upload), 'upload.jpg')}
+    ), iterations)
+
+    library = os.path.join(tmp, 'library')
+    write_library(library, library_size)
+    directory = os.path.abspath(library)
+
+    def forget_scan():
+        with app.app_context():
+            ScanManifest.query.filter_by(directory=directory).delete()
+            Photo.query.filter(Photo.filepath.startswith(directory)).delete(synchronize_session=False)
+            db.session.commit()
+    scan = lambda: call('POST', '/api/photos/scan', json={'directory': library})
+    results[f"api/photos/scan/full/{library_size}_photos"] = measure(
+        scan, max(1, iterations // 5), items=library_size, setup=forget_scan)
+    scan()
+    results[f"api/photos/scan/unchanged/{library_size}_photos"] = measure(scan, iterations, items=library_size)
+
+    with app.app_context():
+        _seed_database(db, seed_faces, 10)
+    results[f"api/photos/organize/{seed_faces}_faces"] = measure(
+        lambda: call('GET', '/api/photos/organize'), iterations)
+    results[f"api/photos/organize/{seed_faces}_faces/summary"] = measure(
+        lambda: call('GET', '/api/photos/organize?summary=1'), iterations)
+
+    # /api/detect-face and the batch route save uploads in the blueprint's upload folder rather than under tmp
+    from app.routes import file_storage
+    with app.app_context():
+        for filename, in db.session.query(Photo.filename).filter(
+                Photo.filename.startswith('upload_') | Photo.filename.startswith('batch_')):
+            file_storage.delete_file(filename)
+        db.session.remove()
+        db.engine.dispose()
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current):
+    """Print the p50 change of every case present in both runs"""
+    print(f"\n{'case':55} {'old p50':>10} {'new p50':>10} {'change':>8}")
+    for name, result in current['results'].items():
+        old = previous['results'].get(name)
+        if not old:
+            continue
+        change = (result['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0.0
+        print(f"{name:55} {old['p50_ms']:10.3f} {result['p50_ms']:10.3f} {change:+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON file to write')
+    parser.add_argument('--compare', help='earlier results JSON to compare against')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations and a smaller library')
+    parser.add_argument('--only', action='append', default=[],
+                        choices=['detection', 'crypto', 'compare', 'storage', 'rate_limiter', 'api'],
+                        help='run only these groups (repeatable)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    iterations = 5 if args.quick else 20
+    groups = set(args.only) or {'detection', 'crypto', 'compare', 'storage', 'rate_limiter', 'api'}
+    tmp = tempfile.mkdtemp(prefix='face-bench-')
+    results = {}
+    try:
+        if 'detection' in groups:
+            results.update(bench_detection(tmp, iterations))
+        if 'crypto' in groups:
+            results.update(bench_crypto(iterations * 10))
+        if 'compare' in groups:
+            results.update(bench_compare(iterations * 10, 1000))
+        if 'storage' in groups:
+            results.update(bench_storage(tmp, iterations * 5))
+        if 'rate_limiter' in groups:
+            results.update(bench_rate_limiter(iterations))
+        if 'api' in groups:
+            results.update(bench_api(tmp, iterations, 10 if args.quick else 40, 50 if args.quick else 500))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quick': args.quick
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name, result in results.items():
+        print(f"{name:55} p50 {result['p50_ms']:10.3f} ms  p95 {result['p95_ms']:10.3f} ms  "
+              f"{result['throughput_per_s']:12,.1f}/s")
+    print(f"\nWrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    sys.exit(main())
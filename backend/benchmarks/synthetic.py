@@ -0,0 +1,105 @@
+"""
+Deterministic synthetic photos for the benchmarks.
+
+Faces are drawn as simple cartoons (skin ellipse, dark brows and eyes,
+nose and mouth) that the Haar cascade detects, on a noisy background, so
+the suite needs no downloaded datasets.
+"""
+import os
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+def draw_face(image: np.ndarray, cx: int, cy: int, size: int, rng: np.random.Generator) -> None:
+    """Draw a detectable face of roughly size x size pixels centred on (cx, cy)"""
+    skin = int(rng.integers(170, 220))
+    cv2.ellipse(image, (cx, cy), (int(size * 0.42), int(size * 0.55)), 0, 0, 360,
+                (skin - 20, skin - 5, skin + 20), -1)
+    eye_y = cy - int(size * 0.12)
+    for eye_x in (cx - int(size * 0.17), cx + int(size * 0.17)):
+        cv2.ellipse(image, (eye_x, eye_y - int(size * 0.1)), (int(size * 0.11), int(size * 0.025)),
+                    0, 0, 360, (40, 40, 50), -1)
+        cv2.ellipse(image, (eye_x, eye_y), (int(size * 0.08), int(size * 0.045)), 0, 0, 360, (60, 60, 70), -1)
+        cv2.circle(image, (eye_x, eye_y), int(size * 0.03), (20, 20, 20), -1)
+    cv2.ellipse(image, (cx, cy + int(size * 0.08)), (int(size * 0.04), int(size * 0.1)), 0, 0, 360,
+                (skin - 40, skin - 25, skin), -1)
+    cv2.ellipse(image, (cx, cy + int(size * 0.28)), (int(size * 0.15), int(size * 0.04)), 0, 0, 360,
+                (60, 50, 120), -1)
+
+def make_image(width: int, height: int, faces: int = 1, seed: int = 0, quality: int = 90) -> bytes:
+    """JPEG bytes of a width x height photo with the given number of faces in a row"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 90, np.uint8)
+    image += rng.integers(0, 30, image.shape, dtype=np.uint8)
+    if faces:
+        slot = width // faces
+        size = int(min(slot * 0.6, height * 0.5))
+        for i in range(faces):
+            draw_face(image, slot * i + slot // 2, height // 2, size, rng)
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError('Failed to encode synthetic image')
+    return buffer.tobytes()
+
+def make_scene(width: int, height: int, faces: int, size: int, angle: float = 0.0,
+               seed: int = 0, quality: int = 90) -> Tuple[bytes, List[Tuple[int, int, int, int]]]:
+    """
+    JPEG bytes of a photo with faces of about size pixels on a grid, each
+    turned by up to angle degrees either way, and their (x, y, w, h)
+    ground-truth boxes.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 90, np.uint8)
+    image += rng.integers(0, 30, image.shape, dtype=np.uint8)
+    columns = max(1, int(np.ceil(np.sqrt(faces * width / height))))
+    rows = max(1, int(np.ceil(faces / columns)))
+    cell_w, cell_h = width // columns, height // rows
+    boxes = []
+    for i in range(faces):
+        cx = cell_w * (i % columns) + cell_w // 2 + int(rng.integers(-cell_w // 8, cell_w // 8 + 1))
+        cy = cell_h * (i // columns) + cell_h // 2 + int(rng.integers(-cell_h // 8, cell_h // 8 + 1))
+        layer = np.zeros_like(image)
+        draw_face(layer, cx, cy, size, rng)
+        if angle:
+            turn = cv2.getRotationMatrix2D((cx, cy), float(rng.uniform(-angle, angle)), 1.0)
+            layer = cv2.warpAffine(layer, turn, (width, height), flags=cv2.INTER_LINEAR)
+        mask = layer.any(axis=2)
+        image[mask] = layer[mask]
+        boxes.append((cx - size // 2, cy - size // 2, size, size))
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError('Failed to encode synthetic image')
+    return buffer.tobytes(), boxes
+
+def write_library(directory: str, count: int, width: int = 1280, height: int = 960,
+                  max_faces: int = 3, seed: int = 0) -> List[str]:
+    """Write count photos with 0..max_faces faces each and return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"photo_{i:05d}.jpg")
+        with open(path, 'wb') as f:
+            f.write(make_image(width, height, i % (max_faces + 1), seed + i))
+        paths.append(path)
+    return paths
+
+def make_embeddings(count: int, dim: int = 4096, identities: Optional[int] = None,
+                    seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unit-length non-negative vectors shaped like the pixel-crop face
+    features: a shared mean, a per-identity offset and per-photo noise.
+    Returns (vectors, identity of each vector).
+    """
+    rng = np.random.default_rng(seed)
+    identities = identities or max(1, count // 5)
+    base = rng.random(dim, dtype=np.float32)
+    centers = base + 0.35 * rng.standard_normal((identities, dim), dtype=np.float32)
+    labels = rng.integers(0, identities, count)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    for start in range(0, count, 8192):
+        block = labels[start:start + 8192]
+        noisy = centers[block] + 0.15 * rng.standard_normal((len(block), dim), dtype=np.float32)
+        np.clip(noisy, 0, None, out=noisy)
+        vectors[start:start + len(block)] = noisy / np.linalg.norm(noisy, axis=1, keepdims=True)
+    return vectors, labels
@@ -1,6 +1,9 @@
-from app import create_app
+from app import create_app, db
 
 app = create_app()
 
 if __name__ == '__main__':
+    # The development server creates the schema itself; deployments run `flask init-db`
+    with app.app_context():
+        db.create_all()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file